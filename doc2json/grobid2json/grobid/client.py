@@ -1,7 +1,10 @@
 """ Generic API Client """
 from copy import deepcopy
+import os
 import json
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 
 try:
     from urlparse import urljoin
@@ -9,6 +12,34 @@ except ImportError:
     from urllib.parse import urljoin
 
 
+# keep-alive sessions shared by every client of a process, keyed by (pid, pool size)
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def get_session(pool_size=10):
+    """ Return the pooled keep-alive session of the current process.
+
+    Sessions are never shared across a fork, a child process gets its own.
+
+    Args:
+        pool_size (int): Maximum number of connections kept open per host.
+
+    Returns:
+        requests.Session
+    """
+    key = (os.getpid(), pool_size)
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _SESSIONS[key] = session
+    return session
+
+
 class ApiClient(object):
     """ Client to interact with a generic Rest API.
 
@@ -18,6 +49,8 @@ class ApiClient(object):
 
     accept_type = 'application/xml'
     api_base = None
+    timeout = None
+    pool_size = 10
 
     def __init__(
             self,
@@ -33,7 +66,8 @@ class ApiClient(object):
             base_url (str): The base URL to the service being used.
             username (str): The username to authenticate with.
             api_key (str): The API key to authenticate with.
-            timeout (int): Maximum time before timing out.
+            timeout (int): Maximum time before timing out, used when a call
+                does not give its own.
         """
         self.base_url = base_url
         self.username = username
@@ -80,6 +114,15 @@ class ApiClient(object):
         except ValueError as e:
             return e.message
 
+    @property
+    def session(self):
+        """ Pooled keep-alive session used for every request of this client.
+
+        Returns:
+            requests.Session
+        """
+        return get_session(self.pool_size)
+
     def get_credentials(self):
         """ Returns parameters to be added to authenticate the request.
 
@@ -111,7 +154,8 @@ class ApiClient(object):
             params (dict or None): Query-string parameters.
             data (dict or None): Request body contents for POST or PUT requests.
             files (dict or None: Files to be passed to the request.
-            timeout (int): Maximum time before timing out.
+            timeout (int): Maximum time before timing out, defaults to the
+                client timeout.
 
         Returns:
             ResultParser or ErrorParser.
@@ -123,14 +167,14 @@ class ApiClient(object):
         files = files or {}
         #if self.username is not None and self.api_key is not None:
         #    params.update(self.get_credentials())
-        r = requests.request(
+        r = self.session.request(
             method,
             url,
             headers=headers,
             params=params,
             files=files,
             data=data,
-            timeout=timeout,
+            timeout=timeout if timeout is not None else self.timeout,
         )
 
         return r, r.status_code
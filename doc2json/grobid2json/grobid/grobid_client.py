@@ -4,9 +4,13 @@ import json
 import argparse
 import time
 import glob
+import requests
+from concurrent.futures import ThreadPoolExecutor
 from doc2json.grobid2json.grobid.client import ApiClient
+from doc2json.utils.grobid_cache import GrobidCache, DEFAULT_MAX_ENTRIES
 import ntpath
-from typing import List
+from typing import List, Optional
+from bs4 import BeautifulSoup
 
 '''
 This version uses the standard ProcessPoolExecutor for parallelizing the concurrent calls to the GROBID services.
@@ -28,6 +32,14 @@ DEFAULT_GROBID_CONFIG = {
     "include_raw_citations": True,
     "include_raw_affiliations": False,
     "max_workers": 2,
+    "timeout": 60,
+    "max_retries": 5,
+    "max_sleep_time": 60,
+    "batch_citations": True,
+    "citation_batch_size": 200,
+    "citation_concurrency": 2,
+    "cache_path": None,
+    "cache_max_entries": DEFAULT_MAX_ENTRIES,
 }
 
 class GrobidClient(ApiClient):
@@ -43,6 +55,41 @@ class GrobidClient(ApiClient):
         self.grobid_server = self.config["grobid_server"]
         self.grobid_port = self.config["grobid_port"]
         self.sleep_time = self.config["sleep_time"]
+        # max number of requests one paper keeps in flight while resolving its bibliography
+        self.citation_concurrency = max(1, self.config.get("citation_concurrency") or self.max_workers)
+        # connection pool of the shared keep-alive session, at least one connection per concurrent request
+        self.pool_size = max(self.config.get("pool_size") or self.max_workers, self.citation_concurrency)
+        # per-request timeout in seconds
+        self.timeout = self.config.get("timeout", 60)
+        # retries on 503 and connection errors wait sleep_time, 2 * sleep_time, ... up to max_sleep_time
+        self.max_retries = self.config.get("max_retries", 5)
+        self.max_sleep_time = self.config.get("max_sleep_time", 60)
+        self.batch_citations = self.config.get("batch_citations", True)
+        self.citation_batch_size = self.config.get("citation_batch_size", 200)
+        # on-disk cache of parsed results shared by all workers, disabled when no path is given
+        self.cache = None
+        if self.config.get("cache_path"):
+            self.cache = GrobidCache(
+                self.config["cache_path"],
+                max_entries=self.config.get("cache_max_entries", DEFAULT_MAX_ENTRIES)
+            )
+
+    def _post_with_retry(self, url: str, data: dict, headers: dict, files: Optional[dict] = None):
+        # POST with exponential backoff while GROBID is busy (503) or unreachable (connection errors, timeouts)
+        # returns (None, None) when no response could be obtained
+        res, status = None, None
+        for attempt in range(self.max_retries + 1):
+            try:
+                res, status = self.post(url=url, data=data, files=files, headers=headers, timeout=self.timeout)
+            except requests.exceptions.RequestException:
+                # 服务重启或连接被重置时，所有 worker 的所有线程同时重试，同样需要退避
+                res, status = None, None
+            else:
+                if status != 503:
+                    return res, status
+            if attempt < self.max_retries:
+                time.sleep(min(self.sleep_time * (2 ** attempt), self.max_sleep_time))
+        return res, status
 
     def process(self, input: str, output: str, service: str):
         batch_size_pdf = self.config['batch_size']
@@ -106,17 +153,14 @@ class GrobidClient(ApiClient):
         else:
             the_data['includeRawCitations'] = '0'
 
-        res, status = self.post(
+        res, status = self._post_with_retry(
             url=the_url,
             files=files,
             data=the_data,
             headers={'Accept': 'text/plain'}
         )
 
-        if status == 503:
-            time.sleep(self.sleep_time)
-            return self.process_pdf_stream(pdf_file, pdf_strm, service)
-        elif status != 200:
+        if status != 200:
             with open(os.path.join(output, "failed.log"), "a+") as failed:
                 failed.write(pdf_file.strip(".pdf") + "\n")
             print('Processing failed with error ' + str(status))
@@ -152,25 +196,81 @@ class GrobidClient(ApiClient):
         the_url += ":" + self.grobid_port
         the_url += "/api/processCitation"
 
-        for _ in range(5):
-            try:
-                res, status = self.post(
-                    url=the_url,
-                    data=the_data,
-                    headers={'Accept': 'text/plain'}
-                )
-                if status == 503:
-                    time.sleep(self.sleep_time)
-                    continue
-                elif status != 200:
-                    with open(log_file, "a+") as failed:
-                        failed.write("-- BIBSTR --\n")
-                        failed.write(bib_string + "\n\n")
-                    break
-                else:
-                    return res.text
-            except Exception:
-                continue
+        res, status = self._post_with_retry(
+            url=the_url,
+            data=the_data,
+            headers={'Accept': 'text/plain'}
+        )
+
+        if status is None:
+            return None
+        elif status != 200:
+            # one write per entry, citations can be processed from several threads
+            with open(log_file, "a+") as failed:
+                failed.write("-- BIBSTR --\n" + bib_string + "\n\n")
+        else:
+            return res.text
+
+    def _process_citation_batch(self, bib_strings: List[str]) -> Optional[List[Optional[str]]]:
+        # process a batch of citation strings in one call, None if the batch could not be mapped back
+        the_data = {
+            'citations': bib_strings,
+            'consolidateCitations': '0'
+        }
+
+        the_url = 'http://' + self.grobid_server
+        the_url += ":" + self.grobid_port
+        the_url += "/api/processCitationList"
+
+        res, status = self._post_with_retry(
+            url=the_url,
+            data=the_data,
+            headers={'Accept': 'application/xml'}
+        )
+
+        if status == 404:
+            # older GROBID servers have no processCitationList
+            self.batch_citations = False
+            return None
+        elif status != 200:
+            return None
+        else:
+            bib_structs = BeautifulSoup(res.text, 'lxml').find_all('biblstruct')
+            # results come back in input order, one biblStruct per citation
+            if len(bib_structs) != len(bib_strings):
+                return None
+            return [str(bib) if bib.get_text(strip=True) else None for bib in bib_structs]
+
+    def process_citation_list(self, bib_strings: List[str], log_file: str) -> List[Optional[str]]:
+        # process many citation raw strings with processCitationList, results are aligned with the input
+        # citations the batch call could not resolve fall back to one processCitation call each
+        # batches and fallback calls run concurrently, at most citation_concurrency at a time
+        batches = [
+            bib_strings[start:start + self.citation_batch_size]
+            for start in range(0, len(bib_strings), self.citation_batch_size)
+        ]
+        if self.citation_concurrency == 1:
+            return self._process_citation_batches(batches, log_file, map)
+        with ThreadPoolExecutor(max_workers=self.citation_concurrency) as executor:
+            return self._process_citation_batches(batches, log_file, executor.map)
+
+    def _process_citation_batches(self, batches: List[List[str]], log_file: str, map_fn) -> List[Optional[str]]:
+        def process_batch(batch):
+            if self.batch_citations and len(batch) > 1:
+                return self._process_citation_batch(batch)
+
+        def process_one(bib_string):
+            return self.process_citation(bib_string, log_file)
+
+        results = []
+        for batch, xml_strs in zip(batches, map_fn(process_batch, batches)):
+            results.extend(xml_strs or [None] * len(batch))
+        # per-item fallback for everything the batch calls did not resolve
+        bib_strings = [bib_string for batch in batches for bib_string in batch]
+        missing = [i for i, xml_str in enumerate(results) if not xml_str]
+        for i, xml_str in zip(missing, map_fn(process_one, [bib_strings[i] for i in missing])):
+            results[i] = xml_str
+        return results
 
     def process_header_names(self, header_string: str, log_file: str) -> str:
         # process author names from header string
@@ -182,16 +282,13 @@ class GrobidClient(ApiClient):
         the_url += ":" + self.grobid_port
         the_url += "/api/processHeaderNames"
 
-        res, status = self.post(
+        res, status = self._post_with_retry(
             url=the_url,
             data=the_data,
             headers={'Accept': 'text/plain'}
         )
 
-        if status == 503:
-            time.sleep(self.sleep_time)
-            return self.process_header_names(header_string, log_file)
-        elif status != 200:
+        if status != 200:
             with open(log_file, "a+") as failed:
                 failed.write("-- AUTHOR --\n")
                 failed.write(header_string + "\n\n")
@@ -208,16 +305,13 @@ class GrobidClient(ApiClient):
         the_url += ":" + self.grobid_port
         the_url += "/api/processAffiliations"
 
-        res, status = self.post(
+        res, status = self._post_with_retry(
             url=the_url,
             data=the_data,
             headers={'Accept': 'text/plain'}
         )
 
-        if status == 503:
-            time.sleep(self.sleep_time)
-            return self.process_affiliations(aff_string, log_file)
-        elif status != 200:
+        if status != 200:
             with open(log_file, "a+") as failed:
                 failed.write("-- AFFILIATION --\n")
                 failed.write(aff_string + "\n\n")
@@ -2,7 +2,9 @@ import base64
 from datetime import datetime
 import re
 import hashlib
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
 import json
 import io
 from typing import Tuple
@@ -16,6 +18,25 @@ import pyarrow as pa
 import pyarrow.parquet as parquet
 
 from doc2json.tex2json.json_to_md import convert_json_to_markdown
+from doc2json.utils.image_util import FigureRasterizer, DEFAULT_DPI, read_image_bytes
+
+# parquet 列结构，与 ArxivBlock.to_dict 保持一致；固定 schema 以便逐行组写入
+ARXIV_BLOCK_SCHEMA = pa.schema([
+    ("md5", pa.string()),
+    ("实体ID", pa.string()),
+    ("页ID", pa.null()),
+    ("块ID", pa.int64()),
+    ("文本", pa.string()),
+    ("图片", pa.binary()),
+    ("块类型", pa.string()),
+    ("时间", pa.string()),
+    ("扩展字段", pa.string()),
+])
+# 每个 parquet 文件内按行组写入的行数，决定写出时的内存峰值
+ROW_GROUP_SIZE = 50
+# 并行读取图片时最多提前提交的图片数，限制已完成但未写出的图片占用的内存
+FIGURE_PREFETCH = 16
+FIGURE_PATTERN = r'^\[BEGIN_FIGURE_PLACEHOLDER](.*?)\[END_FIGURE_PLACEHOLDER]'
 
 
 class ArxivBlock:
@@ -69,7 +90,9 @@ def get_timestamp():
     return datetime.now().strftime("%Y%m%d")
 
 
-def format_figure(figure_content, is_md_format=False):
+def format_figure(figure_content, is_md_format=False, rasterizer: Optional[FigureRasterizer] = None,
+                  images: Optional[Iterator[Tuple[bytes, Tuple[int, int]]]] = None):
+    # images: 预先读取好的图片结果，按 uris 的顺序消费；为 None 时在此处直接读取
     figure_data = json.loads(figure_content)
     uris = figure_data['uris']
     figure_index = figure_data['num']
@@ -80,7 +103,7 @@ def format_figure(figure_content, is_md_format=False):
     if is_md_format:
         caption = f'![Figure {figure_index}: {figure_data["text"]}]'
     if len(uris) == 1:
-        image_binary, img_size = read_image(uris[0])
+        image_binary, img_size = next(images) if images is not None else read_image(uris[0], rasterizer)
         binary_list.append(image_binary)
 
         size_list.append({'text_length': 0, 'type': 'figure', "image_size": {
@@ -89,7 +112,7 @@ def format_figure(figure_content, is_md_format=False):
             }})
     else:
         for sub_img_uri in uris:
-            image_binary, img_size = read_image(sub_img_uri)
+            image_binary, img_size = next(images) if images is not None else read_image(sub_img_uri, rasterizer)
             binary_list.append(image_binary)
             size_list.append({"image_size": {
                 "width": img_size[0],
@@ -99,35 +122,81 @@ def format_figure(figure_content, is_md_format=False):
     return caption, binary_list, size_list
 
 
-def read_image(img_path: Path) -> Tuple[bytes, Tuple[int, int]]:
+def read_image(img_path: Path, rasterizer: Optional[FigureRasterizer] = None) -> Tuple[bytes, Tuple[int, int]]:
     """将图片文件转换为二进制格式
 
     Args:
         img_path: 图片文件路径
+        rasterizer: PDF/EPS 图片的渲染器（DPI 与渲染缓存）
 
     Returns:
         bytes: 图片文件的二进制数据
         Tuple[int, int]: 图片的宽度和高度
     """
-    try:
-        print(img_path)
-        if Path(img_path).suffix.lower() == ".pdf":
-            image = convert_from_path(img_path)[0]
-        else:
-            with open(img_path, 'rb') as file:
-                image = PILImage.open(file)
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format=image.format)
-        img_byte_arr = img_byte_arr.getvalue()
-        return img_byte_arr, image.size
-    except Exception as e:
-        logger.error(f"图片转换二进制失败: {e}")
-        return None, (0, 0)
+    logger.debug(f"read image {img_path}")
+    return read_image_bytes(img_path, rasterizer)
+
+
+
+def iter_figure_uris(paragraphs: Iterable[str]) -> Iterator[str]:
+    """
+    All figure uris of a paper in document order
+    :param paragraphs: markdown paragraphs from convert_json_to_markdown
+    :return:
+    """
+    for paragraph in paragraphs:
+        figure_match = re.search(FIGURE_PATTERN, paragraph)
+        if figure_match:
+            yield from json.loads(figure_match.group(1))['uris']
+
+
+# 进程池中每个 worker 的渲染器，由 figure_executor 的 initializer 设置，内存中的渲染结果在任务之间复用
+_worker_rasterizer: Optional[FigureRasterizer] = None
+
+
+def _init_figure_worker(rasterizer: Optional[FigureRasterizer]):
+    global _worker_rasterizer
+    _worker_rasterizer = rasterizer
 
 
+def _read_image_in_worker(uri: str) -> Tuple[bytes, Tuple[int, int]]:
+    return read_image(uri, _worker_rasterizer)
 
-def convert_to_rows(input_file: Path):
-    rows = []
+
+def figure_executor(workers: int, rasterizer: Optional[FigureRasterizer] = None) -> ProcessPoolExecutor:
+    """
+    Process pool reading figures, every worker gets its own copy of the rasterizer once instead of one per figure
+    :param workers:
+    :param rasterizer:
+    :return:
+    """
+    return ProcessPoolExecutor(workers, initializer=_init_figure_worker, initargs=(rasterizer,))
+
+
+def prefetch_images(uris: Iterable[str], executor: Executor,
+                    prefetch: int = FIGURE_PREFETCH) -> Iterator[Tuple[bytes, Tuple[int, int]]]:
+    """
+    Read images in the executor, at most `prefetch` ahead of the consumer, and yield them in order
+    :param uris:
+    :param executor: see figure_executor, its workers render with their own rasterizer
+    :param prefetch:
+    :return:
+    """
+    pending = deque()
+    for uri in uris:
+        pending.append(executor.submit(_read_image_in_worker, uri))
+        if len(pending) >= prefetch:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def convert_to_rows(input_file: Path, rasterizer: Optional[FigureRasterizer] = None,
+                    executor: Optional[Executor] = None) -> Iterator[ArxivBlock]:
+    # 逐行生成 ArxivBlock，图片在对应行产出时才读取
+    # 传入 executor（见 figure_executor）时图片在进程池中提前读取，行仍按文档顺序产出
+    # 此时使用 worker 自己的渲染器，rasterizer 只用于当前进程内读取
+    row_count = 0
     json_file_md5 = hashlib.md5(input_file.read_bytes()).hexdigest()
     json_name = input_file.name
     block_id = 0
@@ -136,15 +205,19 @@ def convert_to_rows(input_file: Path):
         data = json.load(file)
 
     md_data = convert_json_to_markdown(data)
-    for paragraph in md_data.split('\n\n'):
+    paragraphs = md_data.split('\n\n')
+    images = None
+    if executor is not None:
+        images = prefetch_images(iter_figure_uris(paragraphs), executor)
+    for paragraph in paragraphs:
         if len(paragraph.strip()) == 0:
             continue
 
-        figure_match = re.search(r'^\[BEGIN_FIGURE_PLACEHOLDER](.*?)\[END_FIGURE_PLACEHOLDER]', paragraph)
+        figure_match = re.search(FIGURE_PATTERN, paragraph)
         table_match = re.search(r'^<table>(.*?)</table>$', paragraph)
         if figure_match:  # 图像
             figure_content = figure_match.group(1)
-            caption, binary_list, size_list = format_figure(figure_content)
+            caption, binary_list, size_list = format_figure(figure_content, rasterizer=rasterizer, images=images)
             text_content = [caption]
             image_content = [None]
             category = ['text']
@@ -185,7 +258,7 @@ def convert_to_rows(input_file: Path):
             image = image_content[i]
             item_category = category[i]
             meta = meta_data[i]
-            rows.append(ArxivBlock(
+            yield ArxivBlock(
                 file_md5=json_file_md5,
                 file_id=str(json_name).replace('.json', ''),
                 block_id=block_id,
@@ -194,46 +267,66 @@ def convert_to_rows(input_file: Path):
                 category=item_category,
                 timestamp=get_timestamp(),
                 meta_data=json.dumps(meta, ensure_ascii=False),
-            ))
+            )
             block_id += 1
+            row_count += 1
     logger.info(
-        f"process {input_file} done, {len(rows)} rows generated, {json_file_md5} {json_name}")
-    return rows
+        f"process {input_file} done, {row_count} rows generated, {json_file_md5} {json_name}")
 
 
-def batch_to_parquet(output_file: Path, split_size: int, batchs: List[ArxivBlock]):
-    # 将 rows 写入 parquet 文件
+def batch_to_parquet(output_file: Path, split_size: int, batchs: Iterable[ArxivBlock],
+                     row_group_size: int = ROW_GROUP_SIZE) -> List[Path]:
+    # 将 rows 写入 parquet 文件，返回生成的 parquet 文件列表
+    # batchs 可以是生成器：每 split_size 行写一个文件，文件内每 row_group_size 行写一个行组，
+    # 因此内存中最多只保留一个行组的数据
+    output_files = []
     batch_rows = []
-    # 将 batchs 按 split_size 分割，
-    # 当 batch 长度大于 split_size 时，将 batch 写入 parquet 文件
-    # 当 batch 长度小于 split_size 时，继续追加 batch_rows
-    batch_count = 0
+    writer = None
     split_count = 0
-    for batch in batchs:
-        batch_count += 1
-        batch_rows.append(batch)
-        if batch_count >= split_size:
-            df = pd.DataFrame([row.to_dict() for row in batch_rows])
-            output_file_split = output_file.parent / \
-                f"{output_file.stem}_{split_count}.parquet"
-            # 使用 pyarrow 引擎
-            table = pa.Table.from_pandas(df)
-            # 保存为 parquet
-            parquet.write_table(table, output_file_split)
-            logger.info(
-                f"batch {split_count} done, {output_file_split} generated")
-            batch_rows = []
-            batch_count = 0
-            split_count += 1
-
-    # 处理最后一个 batch
-    if batch_rows:
-        df = pd.DataFrame([row.to_dict() for row in batch_rows])
-        output_file_last = output_file.parent / \
-            f"{output_file.stem}_{split_count}.parquet"
-        table = pa.Table.from_pandas(df)
-        parquet.write_table(table, output_file_last)
-        logger.info(f"batch {split_count} done, {output_file_last} generated")
+    split_rows = 0
+
+    def flush_rows():
+        if batch_rows:
+            table = pa.Table.from_pylist([row.to_dict() for row in batch_rows], schema=ARXIV_BLOCK_SCHEMA)
+            writer.write_table(table)
+            batch_rows.clear()
+
+    try:
+        for batch in batchs:
+            if writer is None:
+                output_file_split = output_file.parent / \
+                    f"{output_file.stem}_{split_count}.parquet"
+                writer = parquet.ParquetWriter(output_file_split, ARXIV_BLOCK_SCHEMA)
+                output_files.append(output_file_split)
+            batch_rows.append(batch)
+            split_rows += 1
+            if len(batch_rows) >= row_group_size:
+                flush_rows()
+            # 当 split 写满 split_size 行时关闭当前文件
+            if split_rows >= split_size:
+                flush_rows()
+                writer.close()
+                writer = None
+                logger.info(
+                    f"batch {split_count} done, {output_files[-1]} generated")
+                split_rows = 0
+                split_count += 1
+
+        # 处理最后一个 batch
+        if writer is not None:
+            flush_rows()
+            writer.close()
+            writer = None
+            logger.info(f"batch {split_count} done, {output_files[-1]} generated")
+    except Exception:
+        # 不留下写了一半的 parquet 文件
+        if writer is not None:
+            writer.close()
+        for output_file_split in output_files:
+            if output_file_split.exists():
+                output_file_split.unlink()
+        raise
+    return output_files
 
 def main():
     parser = argparse.ArgumentParser(description="Docling Convert")
@@ -243,6 +336,10 @@ def main():
                         help="Split size")  # 500-1000MB 一个 parquet 文件
     parser.add_argument("--log_dir", "-l", type=Path,
                         default="logs", help="Log level")
+    parser.add_argument("--dpi", type=int, default=DEFAULT_DPI, help="DPI used to render PDF/EPS figures")
+    parser.add_argument("--figure_cache", type=Path, default=None, help="Directory caching rendered PDF/EPS figures")
+    parser.add_argument("--figure_workers", type=int, default=0,
+                        help="Processes reading/rendering figures, 0 reads them inline")
     args = parser.parse_args()
 
     current_date = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
@@ -256,8 +353,13 @@ def main():
     logger.add(logger_file, encoding="utf-8", rotation="500MB")
 
     # # for paragraph in md_data.split('\n\n'):
-    batchs = convert_to_rows(input_file)
-    batch_to_parquet(output_file, split_size, batchs)
+    rasterizer = FigureRasterizer(args.dpi, args.figure_cache)
+    if args.figure_workers > 0:
+        with figure_executor(args.figure_workers, rasterizer) as executor:
+            batch_to_parquet(output_file, split_size, convert_to_rows(input_file, rasterizer, executor))
+    else:
+        batchs = convert_to_rows(input_file, rasterizer)
+        batch_to_parquet(output_file, split_size, batchs)
 
 
 def bytes_to_img(img_byte_arr, img_path):
@@ -0,0 +1,140 @@
+"""
+Decide which members of an arXiv source archive are worth extracting
+
+arXiv sources often ship datasets, videos and pdf supplements that the pipeline
+never reads. LaTeX sources are always extracted, images only when a source file
+references them (\\includegraphics, \\epsfig, ...), and every other member only
+when it is below the size cap.
+"""
+import os
+import re
+from typing import Iterable, Optional, Set
+
+# 总是解压的源文件；.txt 可能是很大的数据或日志，与其他文件一样受大小上限约束
+SOURCE_EXTENSIONS = {
+    '.tex', '.bbl', '.sty', '.cls', '.bib', '.bst', '.clo', '.def', '.cfg', '.ltx', '.latex'
+}
+# 仅在被源文件引用时解压的图片
+IMAGE_EXTENSIONS = {
+    '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff', '.webp', '.pdf', '.eps', '.ps', '.svg', '.mps'
+}
+# 除源文件外，还会在其中查找图片引用的文件（inkscape/xfig 导出、tikz 等）
+SCANNED_EXTENSIONS = (SOURCE_EXTENSIONS - {'.bib', '.bbl', '.bst'}) | {
+    '.pdf_tex', '.eps_tex', '.pstex_t', '.pdf_t', '.tikz', '.pgf', ''
+}
+# 其余文件超过该大小时跳过
+DEFAULT_MAX_MEMBER_SIZE = 50 * 1024 * 1024
+
+GRAPHICS_PATT = re.compile(
+    r'\\(?:includegraphics|epsfig|psfig|epsfbox|epsffile|includepdf|plotone|plotfiddle|begin\s*\{overpic\})'
+    r'\*?\s*(?:\[[^\]]*\]\s*)*\{([^}]*)\}',
+    re.I
+)
+PLOTTWO_PATT = re.compile(r'\\plottwo\s*\{([^}]*)\}\s*\{([^}]*)\}', re.I)
+GRAPHICS_KEY_PATT = re.compile(r'(?:file|figure)\s*=\s*([^,}\s]+)', re.I)
+
+
+def strip_image_extension(name: str) -> str:
+    """
+    Normalize an image path or reference so that `figs/a`, `./figs/a.pdf` and `figs/a.PDF` compare equal
+    :param name:
+    :return:
+    """
+    name = name.strip().strip('"')
+    while name.startswith('./'):
+        name = name[2:]
+    stem, ext = os.path.splitext(name)
+    if ext.lower() in IMAGE_EXTENSIONS or ext.lower() == '.gz':
+        name = stem
+    return name.lower()
+
+
+def find_graphics_references(latex_str: str) -> Set[str]:
+    """
+    Collect the file names passed to graphics commands in a LaTeX string
+    :param latex_str:
+    :return: normalized references, see strip_image_extension
+    """
+    references = set()
+    for match in GRAPHICS_PATT.finditer(latex_str):
+        arg = match.group(1)
+        # \epsfig{file=a.eps,width=...}
+        keys = GRAPHICS_KEY_PATT.findall(arg)
+        for ref in (keys or [arg]):
+            references.add(strip_image_extension(ref))
+    for match in PLOTTWO_PATT.finditer(latex_str):
+        references.update(strip_image_extension(ref) for ref in match.groups())
+    return references
+
+
+class ExtractionPolicy:
+    """
+    Which archive members extract_latex writes to disk
+    """
+
+    def __init__(self, selective: bool = True, max_member_size: Optional[int] = DEFAULT_MAX_MEMBER_SIZE):
+        """
+        :param selective: False extracts every member, as before
+        :param max_member_size: members other than LaTeX sources above this size are skipped, None for no cap
+        """
+        self.selective = selective
+        self.max_member_size = max_member_size
+
+    @staticmethod
+    def is_source(name: str) -> bool:
+        return os.path.splitext(name)[1].lower() in SOURCE_EXTENSIONS
+
+    @staticmethod
+    def is_image(name: str) -> bool:
+        return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+    def extract_first(self, name: str, size: int) -> bool:
+        """
+        Extract the member in the first pass, before references are known
+        :param name: member path inside the archive
+        :param size: uncompressed size of the member
+        :return:
+        """
+        if not self.selective or self.is_source(name):
+            return True
+        if self.is_image(name):
+            return False
+        return self.max_member_size is None or size <= self.max_member_size
+
+    def is_referenced(self, name: str, size: int, references: Set[str]) -> bool:
+        """
+        Extract an image member in the second pass
+        :param name: member path inside the archive
+        :param size: uncompressed size of the member
+        :param references: see collect_references, None means every image is needed
+        :return:
+        """
+        if self.max_member_size is not None and size > self.max_member_size:
+            return False
+        if references is None:
+            return True
+        stem = strip_image_extension(name)
+        return stem in references or os.path.basename(stem) in references
+
+    def collect_references(self, source_files: Iterable[str]) -> Optional[Set[str]]:
+        """
+        Scan extracted source files for graphics references
+        :param source_files: paths of the extracted files
+        :return: normalized references and their file names, or None when a reference can not be resolved statically
+        """
+        # local import, latex_util pulls in libmagic
+        from doc2json.utils.latex_util import read_file
+
+        references = set()
+        for fpath in source_files:
+            if os.path.splitext(fpath)[1].lower() not in SCANNED_EXTENSIONS:
+                continue
+            try:
+                references |= find_graphics_references(read_file(fpath))
+            except Exception:
+                continue
+        # 参数来自宏（如 \newcommand{\fig}[1]{\includegraphics{#1}}）时无法判断，解压全部图片
+        if any('#' in ref or '\\' in ref for ref in references):
+            return None
+        # \graphicspath 下的引用无法按路径匹配，同时记录文件名
+        return references | {os.path.basename(ref) for ref in references}
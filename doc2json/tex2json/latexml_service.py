@@ -0,0 +1,174 @@
+"""
+Warm LaTeXML daemons for the LaTeX pipeline
+
+latexml loads its Perl bindings and style files on every start, which is a large
+share of the per-paper time. The parent process keeps one `latexmls` daemon per
+worker slot and workers send their paper to it with `latexmlc --port=...`, which
+runs both the conversion and the post-processing in the warm process.
+A daemon is restarted after max_jobs papers, because LaTeXML state builds up
+across documents, and whenever a conversion on it hung or its worker was killed.
+Daemons are started without waiting for them: the parent keeps scheduling papers
+and enforcing timeouts, and papers of a slot whose daemon is not listening yet
+run latexml on their own.
+"""
+import os
+import signal
+import socket
+import subprocess
+import time
+from typing import Optional
+
+# latexmls 默认使用 3334 端口，避开它
+DEFAULT_BASE_PORT = 3354
+DEFAULT_MAX_JOBS = 50
+# 守护进程空闲多久后自行退出（秒），父进程异常退出时也不会残留
+DEFAULT_EXPIRE = 600
+# 守护进程开始监听的最长时间（秒），超过后该 slot 改为每篇论文单独运行 latexml
+STARTUP_TIMEOUT = 60
+
+
+def port_is_open(port: int, host: str = '127.0.0.1') -> bool:
+    """
+    Whether something accepts connections on the port
+    :param port:
+    :param host:
+    :return:
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.settimeout(1)
+        return sock.connect_ex((host, port)) == 0
+
+
+class LatexmlService:
+    """
+    One `latexmls` daemon per worker slot, owned by the parent process
+    """
+
+    def __init__(self, base_port: int = DEFAULT_BASE_PORT, max_jobs: int = DEFAULT_MAX_JOBS,
+                 expire: int = DEFAULT_EXPIRE, log_file: Optional[str] = None):
+        """
+        :param base_port: the daemon of slot i listens on base_port + i
+        :param max_jobs: papers converted by one daemon before it is restarted
+        :param expire: seconds of inactivity after which a daemon exits by itself
+        :param log_file: file collecting the daemons' stderr, None discards it
+        """
+        self.base_port = base_port
+        self.max_jobs = max_jobs
+        self.expire = expire
+        self.log_file = log_file
+        self.available = True
+        self._daemons = dict()  # slot -> Popen
+        self._jobs = dict()     # slot -> papers sent since the daemon started
+        self._starting = dict()  # slot -> start time of a daemon that is not listening yet
+        self._disabled = set()  # slots whose daemon could not be started
+
+    def port(self, slot: int) -> int:
+        return self.base_port + slot
+
+    def start(self, slot: int) -> bool:
+        """
+        Start the daemon of a slot without waiting for it to listen, see ready
+        :param slot:
+        :return: whether the daemon was launched
+        """
+        port = self.port(slot)
+        if port_is_open(port):
+            print(f"[ERROR] port {port} is already in use, slot {slot} runs latexml per paper")
+            self._disabled.add(slot)
+            return False
+        args = ['latexmls', f'--port={port}', f'--expire={self.expire}']
+        try:
+            with open(self.log_file or os.devnull, 'a') as err_f:
+                # 独立的进程组，终端的 Ctrl-C 由父进程统一处理
+                daemon = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=err_f, start_new_session=True)
+        except FileNotFoundError:
+            print("[ERROR] latexmls not found, running latexml per paper")
+            self.available = False
+            return False
+        self._daemons[slot] = daemon
+        self._jobs[slot] = 0
+        self._starting[slot] = time.time()
+        return True
+
+    def start_all(self, slots: int):
+        """
+        Launch the daemons of the first slots when the pool starts, so they warm up while the first papers run
+        :param slots: number of worker slots
+        :return:
+        """
+        for slot in range(slots):
+            if self.available and slot not in self._disabled and slot not in self._daemons:
+                self.start(slot)
+
+    def ready(self, slot: int) -> bool:
+        """
+        Whether the daemon of a slot listens, without blocking
+        :param slot:
+        :return:
+        """
+        daemon = self._daemons.get(slot)
+        if daemon is None or daemon.poll() is not None:
+            return False
+        if slot not in self._starting:
+            return True
+        if port_is_open(self.port(slot)):
+            del self._starting[slot]
+            return True
+        if time.time() - self._starting[slot] > STARTUP_TIMEOUT:
+            print(f"[ERROR] latexmls on port {self.port(slot)} did not start, slot {slot} runs latexml per paper")
+            self.stop(slot)
+            self._disabled.add(slot)
+        return False
+
+    def stop(self, slot: int):
+        """
+        Stop the daemon of a slot, the next acquire starts a new one
+        :param slot:
+        :return:
+        """
+        daemon = self._daemons.pop(slot, None)
+        self._jobs.pop(slot, None)
+        self._starting.pop(slot, None)
+        if daemon is None or daemon.poll() is not None:
+            return
+        # latexmls 会 fork 子进程，整个进程组一起结束
+        try:
+            os.killpg(daemon.pid, signal.SIGTERM)
+            daemon.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            os.killpg(daemon.pid, signal.SIGKILL)
+            daemon.wait()
+        except ProcessLookupError:
+            daemon.wait()
+
+    def acquire(self, slot: int) -> Optional[int]:
+        """
+        Port of the slot's daemon for the next paper, (re)starting the daemon when needed
+        Never waits for a daemon to start: the paper runs latexml on its own until the daemon listens
+        :param slot:
+        :return: port, or None when the paper should run latexml on its own
+        """
+        if not self.available or slot in self._disabled:
+            return None
+        daemon = self._daemons.get(slot)
+        if daemon is not None and (daemon.poll() is not None or self._jobs[slot] >= self.max_jobs):
+            if daemon.poll() is not None and slot in self._starting:
+                # 启动过程中退出，与超时未监听同样处理
+                print(f"[ERROR] latexmls on port {self.port(slot)} exited on start, slot {slot} runs latexml per paper")
+                self.stop(slot)
+                self._disabled.add(slot)
+                return None
+            self.stop(slot)
+            daemon = None
+        if daemon is None:
+            self.start(slot)
+            return None
+        if not self.ready(slot):
+            return None
+        self._jobs[slot] += 1
+        return self.port(slot)
+
+    def close(self):
+        for slot in list(self._daemons.keys()):
+            self.stop(slot)
+
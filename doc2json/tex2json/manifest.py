@@ -0,0 +1,123 @@
+"""
+Append-only completion manifest for batch runs
+
+Every finished archive appends one JSON line:
+    {"source": ..., "status": "ok" | "failed" | "timeout", "outputs": [...],
+     "md5": ..., "runtime": ..., "error": ..., "timestamp": ...}
+
+On restart the manifest is replayed into a dict keyed by source path, the last
+record of a source wins, and only sources whose last status is "ok" are skipped.
+"""
+import os
+import json
+import hashlib
+import time
+from typing import Dict, List, Optional
+
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'
+STATUS_TIMEOUT = 'timeout'
+
+
+def file_md5(file_path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    md5 of a file, read in chunks so large archives are not loaded at once
+    :param file_path:
+    :param chunk_size:
+    :return:
+    """
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class CompletionManifest:
+    """
+    JSONL manifest of processed sources, safe to resume after a crash
+    """
+
+    def __init__(self, manifest_file: str):
+        self.manifest_file = manifest_file
+        self._entries = dict()
+        manifest_dir = os.path.dirname(manifest_file)
+        if manifest_dir:
+            os.makedirs(manifest_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.manifest_file):
+            return
+        with open(self.manifest_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 进程崩溃时最后一行可能只写了一半
+                    continue
+                if isinstance(entry, dict) and entry.get('source'):
+                    self._entries[entry['source']] = entry
+        self._truncate_torn_tail()
+
+    def _truncate_torn_tail(self):
+        # 崩溃留下的半行没有换行符，截掉它，否则下一条记录会接在半行后面而无法解析
+        with open(self.manifest_file, 'rb+') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return
+            f.seek(0)
+            f.truncate(f.read().rfind(b'\n') + 1)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, source: str) -> Optional[Dict]:
+        return self._entries.get(str(source))
+
+    def is_completed(self, source: str) -> bool:
+        entry = self._entries.get(str(source))
+        return entry is not None and entry.get('status') == STATUS_OK
+
+    def record(
+            self,
+            source: str,
+            status: str,
+            outputs: Optional[List[str]] = None,
+            md5: Optional[str] = None,
+            runtime: Optional[float] = None,
+            error: Optional[str] = None
+    ) -> Dict:
+        """
+        Append one record and flush it to disk before returning
+        :param source:
+        :param status:
+        :param outputs:
+        :param md5:
+        :param runtime:
+        :param error:
+        :return:
+        """
+        entry = {
+            "source": str(source),
+            "status": status,
+            "outputs": outputs or [],
+            "md5": md5,
+            "runtime": runtime,
+            "error": error,
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
+        }
+        with open(self.manifest_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._entries[entry['source']] = entry
+        return entry
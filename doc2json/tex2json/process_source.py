@@ -1,28 +1,295 @@
 import argparse
+import errno
 import gzip
 import os
+import queue
+import signal
+from collections import deque
 from pathlib import Path
 import pathlib
 import tarfile
 import tempfile
 import time
 import multiprocessing as mp
+from typing import Dict, List, Optional
 
 from doc2json.tex2json.process_tex import process_tex_file, clean_tmp
-from doc2json.tex2json.arxiv_to_mm import convert_to_rows, batch_to_parquet
+from doc2json.tex2json.arxiv_to_mm import convert_to_rows, batch_to_parquet, figure_executor
+from doc2json.tex2json.extract_policy import ExtractionPolicy, DEFAULT_MAX_MEMBER_SIZE
+from doc2json.tex2json.workdir import WorkdirPool, DEFAULT_TMPFS_BUDGET, paper_log_dir, ran_out_of_space
+from doc2json.tex2json.latexml_service import LatexmlService, DEFAULT_BASE_PORT, DEFAULT_MAX_JOBS
+from doc2json.tex2json.manifest import CompletionManifest, file_md5, STATUS_OK, STATUS_FAILED, STATUS_TIMEOUT
+from doc2json.tex2json.xml_to_json import XML_ENGINE, XML_ENGINES, HTML_TABLES_ONLY
+from doc2json.tex2json.tex_to_xml import LAZY_LATEXML
+from doc2json.grobid2json.grobid.grobid_client import DEFAULT_GROBID_CONFIG
+from doc2json.utils import latex_util, tool_runner, mathml_util
+from doc2json.utils.mathml_util import MathmlConverter
+from doc2json.utils.image_util import FigureRasterizer, DEFAULT_DPI
 
 BASE_TEMP_DIR = 'temp'
 BASE_OUTPUT_DIR = 'output'
 BASE_LOG_DIR = 'log'
 
+# 父进程轮询子进程结果的间隔（秒）
+POLL_INTERVAL = 0.5
 
-def _process_one(source_path: str, temp_path: str, output_path: str, split_size: int, log_path: str, keep_temp: bool):
-    output_file, main_tex_file = process_tex_file(source_path, temp_path, output_path, log_path, keep_temp)
+
+def _process_one(source_path: str, temp_path: str, output_path: str, split_size: int, log_path: str, keep_temp: bool,
+                 grobid_config: Optional[Dict]=None, rasterizer: Optional[FigureRasterizer]=None,
+                 figure_workers: int=0, extraction_policy: Optional[ExtractionPolicy]=None,
+                 latexml_port: Optional[int]=None, xml_engine: str=XML_ENGINE,
+                 html_tables_only: bool=HTML_TABLES_ONLY, lazy_latexml: bool=LAZY_LATEXML) -> List[str]:
+    output_file, main_tex_file = process_tex_file(
+        source_path, temp_path, output_path, log_path, keep_temp, grobid_config=grobid_config,
+        extraction_policy=extraction_policy, latexml_port=latexml_port, xml_engine=xml_engine,
+        html_tables_only=html_tables_only, lazy_latexml=lazy_latexml
+    )
     if output_file is None or main_tex_file is None:
         raise RuntimeError(f"{source_path} is not a valid tex file")
     parquet_out = output_file.replace('.json', '.parquet')
-    batchs = convert_to_rows(Path(output_file))
-    batch_to_parquet(Path(parquet_out), split_size, batchs)
+    if figure_workers > 0:
+        # 图片读取/渲染放到进程池，文本行的组装与写出在当前进程进行
+        with figure_executor(figure_workers, rasterizer) as executor:
+            batchs = convert_to_rows(Path(output_file), rasterizer, executor)
+            parquet_files = batch_to_parquet(Path(parquet_out), split_size, batchs)
+    else:
+        batchs = convert_to_rows(Path(output_file), rasterizer)
+        parquet_files = batch_to_parquet(Path(parquet_out), split_size, batchs)
+    return [output_file] + [str(f) for f in parquet_files]
+
+
+def _on_terminate(signum, frame):
+    tool_runner.kill_active_tools()
+    os._exit(128 + signum)
+
+
+def _worker(job_id: int, source_path: str, temp_path: str, output_path: str, split_size: int, log_path: str,
+            keep_temp: bool, grobid_config: Optional[Dict], rasterizer: Optional[FigureRasterizer],
+            figure_workers: int, extraction_policy: Optional[ExtractionPolicy], latexml_port: Optional[int],
+            xml_engine: str, html_tables_only: bool, lazy_latexml: bool, result_queue: mp.Queue):
+    """
+    Run one archive in a child process and report the result to the parent
+    :param job_id:
+    :param source_path:
+    :param temp_path:
+    :param output_path:
+    :param split_size:
+    :param log_path:
+    :param keep_temp:
+    :param grobid_config:
+    :param rasterizer:
+    :param figure_workers:
+    :param extraction_policy:
+    :param latexml_port:
+    :param xml_engine:
+    :param html_tables_only:
+    :param lazy_latexml:
+    :param result_queue:
+    :return:
+    """
+    # 父进程超时终止 worker 时，先结束仍在运行的外部工具（它们在独立的进程组中）
+    signal.signal(signal.SIGTERM, _on_terminate)
+    start_time = time.time()
+    result = {"job_id": job_id, "source": source_path, "status": STATUS_OK, "error": None, "outputs": [], "md5": None}
+    try:
+        # hash before processing, the archive is removed when temp files are not kept
+        result["md5"] = file_md5(source_path)
+        result["outputs"] = _process_one(
+            source_path, temp_path, output_path, split_size, log_path, keep_temp, grobid_config, rasterizer,
+            figure_workers, extraction_policy, latexml_port, xml_engine, html_tables_only, lazy_latexml
+        )
+    except Exception as e:
+        result["status"] = STATUS_FAILED
+        result["error"] = str(e)
+        # tmpfs 空间不足时由父进程改在磁盘上重试；外部工具写满时只表现为工具出错或没有输出
+        result["no_space"] = (isinstance(e, OSError) and e.errno == errno.ENOSPC) or ran_out_of_space(temp_path)
+    # latexmls 上卡住的转换，父进程据此重启该守护进程
+    result["latexml_timeouts"] = latex_util.latexml_timeouts
+    # worker 只处理一篇论文，计数即该论文的公式缓存命中情况
+    result["mathml_hits"] = mathml_util.get_converter().hits
+    result["mathml_misses"] = mathml_util.get_converter().misses
+    result["runtime"] = round(time.time() - start_time, 3)
+    result_queue.put(result)
+
+
+def _drain_results(result_queue: mp.Queue, results: Dict, block: bool):
+    """
+    Move every result currently available on the queue into results
+    :param result_queue:
+    :param results:
+    :param block: wait up to POLL_INTERVAL for the first result
+    :return:
+    """
+    try:
+        result = result_queue.get(timeout=POLL_INTERVAL) if block else result_queue.get_nowait()
+        results[result["job_id"]] = result
+        while True:
+            result = result_queue.get_nowait()
+            results[result["job_id"]] = result
+    except queue.Empty:
+        pass
+
+
+def process_source_list(
+        input_list: List,
+        temp_path: str=BASE_TEMP_DIR,
+        output_path: str=BASE_OUTPUT_DIR,
+        split_size: int=200,
+        log_path: str=BASE_LOG_DIR,
+        keep_temp: bool=True,
+        timeout: int=600,
+        workers: int=1,
+        manifest: Optional[CompletionManifest]=None,
+        grobid_config: Optional[Dict]=None,
+        rasterizer: Optional[FigureRasterizer]=None,
+        figure_workers: int=0,
+        extraction_policy: Optional[ExtractionPolicy]=None,
+        workdir_pool: Optional[WorkdirPool]=None,
+        latexml_service: Optional[LatexmlService]=None,
+        xml_engine: str=XML_ENGINE,
+        html_tables_only: bool=HTML_TABLES_ONLY,
+        lazy_latexml: bool=LAZY_LATEXML
+) -> Dict:
+    """
+    Process a list of source archives with at most `workers` archives in flight
+    Each archive runs in its own process so the per-file timeout can still kill it
+    :param input_list:
+    :param temp_path:
+    :param output_path:
+    :param split_size:
+    :param log_path:
+    :param keep_temp:
+    :param timeout: per-file max seconds before skipping
+    :param workers: number of archives processed concurrently
+    :param manifest: completion manifest, archives already completed in it are skipped
+    :param grobid_config:
+    :param rasterizer: renders PDF/EPS figures, sets the DPI and the on-disk render cache
+    :param figure_workers: processes per archive reading/rendering figures, 0 reads them inline
+    :param extraction_policy: which archive members are extracted, default skips unreferenced images and huge files
+    :param workdir_pool: per-paper working directories, default puts them all under temp_path
+    :param latexml_service: warm latexmls daemons per worker slot, default runs latexml per paper
+    :param xml_engine: engine converting the tralics xml, see xml_to_json.XML_ENGINES
+    :param html_tables_only: parse only the table figures of the LaTeXML html instead of the whole page
+    :param lazy_latexml: skip latexml for papers whose tex has no table environment
+    :return: counts of processed, failed and skipped archives and of MathML cache hits and misses
+    """
+    os.makedirs(temp_path, exist_ok=True)
+    os.makedirs(output_path, exist_ok=True)
+
+    workers = max(1, workers)
+    if workdir_pool is None:
+        workdir_pool = WorkdirPool(temp_path)
+    if latexml_service is not None:
+        # 守护进程在前几篇论文运行期间启动，就绪前这些论文单独运行 latexml
+        latexml_service.start_all(workers)
+    result_queue = mp.Queue()
+    pending = iter(enumerate(input_list))
+    retry = deque()     # (job_id, source_path) that ran out of space on tmpfs
+    free_slots = list(range(workers))
+    running = dict()    # job_id -> (source_path, process, start_time, slot, workdir, on_tmpfs)
+    results = dict()    # job_id -> result reported by the child
+    processed = 0
+    failed = 0
+    skipped = 0
+    mathml_hits = 0
+    mathml_misses = 0
+    exhausted = False
+
+    while not exhausted or running or retry:
+        # keep the pool full
+        while (retry or not exhausted) and len(running) < workers:
+            if retry:
+                job_id, source_path = retry.popleft()
+                on_disk = True
+            else:
+                try:
+                    job_id, source_path = next(pending)
+                except StopIteration:
+                    exhausted = True
+                    break
+                source_path = str(source_path)
+                on_disk = False
+                if manifest is not None and manifest.is_completed(source_path):
+                    skipped += 1
+                    continue
+            slot = free_slots.pop()
+            workdir, on_tmpfs = workdir_pool.allocate(source_path, slot, on_disk=on_disk)
+            latexml_port = latexml_service.acquire(slot) if latexml_service is not None else None
+            print(f"[INFO] start processing {source_path}" + (" on tmpfs" if on_tmpfs else ""))
+            p = mp.Process(
+                target=_worker,
+                args=(job_id, source_path, workdir, output_path, split_size, paper_log_dir(workdir), keep_temp,
+                      grobid_config,
+                      rasterizer, figure_workers, extraction_policy, latexml_port, xml_engine, html_tables_only,
+                      lazy_latexml, result_queue)
+            )
+            p.start()
+            running[job_id] = (source_path, p, time.time(), slot, workdir, on_tmpfs)
+
+        if not running:
+            continue
+
+        _drain_results(result_queue, results, block=True)
+
+        for job_id in list(running.keys()):
+            source_path, p, start_time, slot, workdir, on_tmpfs = running[job_id]
+            if job_id not in results and not p.is_alive():
+                # the child may have exited right after putting its result
+                _drain_results(result_queue, results, block=False)
+            if job_id in results:
+                p.join()
+                result = results.pop(job_id)
+            elif not p.is_alive():
+                p.join()
+                result = {"job_id": job_id, "source": source_path, "status": STATUS_FAILED,
+                          "error": f"worker exited with code {p.exitcode}",
+                          "runtime": round(time.time() - start_time, 3)}
+            elif time.time() - start_time > timeout:
+                print(f"[ERROR] processing {source_path} timeout after {timeout}s, skipping")
+                p.terminate()
+                p.join()
+                result = {"job_id": job_id, "source": source_path, "status": STATUS_TIMEOUT,
+                          "error": f"timeout after {timeout}s",
+                          "runtime": round(time.time() - start_time, 3)}
+            else:
+                continue
+
+            del running[job_id]
+            # 子进程已退出（或被终止），此时合并日志并清理该论文的工作目录
+            # 之后 fork 的 worker 继承这些工具运行时长，用于计算超时
+            tool_runner.load_history(os.path.join(paper_log_dir(workdir), tool_runner.TOOL_LOG_NAME))
+            workdir_pool.release(workdir, on_tmpfs, log_path=log_path, keep=keep_temp)
+            if os.path.exists(workdir):
+                clean_tmp(workdir)
+            if latexml_service is not None and (result["status"] == STATUS_TIMEOUT or result.get("latexml_timeouts")):
+                # 被终止的 worker 或超时的转换可能让守护进程卡在该论文上，下一篇论文前重启
+                print(f"[INFO] restarting latexmls of worker {slot}")
+                latexml_service.stop(slot)
+            free_slots.append(slot)
+            # the archive is already gone if the first run cleaned up its temp files
+            if on_tmpfs and result.get("no_space") and os.path.exists(source_path):
+                print(f"[INFO] {source_path} ran out of space on tmpfs, retrying on disk")
+                retry.append((job_id, source_path))
+                continue
+            if manifest is not None:
+                manifest.record(
+                    source_path, result["status"], outputs=result.get("outputs"), md5=result.get("md5"),
+                    runtime=result["runtime"], error=result["error"]
+                )
+            mathml_hits += result.get("mathml_hits", 0)
+            mathml_misses += result.get("mathml_misses", 0)
+            if result["status"] == STATUS_OK:
+                processed += 1
+                print(f"[INFO] processed {source_path} in {result['runtime']}s, {processed} successfully")
+            else:
+                failed += 1
+                if result["status"] == STATUS_FAILED:
+                    print(f"[ERROR] processing {source_path} failed: {result['error']}")
+
+    if skipped:
+        print(f"[INFO] skipped {skipped} archives already completed in the manifest")
+    return {"processed": processed, "failed": failed, "skipped": skipped,
+            "mathml_hits": mathml_hits, "mathml_misses": mathml_misses}
 
 
 if __name__ == '__main__':
@@ -35,6 +302,41 @@ if __name__ == '__main__':
     parser.add_argument("-l", "--log", default='log', help="path to the log dir")
     parser.add_argument("-k", "--keep", default=True, help="keep temporary files")
     parser.add_argument("--timeout", type=int, default=600, help="per-file max seconds before skipping")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="number of archives processed in parallel")
+    parser.add_argument("-m", "--manifest", default=None,
+                        help="path to the completion manifest, default is <output>/manifest.jsonl")
+    parser.add_argument("--no_resume", action="store_true", help="do not skip archives completed in the manifest")
+    parser.add_argument("--grobid_cache", default=None,
+                        help="path to a sqlite file caching GROBID citation/author results across papers and workers")
+    parser.add_argument("--dpi", type=int, default=DEFAULT_DPI, help="DPI used to render PDF/EPS figures")
+    parser.add_argument("--figure_cache", default=None,
+                        help="path to a dir caching rendered PDF/EPS figures, keyed by content hash and DPI")
+    parser.add_argument("--figure_workers", type=int, default=0,
+                        help="processes per archive reading/rendering figures, 0 reads them inline")
+    parser.add_argument("--tmpfs", default=None,
+                        help="tmpfs root (e.g. /dev/shm) holding each paper's working tree, default uses the temp dir")
+    parser.add_argument("--tmpfs_budget", type=int, default=DEFAULT_TMPFS_BUDGET // (1024 * 1024),
+                        help="max estimated size in MB of one paper's working tree on tmpfs, larger papers use disk")
+    parser.add_argument("--extract_all", action="store_true",
+                        help="extract every archive member, not only LaTeX sources and referenced images")
+    parser.add_argument("--max_member_size", type=int, default=DEFAULT_MAX_MEMBER_SIZE // (1024 * 1024),
+                        help="skip archive members other than LaTeX sources above this size in MB, 0 for no cap")
+    parser.add_argument("--latexml_daemons", action="store_true",
+                        help="keep a warm latexmls daemon per worker instead of starting latexml for every paper")
+    parser.add_argument("--latexml_port", type=int, default=DEFAULT_BASE_PORT,
+                        help="port of the first latexmls daemon, worker i uses latexml_port + i")
+    parser.add_argument("--latexml_max_jobs", type=int, default=DEFAULT_MAX_JOBS,
+                        help="papers converted by one latexmls daemon before it is restarted")
+    parser.add_argument("--xml_engine", choices=XML_ENGINES, default=XML_ENGINE,
+                        help="engine converting the tralics xml, lxml collects everything in one traversal")
+    parser.add_argument("--html_tables_only", action="store_true",
+                        help="stream the LaTeXML html and minify/parse only its table figures")
+    parser.add_argument("--eager_latexml", action="store_true",
+                        help="run latexml for every paper, by default it is skipped when the tex has no table environment")
+    parser.add_argument("--mathml_cache", default=None,
+                        help="path to a sqlite file caching LaTeX to MathML conversions across papers and workers")
+    parser.add_argument("--no_mathml", action="store_true",
+                        help="leave MathML empty, the parquet rows only use the LaTeX of formulas")
 
     args = parser.parse_args()
 
@@ -46,7 +348,7 @@ if __name__ == '__main__':
     keep_temp = args.keep
 
     start_time = time.time()
-    
+
     input_path = Path(input_path)
     if input_path.suffix == '.txt':
         input_list = input_path.read_text().splitlines()
@@ -54,36 +356,45 @@ if __name__ == '__main__':
     else:
         input_list = [input_path]
 
-    failed = 0
-    processed = 0
-    
-    for source_path in input_list:
-        print(f"[INFO] start processing {source_path}")
-
-        os.makedirs(temp_path, exist_ok=True)
-        os.makedirs(output_path, exist_ok=True)  # noqa: F821
-        start_time = time.time()
-        try:
-            p = mp.Process(target=_process_one, args=(str(source_path), temp_path, output_path, split_size, log_path, keep_temp))
-            p.start()
-            p.join(args.timeout)
-            if p.is_alive():
-                print(f"[ERROR] processing {source_path} timeout after {args.timeout}s, skipping")
-                p.terminate()
-                p.join()
-                failed += 1
-                continue
-        except Exception as e:
-            # 捕获单个样本的异常，记录并继续
-            print(f"[ERROR] processing {source_path} failed: {e}")
-            failed += 1
-            continue
-        finally:
-            runtime = round(time.time() - start_time, 3)
-            clean_tmp()
-        print(f"[INFO] processed {processed} successfully")
-        processed += 1
+    manifest = None
+    if not args.no_resume:
+        manifest = CompletionManifest(args.manifest or os.path.join(output_path, 'manifest.jsonl'))
+        print(f"[INFO] manifest {manifest.manifest_file} has {len(manifest)} entries")
+
+    grobid_config = dict(DEFAULT_GROBID_CONFIG)
+    grobid_config["cache_path"] = args.grobid_cache
+
+    rasterizer = FigureRasterizer(args.dpi, args.figure_cache)
+    extraction_policy = ExtractionPolicy(
+        selective=not args.extract_all,
+        max_member_size=args.max_member_size * 1024 * 1024 if args.max_member_size > 0 else None
+    )
 
+    # workers are forked afterwards and inherit the converter
+    mathml_util.set_converter(MathmlConverter(cache_path=args.mathml_cache, enabled=not args.no_mathml))
 
-    
+    workdir_pool = WorkdirPool(temp_path, args.tmpfs, args.tmpfs_budget * 1024 * 1024)
+    latexml_service = None
+    if args.latexml_daemons:
+        os.makedirs(log_path, exist_ok=True)
+        latexml_service = LatexmlService(
+            args.latexml_port, args.latexml_max_jobs, log_file=os.path.join(log_path, 'latexmls.log')
+        )
+    try:
+        summary = process_source_list(
+            input_list, temp_path, output_path, split_size, log_path, keep_temp,
+            timeout=args.timeout, workers=args.workers, manifest=manifest, grobid_config=grobid_config,
+            rasterizer=rasterizer, figure_workers=args.figure_workers, extraction_policy=extraction_policy,
+            workdir_pool=workdir_pool, latexml_service=latexml_service, xml_engine=args.xml_engine,
+            html_tables_only=args.html_tables_only, lazy_latexml=not args.eager_latexml
+        )
+    finally:
+        workdir_pool.close()
+        if latexml_service is not None:
+            latexml_service.close()
 
+    runtime = round(time.time() - start_time, 3)
+    print(f"[INFO] {summary['processed']} processed, {summary['failed']} failed, {summary['skipped']} skipped")
+    if not args.no_mathml:
+        print(f"[INFO] mathml cache: {summary['mathml_hits']} hits, {summary['mathml_misses']} misses")
+    print("runtime: %s seconds " % (runtime))
@@ -4,14 +4,17 @@ import os
 import json
 import base64
 import shutil
-import subprocess
 import signal
 from pathlib import Path
 from typing import Optional, Dict
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..','..')))
-from doc2json.tex2json.tex_to_xml import convert_latex_to_s2orc_json
-from doc2json.tex2json.xml_to_json import convert_latex_xml_to_s2orc_json
+from doc2json.tex2json.tex_to_xml import convert_latex_to_s2orc_json, LAZY_LATEXML
+from doc2json.tex2json.extract_policy import ExtractionPolicy
+from doc2json.tex2json.xml_to_json import convert_latex_xml_to_s2orc_json, XML_ENGINE, HTML_TABLES_ONLY
 from doc2json.tex2json.arxiv_to_mm import *
+from doc2json.utils.image_util import read_image_bytes
+from doc2json.utils import tool_runner
+from doc2json.utils.tool_runner import run_tool
 
 import io
 from io import BytesIO
@@ -72,7 +75,12 @@ def process_tex_file(
         output_dir: str=BASE_OUTPUT_DIR,
         log_dir: str=BASE_LOG_DIR,
         keep_flag: bool=False,
-        grobid_config: Optional[Dict]=None
+        grobid_config: Optional[Dict]=None,
+        extraction_policy: Optional[ExtractionPolicy]=None,
+        latexml_port: Optional[int]=None,
+        xml_engine: str=XML_ENGINE,
+        html_tables_only: bool=HTML_TABLES_ONLY,
+        lazy_latexml: bool=LAZY_LATEXML
 ) -> (str, str):
     """
     Process files in a TEX zip and get JSON representation
@@ -82,12 +90,19 @@ def process_tex_file(
     :param log_dir:
     :param keep_flag:
     :param grobid_config:
+    :param extraction_policy: which archive members are extracted
+    :param latexml_port: port of a warm latexmls daemon, None runs latexml per paper
+    :param xml_engine: engine converting the tralics xml, see xml_to_json.XML_ENGINES
+    :param html_tables_only: parse only the table figures of the LaTeXML html
+    :param lazy_latexml: skip latexml for papers without table environments
     :return:
     """
     # create directories
     os.makedirs(temp_dir, exist_ok=True)
     os.makedirs(output_dir, exist_ok=True)
     os.makedirs(log_dir, exist_ok=True)
+    # 外部工具的运行时长与退出原因记录到 log_dir/tool_runs.jsonl
+    tool_runner.set_log_dir(log_dir)
 
     # get paper id as the name of the file
     paper_id = os.path.splitext(input_file)[0].split('/')[-1]
@@ -102,29 +117,24 @@ def process_tex_file(
         print(f'{output_file} already exists!')
 
     # process LaTeX
-    xml_file, html_file, main_tex_fn = convert_latex_to_s2orc_json(input_file, temp_dir, cleanup_flag)
+    xml_file, html_file, main_tex_fn = convert_latex_to_s2orc_json(
+        input_file, temp_dir, cleanup_flag, extraction_policy, latexml_port, lazy_latexml
+    )
     if not xml_file or not html_file or not main_tex_fn:
         return None, None
     # convert to S2ORC
-    paper = convert_latex_xml_to_s2orc_json(xml_file, html_file, temp_dir, log_dir, grobid_config=grobid_config)
+    paper = convert_latex_xml_to_s2orc_json(
+        xml_file, html_file, temp_dir, log_dir, grobid_config=grobid_config, engine=xml_engine,
+        html_tables_only=html_tables_only
+    )
     # write to file
     with open(output_file, 'w') as outf:
         json.dump(paper.release_json("latex"), outf, ensure_ascii=False, indent=4, sort_keys=False)
     return output_file, main_tex_fn
 
 def read_image(image_path):
-    # 打开图像文件
-    if image_path.lower().endswith('.pdf'):
-        images = convert_from_path(image_path)
-        new_image_path = os.path.splitext(image_path)[0] + ".png"
-        images[0].save(new_image_path, 'PNG')
-        image_path = new_image_path
-    with open(image_path, 'rb') as file:
-        image = Image.open(file)
-        # 将图像转换为二进制格式
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format=image.format)
-        img_byte_arr = img_byte_arr.getvalue()
+    # 打开图像文件，返回二进制格式
+    img_byte_arr, _ = read_image_bytes(image_path)
     return img_byte_arr
 
 def save_to_parquet(data, output_path):
@@ -205,18 +215,13 @@ def convert_to_target_format_cyp(data, template):
 
 
 def split_pdf_images(main_latex_file, md_data):
-    try:
-        cur_path = os.getcwd()
-        os.chdir(os.path.dirname(main_latex_file))
-        pdflatex_args = ['pdflatex',
-                         '-synctex=1',
-                         f'{os.path.basename(main_latex_file)}'
-                         ]
-        # 设置编译超时，避免卡死
-        subprocess.run(pdflatex_args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=180)
-        os.chdir(cur_path)
-    except subprocess.TimeoutExpired:
-        os.chdir(cur_path)
+    pdflatex_args = ['pdflatex',
+                     '-synctex=1',
+                     f'{os.path.basename(main_latex_file)}'
+                     ]
+    # 编译超时由 run_tool 按输入大小设置，避免卡死
+    if run_tool(pdflatex_args, input_path=os.path.basename(main_latex_file),
+                cwd=os.path.dirname(main_latex_file) or None).timed_out:
         # 回退：不抛异常，允许后续流程继续（例如跳过页面切分）
         return []
     pdf_path = main_latex_file.replace('.tex', '.pdf')
@@ -237,8 +242,9 @@ def timeout_handler(signum, frame):
     raise TimeoutError("Function execution timed out after 1 minute.")
 
 
-def clean_tmp():
-    directory = Path('./')
+def clean_tmp(directory: str):
+    # 只清理该论文工作目录下的 *.log（tralics 等工具的输出）
+    directory = Path(directory)
     for log_file in directory.rglob('*.log'):
         try:
             # 删除文件
@@ -281,7 +287,7 @@ if __name__ == '__main__':
     batchs = convert_to_rows(Path(output_file))
     batch_to_parquet(Path(parquet_out), split_size, batchs)
     runtime = round(time.time() - start_time, 3)
-    clean_tmp()
+    clean_tmp(temp_path)
     print("runtime: %s seconds " % (runtime))
     print('done.')
 
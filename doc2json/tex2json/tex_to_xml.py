@@ -5,7 +5,8 @@ Process all the files in a LaTeX zip file to extract paper content
 2. Identifies primary TEX file
 3. Expands other TEX files into main TEX file using latexpand
 4. Expands BBL file into main TEX file
-5. Convert TEX file into XML using tralics
+5. Convert TEX file into XML using tralics and into HTML using latexml, concurrently
+   (latexml only when the TEX file has table environments, its HTML is only used for tables)
 6. Extract content of XML into S2ORC JSON
 
 """
@@ -15,9 +16,16 @@ import gzip
 import tarfile
 import zipfile
 import shutil
-from typing import Optional
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
 
-from doc2json.utils.latex_util import normalize, latex_to_xml, latex_to_html
+from doc2json.utils.latex_util import normalize, latex_to_xml, latex_to_html, has_table_environment
+from doc2json.tex2json.extract_policy import ExtractionPolicy
+
+# 没有表格环境的论文不运行 latexml，以空白页面代替其输出
+LAZY_LATEXML = True
+EMPTY_HTML = '<html><body></body></html>\n'
 
 
 def _is_gzip_file(fpath):
@@ -25,14 +33,128 @@ def _is_gzip_file(fpath):
         return test_f.read(2) == b'\x1f\x8b'
 
 
-def extract_latex(zip_file: str, latex_dir: str, cleanup=True):
+def _is_tar_header(block: bytes) -> bool:
+    """
+    Check if the first block of a (decompressed) stream is a valid tar header
+    :param block:
+    :return:
+    """
+    if len(block) < tarfile.BLOCKSIZE:
+        return False
+    try:
+        tarfile.TarInfo.frombuf(block[:tarfile.BLOCKSIZE], tarfile.ENCODING, 'surrogateescape')
+        return True
+    except tarfile.HeaderError:
+        return False
+
+
+def _is_within_directory(directory, target):
+    abs_directory = os.path.abspath(directory)
+    abs_target = os.path.abspath(target)
+    return os.path.commonpath([abs_directory, abs_target]) == abs_directory
+
+
+def _stream_extract(fileobj, path: str,
+                    route: Optional[Callable[[tarfile.TarInfo], Optional[str]]] = None) -> List[str]:
+    """
+    Extract a tar stream member by member without seeking or buffering the archive
+    :param fileobj: tar stream, compressed tar streams (bz2, xz, ...) are detected
+    :param path: output directory
+    :param route: directory a file member is written to, None skips it; default writes every file to path
+    :return: paths of the written files
+    """
+    extracted = []
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+        for member in tar:
+            member_path = os.path.join(path, member.name)
+            if not _is_within_directory(path, member_path):
+                raise Exception("Attempted Path Traversal in Tar File")
+            if member.isdir():
+                os.makedirs(member_path, exist_ok=True)
+            elif member.isfile():
+                out_dir = route(member) if route is not None else path
+                if out_dir is None:
+                    continue
+                member_path = os.path.join(out_dir, member.name)
+                os.makedirs(os.path.dirname(member_path), exist_ok=True)
+                with tar.extractfile(member) as in_f, open(member_path, 'wb') as out_f:
+                    shutil.copyfileobj(in_f, out_f)
+                extracted.append(member_path)
+            # links and device files are skipped, they can point outside of the directory
+    return extracted
+
+
+def _extract_tar(fileobj, path: str, policy: ExtractionPolicy):
+    """
+    Extract LaTeX sources, small files and the images they reference in one pass over the archive
+    Images are staged next to the output directory until the sources have been scanned for references
+    :param fileobj: tar stream
+    :param path: output directory
+    :param policy:
+    :return:
+    """
+    # 与输出目录在同一文件系统上，被引用的图片只需 rename
+    staging_dir = tempfile.mkdtemp(prefix='.images_', dir=os.path.dirname(os.path.abspath(path)))
+
+    def route(member: tarfile.TarInfo) -> Optional[str]:
+        if policy.extract_first(member.name, member.size):
+            return path
+        if policy.is_image(member.name) and \
+                (policy.max_member_size is None or member.size <= policy.max_member_size):
+            return staging_dir
+        return None
+
+    try:
+        extracted = _stream_extract(fileobj, path, route)
+        staged = [f for f in extracted if _is_within_directory(staging_dir, f)]
+        if not staged:
+            return
+        references = policy.collect_references([f for f in extracted if f not in staged])
+        for staged_file in staged:
+            name = os.path.relpath(staged_file, staging_dir)
+            if policy.is_referenced(name, os.path.getsize(staged_file), references):
+                member_path = os.path.join(path, name)
+                os.makedirs(os.path.dirname(member_path), exist_ok=True)
+                os.replace(staged_file, member_path)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def _extract_zip(zip_file: str, path: str, policy: ExtractionPolicy):
+    """
+    Zip counterpart of _extract_tar
+    :param zip_file:
+    :param path:
+    :param policy:
+    :return:
+    """
+    with zipfile.ZipFile(zip_file, 'r') as in_f:
+        members = [m for m in in_f.infolist() if not m.is_dir()]
+        extracted = []
+        images = []
+        for member in members:
+            if policy.extract_first(member.filename, member.file_size):
+                extracted.append(in_f.extract(member, path))
+            elif policy.is_image(member.filename):
+                images.append(member)
+        if images:
+            references = policy.collect_references(extracted)
+            for member in images:
+                if policy.is_referenced(member.filename, member.file_size, references):
+                    in_f.extract(member, path)
+
+
+def extract_latex(zip_file: str, latex_dir: str, cleanup=True, policy: Optional[ExtractionPolicy]=None):
     """
     Unzip latex zip into temp directory
+    gzip archives are decompressed and untarred in a single streaming pass
     :param zip_file:
     :param latex_dir:
     :param cleanup:
+    :param policy: which members are extracted, default skips unreferenced images and huge files
     :return:
     """
+    policy = policy or ExtractionPolicy()
     assert os.path.exists(zip_file)
     # assert zip_file.endswith('.gz') or zip_file.endswith('.zip') or zip_file.endswith('.tar') or zip_file.endswith('.tar.gz')
     assert zip_file.endswith('.tar.gz') or zip_file.endswith('.tar') or zip_file.endswith('.gz') or zip_file.endswith('.zip') or zip_file.endswith('.tex')
@@ -40,71 +162,27 @@ def extract_latex(zip_file: str, latex_dir: str, cleanup=True):
     # get name of zip file
     file_id = os.path.splitext(zip_file)[0].split('/')[-1]
 
-    # check if tar file -> untar
     tar_dir = os.path.join(latex_dir, file_id)
     os.makedirs(tar_dir, exist_ok=True)
-    if tarfile.is_tarfile(zip_file):
-        with tarfile.open(zip_file) as tar:
-            def is_within_directory(directory, target):
-                
-                abs_directory = os.path.abspath(directory)
-                abs_target = os.path.abspath(target)
-            
-                prefix = os.path.commonprefix([abs_directory, abs_target])
-                
-                return prefix == abs_directory
-            
-            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-            
-                for member in tar.getmembers():
-                    member_path = os.path.join(path, member.name)
-                    if not is_within_directory(path, member_path):
-                        raise Exception("Attempted Path Traversal in Tar File")
-            
-                tar.extractall(path, members, numeric_owner=numeric_owner) 
-                
-            
-            safe_extract(tar, tar_dir)
-    # check if gzip file -> un-gz and/or untar
-    elif _is_gzip_file(zip_file):
-        tar_file = os.path.join(latex_dir, f'{file_id}.tar')
-        with gzip.open(zip_file, 'rb') as in_f, open(tar_file, 'wb') as out_f:
-            s = in_f.read()
-            out_f.write(s)
-        if os.path.exists(tar_file):
-            # check if tarfile
-            if tarfile.is_tarfile(tar_file):
-                with tarfile.open(tar_file) as tar:
-                    def is_within_directory(directory, target):
-                        
-                        abs_directory = os.path.abspath(directory)
-                        abs_target = os.path.abspath(target)
-                    
-                        prefix = os.path.commonprefix([abs_directory, abs_target])
-                        
-                        return prefix == abs_directory
-                    
-                    def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-                    
-                        for member in tar.getmembers():
-                            member_path = os.path.join(path, member.name)
-                            if not is_within_directory(path, member_path):
-                                raise Exception("Attempted Path Traversal in Tar File")
-                    
-                        tar.extractall(path, members, numeric_owner=numeric_owner) 
-                        
-                    
-                    safe_extract(tar, tar_dir)
-                os.remove(tar_file)
-            # else, copy to tex file
-            else: # old tex file could be ps file
-                tex_file = os.path.join(latex_dir, file_id, f'{file_id}.tex')
-                os.makedirs(tar_dir, exist_ok=True)
-                os.rename(tar_file, tex_file)
+    # check if gzip file -> untar, or a single gzipped tex file
+    if _is_gzip_file(zip_file):
+        with gzip.open(zip_file, 'rb') as in_f:
+            is_tar = _is_tar_header(in_f.read(tarfile.BLOCKSIZE))
+        if is_tar:
+            with gzip.open(zip_file, 'rb') as in_f:
+                _extract_tar(in_f, tar_dir, policy)
+        # else, copy to tex file
+        else: # old tex file could be ps file
+            tex_file = os.path.join(tar_dir, f'{file_id}.tex')
+            with gzip.open(zip_file, 'rb') as in_f, open(tex_file, 'wb') as out_f:
+                shutil.copyfileobj(in_f, out_f)
+    # check if tar file -> untar
+    elif tarfile.is_tarfile(zip_file):
+        with open(zip_file, 'rb') as in_f:
+            _extract_tar(in_f, tar_dir, policy)
     # check if zip file -> unzip
     elif zipfile.is_zipfile(zip_file):
-        with zipfile.ZipFile(zip_file, 'r') as in_f:
-            in_f.extractall(tar_dir)
+        _extract_zip(zip_file, tar_dir, policy)
     elif zip_file.endswith('.tex'):
         tex_file = os.path.join(latex_dir, file_id, f'{file_id}.tex')
         os.makedirs(tar_dir, exist_ok=True)
@@ -183,7 +261,9 @@ def norm_latex_to_xml(norm_dir: str, xml_dir: str, xml_err_file: str, xml_log_fi
 
 
 def convert_latex_to_xml(
-        zip_file: str, latex_dir: str, norm_dir: str, xml_dir: str, html_dir: str, log_dir: str, cleanup=True
+        zip_file: str, latex_dir: str, norm_dir: str, xml_dir: str, html_dir: str, log_dir: str, cleanup=True,
+        extraction_policy: Optional[ExtractionPolicy]=None, latexml_port: Optional[int]=None,
+        lazy_latexml: bool=LAZY_LATEXML
 ) -> (str, str, str):
     """
     Run expansion, normalization, xml conversion on latex
@@ -193,13 +273,16 @@ def convert_latex_to_xml(
     :param xml_dir:
     :param log_dir:
     :param cleanup:
+    :param extraction_policy:
+    :param latexml_port: port of a warm latexmls daemon, None runs latexml per paper
+    :param lazy_latexml: skip latexml when the normalized tex has no table environment
     :return:
     """
     # extract zip file
-    latex_output_dir = extract_latex(zip_file, latex_dir, cleanup)
-    # normalize latex
+    latex_output_dir = extract_latex(zip_file, latex_dir, cleanup, extraction_policy)
+    # normalize latex, latexml still reads the main tex from the latex directory
     norm_log_file = os.path.join(log_dir, 'norm_error.log')
-    norm_output_dir, main_tex_fn = normalize_latex(latex_output_dir, norm_dir, norm_log_file, cleanup)
+    norm_output_dir, main_tex_fn = normalize_latex(latex_output_dir, norm_dir, norm_log_file, cleanup=False)
 
     # convert to xml
     xml_error_file = os.path.join(log_dir, 'xml_error.log')
@@ -207,32 +290,75 @@ def convert_latex_to_xml(
 
     html_error_file = os.path.join(log_dir, 'html_error.log')
     html_log_file = os.path.join(log_dir, 'html_skip.log')
-    xml_output_file = norm_latex_to_xml(norm_output_dir, xml_dir, xml_error_file, xml_log_file, cleanup)
+    # tralics 结束后会删除 norm 目录，先检查表格环境
+    run_latexml = main_tex_fn is not None
+    if run_latexml and lazy_latexml:
+        norm_tex_file = os.path.join(norm_output_dir, os.path.basename(norm_output_dir) + '.tex')
+        run_latexml = has_table_environment(norm_tex_file)
+    # tralics 与 latexml 只读取各自的输入，两者都在子进程中运行，可以同时进行
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        xml_future = executor.submit(
+            norm_latex_to_xml, norm_output_dir, xml_dir, xml_error_file, xml_log_file, cleanup
+        )
+        html_future = None
+        if run_latexml:
+            html_future = executor.submit(
+                norm_latex_to_html, main_tex_fn, html_dir, html_error_file, html_log_file, latexml_port
+            )
+        xml_output_file = xml_future.result()
+        if html_future is not None:
+            html_output_file = html_future.result()
+        elif main_tex_fn is not None:
+            html_output_file = write_empty_html(main_tex_fn, html_dir)
+        else:
+            html_output_file = None
+
+    # delete latex directory if cleanup
+    if cleanup:
+        shutil.rmtree(latex_output_dir)
     if xml_output_file is None:
         return None, None, None
-    html_output_file = norm_latex_to_html(main_tex_fn, html_dir, html_error_file, html_log_file)
     return xml_output_file, html_output_file, main_tex_fn
 
-def norm_latex_to_html(main_tex_file: str, html_dir: str, html_err_file: str, html_log_file: str) -> Optional[str]:
+def _latexml_html_file(main_tex_file: str, html_dir: str) -> str:
+    file_id = main_tex_file.strip('/').split('/')[-2]
+    html_output_dir = os.path.join(html_dir, file_id)
+    os.makedirs(html_output_dir, exist_ok=True)
+    return os.path.join(html_output_dir, f'{file_id}_latexml.html')
+
+
+def write_empty_html(main_tex_file: str, html_dir: str) -> str:
     """
-    Convert LaTeX to XML using tralics
-    :param norm_dir:
-    :param xml_dir:
-    :param xml_err_file:
-    :param xml_log_file:
-    :param cleanup:
+    Write an html page without tables where latexml would have written its output
+    :param main_tex_file:
+    :param html_dir:
+    :return:
+    """
+    html_file = _latexml_html_file(main_tex_file, html_dir)
+    with open(html_file, 'w', encoding='utf-8') as f:
+        f.write(EMPTY_HTML)
+    return html_file
+
+
+def norm_latex_to_html(main_tex_file: str, html_dir: str, html_err_file: str, html_log_file: str,
+                       latexml_port: Optional[int]=None) -> Optional[str]:
+    """
+    Convert LaTeX to HTML using latexml
+    :param main_tex_file:
+    :param html_dir:
+    :param html_err_file:
+    :param html_log_file:
+    :param latexml_port: port of a warm latexmls daemon, None runs latexml per paper
     :return:
     """
-    file_id = main_tex_file.strip('/').split('/')[-2]
     norm_tex_file = main_tex_file
-    html_output_dir = os.path.join(html_dir, file_id)
-    html_file = os.path.join(html_output_dir, f'{file_id}_latexml.html')
-    os.makedirs(html_output_dir, exist_ok=True)
+    html_file = _latexml_html_file(main_tex_file, html_dir)
     latex_to_html(
         tex_file=norm_tex_file,
         out_file=html_file,
         err_file=html_err_file,
-        log_file=html_log_file
+        log_file=html_log_file,
+        latexml_port=latexml_port
     )
     if os.path.exists(html_file):
         return html_file
@@ -241,13 +367,19 @@ def norm_latex_to_html(main_tex_file: str, html_dir: str, html_err_file: str, ht
 def convert_latex_to_s2orc_json(
         latex_zip: str,
         base_temp_dir: str,
-        cleanup_after: bool=True
+        cleanup_after: bool=True,
+        extraction_policy: Optional[ExtractionPolicy]=None,
+        latexml_port: Optional[int]=None,
+        lazy_latexml: bool=LAZY_LATEXML
 ) -> (str, str, str):
     """
     Convert a LaTeX zip file to S2ORC JSON
     :param latex_zip:
     :param base_temp_dir:
     :param cleanup_after:
+    :param extraction_policy:
+    :param latexml_port: port of a warm latexmls daemon, None runs latexml per paper
+    :param lazy_latexml: skip latexml when the normalized tex has no table environment
     :return:
     """
     if not os.path.exists(latex_zip):
@@ -267,6 +399,7 @@ def convert_latex_to_s2orc_json(
     os.makedirs(latex_log_dir, exist_ok=True)
     # convert to XML
     xml_file, html_file, main_tex_fn = convert_latex_to_xml(
-        latex_zip, latex_expand_dir, latex_norm_dir, latex_xml_dir, latex_html_dir, latex_log_dir, cleanup_after
+        latex_zip, latex_expand_dir, latex_norm_dir, latex_xml_dir, latex_html_dir, latex_log_dir, cleanup_after,
+        extraction_policy, latexml_port, lazy_latexml
     )
     return xml_file, html_file, main_tex_fn
@@ -0,0 +1,176 @@
+"""
+Working directories of the LaTeX pipeline
+
+Every stage of process_tex_file (latex/, norm/, xml/, html/, log/) round-trips
+through the filesystem. Each paper gets its own working tree under a per-worker
+directory, worker_<slot>/<paper_id>, so concurrent workers never share files.
+With a tmpfs root (e.g. /dev/shm) the tree is kept in memory as long as its
+estimated size fits the budget; other papers use the temp dir on disk.
+The pool is owned by the parent process: it merges the paper's logs into the
+shared log dir and removes the tree once the worker is gone, even when the
+worker was killed by the per-file timeout.
+"""
+import os
+import shutil
+import struct
+import tempfile
+from typing import Optional, Tuple
+
+DEFAULT_TMPFS_ROOT = '/dev/shm'
+DEFAULT_TMPFS_BUDGET = 1024 * 1024 * 1024
+# 解压后的源文件、规范化 tex、xml、html 相对源文件大小的估计倍数
+EXPANSION_FACTOR = 3
+# 论文失败后工作目录所在文件系统的剩余空间低于该值时，视为空间不足
+NO_SPACE_MARGIN = 4 * 1024 * 1024
+NO_SPACE_MESSAGES = (b'No space left on device', b'Disk quota exceeded')
+
+
+def uncompressed_size(source_path: str) -> int:
+    """
+    Estimate the extracted size of a source archive without decompressing it
+    gzip files store the uncompressed size (mod 2**32) in their last 4 bytes
+    :param source_path:
+    :return:
+    """
+    size = os.path.getsize(source_path)
+    with open(source_path, 'rb') as f:
+        if f.read(2) != b'\x1f\x8b' or size < 18:
+            return size
+        f.seek(-4, os.SEEK_END)
+        isize = struct.unpack('<I', f.read(4))[0]
+    # ISIZE 只保存低 32 位，解压后不会比压缩文件更小
+    while isize < size:
+        isize += 1 << 32
+    return isize
+
+
+def paper_log_dir(workdir: str) -> str:
+    """
+    Log dir of one paper, the worker writes here instead of the shared log dir
+    :param workdir:
+    :return:
+    """
+    return os.path.join(workdir, 'log')
+
+
+def ran_out_of_space(workdir: str, min_free: int = NO_SPACE_MARGIN) -> bool:
+    """
+    Whether a failed paper ran out of space, also when an external tool hit it and only reported an error
+    Checks the free space left next to the working tree and the paper's tool logs
+    :param workdir:
+    :param min_free: bytes under which the file system counts as full
+    :return:
+    """
+    try:
+        if shutil.disk_usage(workdir).free < min_free:
+            return True
+    except OSError:
+        pass
+    log_dir = paper_log_dir(workdir)
+    if not os.path.isdir(log_dir):
+        return False
+    for fname in os.listdir(log_dir):
+        try:
+            with open(os.path.join(log_dir, fname), 'rb') as f:
+                content = f.read()
+        except OSError:
+            continue
+        if any(message in content for message in NO_SPACE_MESSAGES):
+            return True
+    return False
+
+
+def merge_logs(src_dir: str, dst_dir: str):
+    """
+    Append every log file of src_dir to the file with the same name in dst_dir and remove it
+    Only the parent process merges, so the shared files have a single writer
+    :param src_dir:
+    :param dst_dir:
+    :return:
+    """
+    if not os.path.isdir(src_dir):
+        return
+    os.makedirs(dst_dir, exist_ok=True)
+    for fname in sorted(os.listdir(src_dir)):
+        src_file = os.path.join(src_dir, fname)
+        if not os.path.isfile(src_file):
+            continue
+        with open(src_file, 'rb') as in_f, open(os.path.join(dst_dir, fname), 'ab') as out_f:
+            shutil.copyfileobj(in_f, out_f)
+        os.remove(src_file)
+
+
+class WorkdirPool:
+    """
+    Hand out a working directory per paper, in memory when it fits the budget
+    """
+
+    def __init__(self, temp_path: str, tmpfs_root: Optional[str] = None,
+                 tmpfs_budget: int = DEFAULT_TMPFS_BUDGET):
+        """
+        :param temp_path: temp dir on disk, used when tmpfs is disabled or the paper is too large
+        :param tmpfs_root: tmpfs mount point, None to always use temp_path
+        :param tmpfs_budget: max estimated size in bytes of one paper's working tree on tmpfs
+        """
+        self.temp_path = temp_path
+        self.tmpfs_budget = tmpfs_budget
+        self.tmpfs_dir = None
+        self._reserved = dict()     # workdir -> reserved bytes
+        if tmpfs_root:
+            # 每次运行使用独立的目录，多个进程共用同一个 tmpfs 时互不影响
+            self.tmpfs_dir = tempfile.mkdtemp(prefix='arxiv_mm_', dir=tmpfs_root)
+
+    def _fits_tmpfs(self, source_path: str) -> int:
+        """
+        Estimated size of the paper's working tree if it fits on tmpfs, else 0
+        :param source_path:
+        :return:
+        """
+        try:
+            need = uncompressed_size(source_path) * EXPANSION_FACTOR
+        except OSError:
+            # 由 worker 报告文件错误
+            return 0
+        free = shutil.disk_usage(self.tmpfs_dir).free - sum(self._reserved.values())
+        if need > self.tmpfs_budget or need > free:
+            return 0
+        return max(need, 1)
+
+    def allocate(self, source_path: str, slot: int, on_disk: bool = False) -> Tuple[str, bool]:
+        """
+        Create the working directory of one paper
+        :param source_path: source archive of the paper
+        :param slot: index of the worker running the paper
+        :param on_disk: skip tmpfs, e.g. when a run on tmpfs ran out of space
+        :return: working directory and whether it is on tmpfs
+        """
+        paper_id = os.path.splitext(source_path)[0].split('/')[-1]
+        need = 0
+        if self.tmpfs_dir is not None and not on_disk:
+            need = self._fits_tmpfs(source_path)
+        root = self.tmpfs_dir if need else self.temp_path
+        workdir = os.path.join(root, f'worker_{slot}', paper_id)
+        os.makedirs(workdir, exist_ok=True)
+        if need:
+            self._reserved[workdir] = need
+        return workdir, bool(need)
+
+    def release(self, workdir: str, on_tmpfs: bool, log_path: Optional[str] = None, keep: bool = False):
+        """
+        Merge a paper's logs into log_path and remove its working tree, called by the parent once the worker is gone
+        :param workdir:
+        :param on_tmpfs:
+        :param log_path: shared log dir, see paper_log_dir
+        :param keep: keep the working tree on disk, trees on tmpfs are always removed
+        :return:
+        """
+        if log_path:
+            merge_logs(paper_log_dir(workdir), log_path)
+        if on_tmpfs or not keep:
+            self._reserved.pop(workdir, None)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def close(self):
+        if self.tmpfs_dir is not None:
+            shutil.rmtree(self.tmpfs_dir, ignore_errors=True)
+            self.tmpfs_dir = None
@@ -10,13 +10,15 @@ from bs4 import BeautifulSoup, NavigableString
 from typing import List, Dict, Tuple, Optional
 import copy
 import soupsieve as sv
-import latex2mathml.converter
+from lxml import etree
 from PIL import Image as PILImage
 from loguru import logger
 from pathlib import Path
 
 from doc2json.grobid2json.grobid.grobid_client import GrobidClient
 from doc2json.utils.grobid_util import parse_bib_entry, get_author_data_from_grobid_xml
+from doc2json.utils.image_util import read_image_bytes
+from doc2json.utils.mathml_util import latex_to_mathml
 from doc2json.s2orc import Paper, Paragraph
 
 
@@ -33,6 +35,17 @@ TEXT_TAGS = {
     'caption'
 }
 
+# <ref target="uidN"> 依次尝试的 ref id 前缀
+UID_REF_PREFIXES = ('FIGREF', 'TABREF', 'EQREF', 'FOOTREF', 'SECREFU')
+
+# xml 解析引擎：bs4 逐步 find_all；lxml 一次遍历收集各类元素（见 xml_to_json_lxml）
+XML_ENGINES = ('bs4', 'lxml')
+XML_ENGINE = 'bs4'
+# 只从 LaTeXML html 中取出表格（figure.ltx_table）再压缩、解析，其余内容不会被用到
+HTML_TABLES_ONLY = False
+# 流式读取 html 的块大小
+HTML_READ_SIZE = 1024 * 1024
+
 
 def normalize_latex_id(latex_id: str):
     str_norm = latex_id.upper().replace('_', '')
@@ -58,10 +71,16 @@ def process_author(
     :return:
     """
     if author_text:
+        if grobid_client.cache is not None:
+            author_entry = grobid_client.cache.get('header_names', author_text)
+            if author_entry is not None:
+                return author_entry
         author_xml_str = grobid_client.process_header_names(author_text, logfile)
         if author_xml_str:
             author_soup = BeautifulSoup(author_xml_str, 'xml')
             author_entry = get_author_data_from_grobid_xml(author_soup)
+            if grobid_client.cache is not None:
+                grobid_client.cache.put('header_names', author_text, author_entry)
             return author_entry
 
     return [{
@@ -74,6 +93,32 @@ def process_author(
     }]
 
 
+def normalize_bib_text(bib_text: str) -> str:
+    """
+    Collapse the lines of one bib entry into the string sent to GROBID
+    :param bib_text:
+    :return:
+    """
+    bib_lines = bib_text.split('\n')
+    bib_lines = [re.sub(r'\s+', ' ', line) for line in bib_lines]
+    bib_lines = [re.sub(r'\s', ' ', line).strip() for line in bib_lines]
+    return ' '.join(bib_lines)
+
+
+def parse_bibentry_xml(xml_str: str, bib_string: str) -> Dict:
+    """
+    Parse the GROBID xml of one citation into a bib entry
+    :param xml_str:
+    :param bib_string:
+    :return:
+    """
+    soup = BeautifulSoup(xml_str, 'lxml')
+    bib_entry = parse_bib_entry(soup)
+    if not bib_entry['raw_text']:
+        bib_entry['raw_text'] = bib_string
+    return bib_entry
+
+
 def process_bibentry(bib_text: str, grobid_client: GrobidClient, logfile: str):
     """
     Process one bib entry text into title, authors, etc
@@ -84,20 +129,121 @@ def process_bibentry(bib_text: str, grobid_client: GrobidClient, logfile: str):
     """
     if not bib_text:
         return None
-    bib_lines = bib_text.split('\n')
-    bib_lines = [re.sub(r'\s+', ' ', line) for line in bib_lines]
-    bib_lines = [re.sub(r'\s', ' ', line).strip() for line in bib_lines]
-    bib_string = ' '.join(bib_lines)
+    bib_string = normalize_bib_text(bib_text)
+    if grobid_client.cache is not None:
+        bib_entry = grobid_client.cache.get('citation', bib_string)
+        if bib_entry is not None:
+            return bib_entry
     xml_str = grobid_client.process_citation(bib_string, logfile)
     if xml_str:
-        soup = BeautifulSoup(xml_str, 'lxml')
-        bib_entry = parse_bib_entry(soup)
-        if not bib_entry['raw_text']:
-            bib_entry['raw_text'] = bib_string
+        bib_entry = parse_bibentry_xml(xml_str, bib_string)
+        # cache before urls, ref_id and num are filled in by the caller
+        if grobid_client.cache is not None:
+            grobid_client.cache.put('citation', bib_string, bib_entry)
         return bib_entry
     return None
 
 
+def process_bibentries(bib_texts: List[str], grobid_client: GrobidClient, logfile: str) -> List[Optional[Dict]]:
+    """
+    Process all bib entry texts of a paper, cached entries first and the rest in one batched GROBID call
+    :param bib_texts:
+    :param grobid_client:
+    :param logfile:
+    :return: bib entries aligned with bib_texts, None where processing failed
+    """
+    bib_strings = [normalize_bib_text(bib_text) if bib_text else None for bib_text in bib_texts]
+
+    # resolve every distinct string once
+    resolved = dict()
+    to_request = []
+    for bib_string in bib_strings:
+        if not bib_string or bib_string in resolved:
+            continue
+        resolved[bib_string] = None
+        if grobid_client.cache is not None:
+            resolved[bib_string] = grobid_client.cache.get('citation', bib_string)
+        if resolved[bib_string] is None:
+            to_request.append(bib_string)
+
+    if to_request:
+        xml_strs = grobid_client.process_citation_list(to_request, logfile)
+        for bib_string, xml_str in zip(to_request, xml_strs):
+            if xml_str:
+                try:
+                    bib_entry = parse_bibentry_xml(xml_str, bib_string)
+                except (AttributeError, TypeError):
+                    print('Error parsing bib entry!', bib_string)
+                    continue
+                if grobid_client.cache is not None:
+                    grobid_client.cache.put('citation', bib_string, bib_entry)
+                resolved[bib_string] = bib_entry
+
+    # copy so that callers can fill in urls, ref_id and num per entry
+    return [copy.deepcopy(resolved[bib_string]) if bib_string else None for bib_string in bib_strings]
+
+
+class RefMap(dict):
+    """
+    ref id -> ref entry, with the index from <ref> targets like uid12 to ref ids built by combine_ref_maps
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.uid_index = dict()
+
+
+def build_uid_index(ref_map: Dict) -> Dict[str, str]:
+    """
+    Map uid targets to the ref id they resolve to, the first prefix of UID_REF_PREFIXES with an entry wins
+    :param ref_map:
+    :return:
+    """
+    uid_index = dict()
+    for prefix in UID_REF_PREFIXES:
+        for ref_id in ref_map:
+            if ref_id.startswith(prefix):
+                target = 'uid' + ref_id[len(prefix):]
+                if target.replace('uid', prefix) == ref_id:
+                    uid_index.setdefault(target, ref_id)
+    return uid_index
+
+
+# 调用方传入普通 dict 时，缓存最近一个 ref map 的索引；保留其引用，id 不会被其他 dict 复用
+_last_uid_index = (None, None)
+
+
+def get_uid_index(ref_map: Dict) -> Dict[str, str]:
+    """
+    uid index of a ref map, built once per paper; the keys of a ref map are complete before references are replaced
+    :param ref_map: RefMap from combine_ref_maps, or a plain dict
+    :return:
+    """
+    global _last_uid_index
+    if isinstance(ref_map, RefMap):
+        return ref_map.uid_index
+    last_ref_map, uid_index = _last_uid_index
+    if last_ref_map is not ref_map:
+        uid_index = build_uid_index(ref_map)
+        _last_uid_index = (ref_map, uid_index)
+    return uid_index
+
+
+def normalize_ref_target(target: str, uid_index: Dict[str, str]) -> str:
+    """
+    Ref id token of a non citation <ref> target
+    :param target:
+    :param uid_index: see build_uid_index
+    :return:
+    """
+    if target.startswith('cid'):
+        return target.replace('cid', 'SECREF')
+    elif target.startswith('uid'):
+        return uid_index.get(target) or target.upper()
+    print('Weird ID!')
+    return target.upper()
+
+
 def replace_ref_tokens(sp: BeautifulSoup, el: bs4.element.Tag, ref_map: Dict):
     """
     Replace all references in element with special tokens
@@ -116,27 +262,12 @@ def replace_ref_tokens(sp: BeautifulSoup, el: bs4.element.Tag, ref_map: Dict):
             continue
 
     # replace all non citation references
+    uid_index = get_uid_index(ref_map)
     for rtag in el.find_all('ref'):
         try:
-            if rtag.get('target') and not rtag.get('target').startswith('bid'):
-                if rtag.get('target').startswith('cid'):
-                    target = rtag.get('target').replace('cid', 'SECREF')
-                elif rtag.get('target').startswith('uid'):
-                    if rtag.get('target').replace('uid', 'FIGREF') in ref_map:
-                        target = rtag.get('target').replace('uid', 'FIGREF')
-                    elif rtag.get('target').replace('uid', 'TABREF') in ref_map:
-                        target = rtag.get('target').replace('uid', 'TABREF')
-                    elif rtag.get('target').replace('uid', 'EQREF') in ref_map:
-                        target = rtag.get('target').replace('uid', 'EQREF')
-                    elif rtag.get('target').replace('uid', 'FOOTREF') in ref_map:
-                        target = rtag.get('target').replace('uid', 'FOOTREF')
-                    elif rtag.get('target').replace('uid', 'SECREFU') in ref_map:
-                        target = rtag.get('target').replace('uid', 'SECREFU')
-                    else:
-                        target = rtag.get('target').upper()
-                else:
-                    print('Weird ID!')
-                    target = rtag.get('target').upper()
+            target = rtag.get('target')
+            if target and not target.startswith('bid'):
+                target = normalize_ref_target(target, uid_index)
                 rtag.replace_with(sp.new_string(f" {target} "))
         except AttributeError:
             print('Attribute error: ', rtag)
@@ -290,7 +421,7 @@ def process_paragraph(sp: BeautifulSoup, para_el: bs4.element.Tag, section_info:
                 ref_id = None
                 inline_key_ind += 1
             try:
-                formula_mathml = latex2mathml.converter.convert(ftag.texmath.text)
+                formula_mathml = latex_to_mathml(ftag.texmath.text)
             except Exception:
                 formula_mathml = ""
             formula_dict[formula_key] = (ftag.math.text, ftag.texmath.text, formula_mathml, ref_id)
@@ -475,10 +606,12 @@ def process_bibliography_from_tex(sp: BeautifulSoup, client, log_file) -> Dict:
     :return:
     """
     bibkey_map = dict()
+    # (bib key, bib text, fields added to the processed entry) in document order
+    bib_items_to_process = []
     # replace Bibliography with bibliography if needed
     for bibl in sp.find_all("Bibliography"):
         bibl.name = 'bibliography'
-    # construct bib map
+    # collect bib entry texts
     for bibliography in sp.find_all('bibliography'):
         bib_items = bibliography.find_all('bibitem')
         # map all bib entries
@@ -487,28 +620,25 @@ def process_bibliography_from_tex(sp: BeautifulSoup, client, log_file) -> Dict:
                 try:
                     if not bi.get('id'):
                         continue
-                    # get bib entry text and process it
+                    # get bib entry text
                     bib_par = bi.find_parent('p')
                     if bib_par.text:
-                        bib_entry = process_bibentry(bib_par.text, client, log_file)
+                        bib_text = bib_par.text
                     else:
                         next_tag = bib_par.findNext('p')
                         if not next_tag.find('bibitem') and next_tag.text:
-                            bib_entry = process_bibentry(next_tag.text, client, log_file)
+                            bib_text = next_tag.text
                         else:
-                            bib_entry = None
-                    # if processed successfully, add to map
-                    if bib_entry:
-                        # get URLs from bib entry
-                        urls = []
-                        for xref in bib_par.find_all('xref'):
-                            urls.append(xref.get('url'))
-                        bib_entry['urls'] = urls
-                        # map to ref id
-                        ref_id = normalize_latex_id(bi.get('id'))
-                        bib_entry['ref_id'] = ref_id
-                        bib_entry['num'] = bi_num
-                        bibkey_map[ref_id] = bib_entry
+                            bib_text = None
+                    if not bib_text:
+                        continue
+                    # get URLs from bib entry
+                    urls = []
+                    for xref in bib_par.find_all('xref'):
+                        urls.append(xref.get('url'))
+                    # map to ref id
+                    ref_id = normalize_latex_id(bi.get('id'))
+                    bib_items_to_process.append((ref_id, bib_text, {'urls': urls, 'ref_id': ref_id, 'num': bi_num}))
                 except AttributeError:
                     print('Attribute error in bib item!', bi)
                     continue
@@ -518,35 +648,42 @@ def process_bibliography_from_tex(sp: BeautifulSoup, client, log_file) -> Dict:
         else:
             for bi_num, p in enumerate(sp.bibliography.find_all('p')):
                 try:
-                    bib_key, bib_entry = None, None
+                    bib_key, bib_text = None, None
                     bib_text = p.text
                     bib_name = re.match(r'\[(.*?)\](.*)', bib_text)
                     if bib_name:
                         bib_text = re.sub(r'\s', ' ', bib_text)
                         bib_name = re.match(r'\[(.*?)\](.*)', bib_text)
+                        bib_text = None
                         if bib_name:
                             bib_key = bib_name.group(1)
-                            bib_entry = process_bibentry(bib_name.group(2), client, log_file)
+                            bib_text = bib_name.group(2)
                     else:
                         bib_lines = bib_text.split('\n')
                         bib_key = re.sub(r'\s', ' ', bib_lines[0])
                         bib_text = re.sub(r'\s', ' ', ' '.join(bib_lines[1:]))
-                        bib_entry = process_bibentry(bib_text, client, log_file)
-                    if bib_key and bib_entry:
+                    if bib_key and bib_text:
                         # get URLs from bib entry
                         urls = []
                         for xref in p.find_all('xref'):
                             urls.append(xref.get('url'))
-                        bib_entry['urls'] = urls
-                        bib_entry['num'] = bi_num
                         # map to bib id
-                        bibkey_map[bib_key] = bib_entry
+                        bib_items_to_process.append((bib_key, bib_text, {'urls': urls, 'num': bi_num}))
                 except AttributeError:
                     print('Attribute error in bib item!', p)
                     continue
                 except TypeError:
                     print('Type error in bib item!', p)
                     continue
+
+    # process all bib entries of the paper together
+    bib_entries = process_bibentries([bib_text for _, bib_text, _ in bib_items_to_process], client, log_file)
+    for (bib_key, _, fields), bib_entry in zip(bib_items_to_process, bib_entries):
+        # if processed successfully, add to map
+        if bib_entry:
+            bib_entry.update(fields)
+            bibkey_map[bib_key] = bib_entry
+
     for bibliography in sp.find_all('bibliography'):
         bibliography.decompose()
     return bibkey_map
@@ -680,7 +817,7 @@ def process_equations_from_tex(sp: BeautifulSoup) -> Dict:
                 if eq.get('id', None):
                     ref_id = eq.get('id').replace('uid', 'EQREF')
                     try:
-                        mathml = latex2mathml.converter.convert(eq.texmath.text.strip())
+                        mathml = latex_to_mathml(eq.texmath.text.strip())
                     except Exception:
                         mathml = ""
                     equation_map[ref_id] = {
@@ -764,16 +901,7 @@ def read_image(img_path: Path) -> Tuple[bytes, Tuple[int, int]]:
         bytes: 图片文件的二进制数据
         Tuple[int, int]: 图片的宽度和高度
     """
-    try:
-        with open(img_path, 'rb') as file:
-            image = PILImage.open(file)
-            img_byte_arr = io.BytesIO()
-            image.save(img_byte_arr, format=image.format)
-            img_byte_arr = img_byte_arr.getvalue()
-        return img_byte_arr, image.size
-    except Exception as e:
-        logger.error(f"图片转换二进制失败: {e}")
-        return None, (0, 0)
+    return read_image_bytes(img_path)
 
 
 def get_figure_map_from_tex(sp: BeautifulSoup, latex_dir: str) -> Dict:
@@ -1298,7 +1426,7 @@ def combine_ref_maps(eq_map: Dict, fig_map: Dict, tab_map: Dict, foot_map: Dict,
     :param sec_map:
     :return:
     """
-    ref_map = dict()
+    ref_map = RefMap()
     for k, v in eq_map.items():
         v['type'] = 'equation'
         ref_map[k] = v
@@ -1314,6 +1442,8 @@ def combine_ref_maps(eq_map: Dict, fig_map: Dict, tab_map: Dict, foot_map: Dict,
     for k, v in sec_map.items():
         v['type'] = 'section'
         ref_map[k] = v
+    # 每个 <ref> 只需一次查找
+    ref_map.uid_index = build_uid_index(ref_map)
     return ref_map
 
 
@@ -1587,13 +1717,75 @@ def convert_xml_to_s2orc(
     )
 
 
-def convert_latex_xml_to_s2orc_json(xml_fpath: str, html_fpath: str, temp_dir: str, log_dir: str, grobid_config: Optional[Dict]=None) -> Paper:
+def is_table_figure(el) -> bool:
+    """
+    Whether an lxml element matches figure.ltx_table
+    :param el:
+    :return:
+    """
+    return el.tag == 'figure' and 'ltx_table' in (el.get('class') or '').split()
+
+
+def extract_latexml_tables(html_fpath: str) -> str:
+    """
+    Stream a LaTeXML html with lxml and keep only its table figures, the only part get_table_map_from_html uses
+    :param html_fpath:
+    :return: the outermost figure.ltx_table elements serialized one after another
+    """
+    parser = etree.HTMLPullParser(events=('start', 'end'), encoding='utf-8')
+    fragments = []
+    depth = 0   # table figures currently open
+
+    def collect():
+        nonlocal depth
+        for event, el in parser.read_events():
+            if is_table_figure(el):
+                depth += 1 if event == 'start' else -1
+                if event == 'end' and depth == 0:
+                    # 非 ASCII 字符写成字符引用，html.parser 解码后与整篇解析时相同
+                    fragments.append(
+                        etree.tostring(el, method='html', encoding='us-ascii', with_tail=False).decode('ascii')
+                    )
+                    el.clear()
+            elif event == 'end' and depth == 0:
+                # 表格以外的内容读完即释放
+                el.clear()
+                parent = el.getparent()
+                while parent is not None and el.getprevious() is not None:
+                    del parent[0]
+
+    with open(html_fpath, 'rb') as f:
+        carry = b''
+        while True:
+            chunk = f.read(HTML_READ_SIZE)
+            if not chunk:
+                break
+            chunk = carry + chunk
+            carry = b''
+            # U+00A0 的 utf-8 编码可能被块边界截断
+            if chunk.endswith(b'\xc2'):
+                chunk, carry = chunk[:-1], chunk[-1:]
+            parser.feed(chunk.replace(b'\xc2\xa0', b' '))
+            collect()
+    if carry:
+        parser.feed(carry)
+    parser.close()
+    collect()
+    return ''.join(fragments)
+
+
+def convert_latex_xml_to_s2orc_json(xml_fpath: str, html_fpath: str, temp_dir: str, log_dir: str, grobid_config: Optional[Dict]=None,
+                                    engine: str=XML_ENGINE, html_tables_only: bool=HTML_TABLES_ONLY) -> Paper:
     """
     :param xml_fpath:
     :param log_dir:
     :param grobid_config:
+    :param engine: one of XML_ENGINES, both give the same Paper
+    :param html_tables_only: minify and parse only the table figures of the LaTeXML html
     :return:
     """
+    if engine not in XML_ENGINES:
+        raise ValueError(f"Unknown xml engine: {engine}")
     assert os.path.exists(xml_fpath)
 
     # get file id
@@ -1617,16 +1809,24 @@ def convert_latex_xml_to_s2orc_json(xml_fpath: str, html_fpath: str, temp_dir: s
     with open(xml_fpath, 'r') as f:
         try:
             xml = f.read()
-            soup_xml = BeautifulSoup(xml, "lxml")
+            if html_tables_only:
+                html_str = extract_latexml_tables(html_fpath)
+            else:
+                html_str = open(html_fpath, "r", encoding="utf-8").read().replace("\xa0", " ")
             soup_html = BeautifulSoup(
                 htmlmin.minify(
-                    open(html_fpath, "r", encoding="utf-8").read().replace("\xa0", " "),
+                    html_str,
                     remove_all_empty_space=1,
                 ),
                 features="html.parser",
             )
 
-            paper = convert_xml_to_s2orc(soup_xml, soup_html, file_id, year, log_file, temp_dir, grobid_config=grobid_config)
+            if engine == 'lxml':
+                from doc2json.tex2json.xml_to_json_lxml import convert_xml_to_s2orc as convert_xml_to_s2orc_lxml
+                paper = convert_xml_to_s2orc_lxml(xml, soup_html, file_id, year, log_file, temp_dir, grobid_config=grobid_config)
+            else:
+                soup_xml = BeautifulSoup(xml, "lxml")
+                paper = convert_xml_to_s2orc(soup_xml, soup_html, file_id, year, log_file, temp_dir, grobid_config=grobid_config)
             return paper
         except UnicodeDecodeError:
             with open(log_file, 'a+') as log_f:
@@ -0,0 +1,959 @@
+"""
+lxml engine of xml_to_json
+
+The BeautifulSoup engine walks the tralics tree once per step: the title block,
+the bibliography, sections, equations, footnotes, figures, tables and <hi> tags
+all use their own find_all. This engine parses the same xml with lxml's HTML
+parser (the parser behind BeautifulSoup(xml, "lxml"), so the tree is identical),
+collects every element those steps need in one traversal and runs the steps on
+the lxml tree. Only the finished tree is handed to BeautifulSoup, for the
+abstract and body text walkers of xml_to_json.
+
+The steps mirror their xml_to_json counterparts, including how BeautifulSoup
+keeps replaced and neighbouring strings apart: a tag replaced by a string becomes
+a STRING_TAG element and a removed tag leaves a BOUNDARY_TAG element behind.
+Both turn back into plain strings in to_soup.
+"""
+import os
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+from bs4 import BeautifulSoup, NavigableString, Comment
+from lxml import etree
+
+from doc2json.grobid2json.grobid.grobid_client import GrobidClient
+from doc2json.s2orc import Paper
+from doc2json.utils.mathml_util import latex_to_mathml
+from doc2json.tex2json.xml_to_json import (
+    process_author, process_bibentries, normalize_latex_id, combine_ref_maps, get_table_map_from_html,
+    get_table_list_from_tex, process_abstract_from_tex, process_body_text_from_tex, get_uid_index, normalize_ref_target
+)
+from loguru import logger
+
+# 被替换为字符串的标签
+STRING_TAG = '_s2orc_string'
+# 被删除的标签，BeautifulSoup 中其前后的字符串是两个独立的节点
+BOUNDARY_TAG = '_s2orc_boundary'
+MARKER_TAGS = {STRING_TAG, BOUNDARY_TAG}
+# 与 BeautifulSoup.endData 一致：只含这些字符的字符串被压缩为一个空格或换行
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+PRESERVE_WHITESPACE_TAGS = {'pre', 'textarea'}
+# 一次遍历中收集的标签
+COLLECTED_TAGS = {
+    'std', 'unknown', 'maketitle', 'metadata', 'title', 'author', 'authors', 'bibliography',
+    'div0', 'formula', 'note', 'float', 'figure', 'table', 'hi'
+}
+# _for_each_content 回调的返回值
+REMOVED = 'removed'
+STOP = 'stop'
+
+
+class XmlTree:
+    """
+    lxml tree of one tralics xml with the elements of COLLECTED_TAGS in document order
+    """
+
+    def __init__(self, xml: str):
+        parser = etree.HTMLParser()
+        parser.feed(xml)
+        self.root = parser.close()
+        self.tags = {tag: [] for tag in COLLECTED_TAGS}
+        # 被 decompose 的元素，与 replace_with 移出的元素不同，其子树不再被处理
+        self.decomposed = set()
+
+        preserved = set()
+        for el in self.root.iter(*PRESERVE_WHITESPACE_TAGS):
+            preserved.update(el.iter())
+        # the single traversal: collapse whitespace like BeautifulSoup and collect elements
+        for el in self.root.iter():
+            if not isinstance(el.tag, str):
+                if el.tail and el.getparent() not in preserved:
+                    el.tail = _collapse(el.tail)
+                continue
+            if el.text and el not in preserved:
+                el.text = _collapse(el.text)
+            if el.tail and el.getparent() not in preserved:
+                el.tail = _collapse(el.tail)
+            if el.tag in self.tags:
+                self.tags[el.tag].append(el)
+
+    def attached(self, el) -> bool:
+        top = el
+        for top in el.iterancestors():
+            pass
+        return top is self.root
+
+    def decompose(self, el):
+        """
+        Tag.decompose: remove el, the string after it stays a separate string
+        :param el:
+        :return:
+        """
+        self.decomposed.add(el)
+        if el.tail:
+            _replace(el, BOUNDARY_TAG)
+        elif el.getparent() is not None:
+            el.getparent().remove(el)
+
+    def destroyed(self, el) -> bool:
+        """
+        Whether el is inside a decomposed element, such a tag has no name in BeautifulSoup
+        :param el:
+        :return:
+        """
+        return el in self.decomposed or any(ancestor in self.decomposed for ancestor in el.iterancestors())
+
+    def all(self, tag: str) -> List:
+        """
+        Elements of one tag still in the tree, like sp.find_all(tag)
+        :param tag:
+        :return:
+        """
+        return [el for el in self.tags[tag] if self.attached(el)]
+
+    def first(self, tag: str):
+        """
+        First element of one tag still in the tree, like sp.<tag>
+        :param tag:
+        :return:
+        """
+        for el in self.tags[tag]:
+            if self.attached(el):
+                return el
+        return None
+
+    @property
+    def body(self):
+        return self.root.find('body')
+
+
+def _collapse(text: str) -> str:
+    for c in text:
+        if c not in ASCII_SPACES:
+            return text
+    return '\n' if '\n' in text else ' '
+
+
+def _is_tag(item) -> bool:
+    return isinstance(item, etree._Element) and isinstance(item.tag, str) and item.tag not in MARKER_TAGS
+
+
+def _is_comment(item) -> bool:
+    return isinstance(item, etree._Element) and item.tag is etree.Comment
+
+
+def _text(el) -> str:
+    """
+    Tag.text: every string below el, comments excluded
+    :param el:
+    :return:
+    """
+    return etree.tostring(el, method='text', encoding=str, with_tail=False)
+
+
+def _item_text(item) -> str:
+    """
+    .text of one item of _contents, comments have none
+    :param item:
+    :return:
+    """
+    if _is_comment(item):
+        raise AttributeError("'Comment' object has no attribute 'text'")
+    return _text(item)
+
+
+def _contents(el) -> List:
+    """
+    Tag.contents: strings, tags and comments
+    :param el:
+    :return:
+    """
+    contents = []
+    if el.text:
+        contents.append(el.text)
+    for child in el:
+        if child.tag == STRING_TAG:
+            contents.append(child.text or '')
+        elif child.tag != BOUNDARY_TAG:
+            contents.append(child)
+        if child.tail:
+            contents.append(child.tail)
+    return contents
+
+
+def _children(el) -> List:
+    """
+    Tag.find_all(recursive=False)
+    :param el:
+    :return:
+    """
+    return [child for child in el if _is_tag(child)]
+
+
+def _descendants(el, tag: str) -> List:
+    """
+    Tag.find_all(tag), el itself excluded
+    :param el:
+    :param tag:
+    :return:
+    """
+    return [sub_el for sub_el in el.iter(tag) if sub_el is not el]
+
+
+def _find(el, tag: str):
+    """
+    Tag.<tag>: first descendant with the tag, el itself excluded
+    :param el:
+    :param tag:
+    :return:
+    """
+    for sub_el in el.iter(tag):
+        if sub_el is not el:
+            return sub_el
+    return None
+
+
+def _replace(el, marker_tag: str, text: Optional[str] = None):
+    parent = el.getparent()
+    if parent is None:
+        return
+    marker = etree.Element(marker_tag)
+    marker.text = text
+    marker.tail = el.tail
+    el.tail = None
+    parent.replace(el, marker)
+
+
+def _replace_with_string(el, text: str):
+    """
+    Tag.replace_with(text)
+    :param el:
+    :param text:
+    :return:
+    """
+    _replace(el, STRING_TAG, text)
+
+
+def _for_each_content(el, fn: Callable):
+    """
+    `for tag in el: ...` of BeautifulSoup, which iterates the contents list while the body may remove the current tag
+    Like any list iteration, the item after a removed one is skipped
+    :param el:
+    :param fn: called with each item, returns REMOVED after removing it or STOP to break
+    :return:
+    """
+    contents = _contents(el)
+    idx = 0
+    while idx < len(contents):
+        result = fn(contents[idx])
+        if result == STOP:
+            return
+        if result == REMOVED:
+            del contents[idx]
+        idx += 1
+
+
+def decompose_tags_before_title(tree: XmlTree):
+    """
+    decompose all tags before title, see xml_to_json.decompose_tags_before_title
+    :param tree:
+    :return:
+    """
+    body = tree.body
+    if body is None:
+        raise AttributeError("'NoneType' object has no attribute 'next'")
+    first = body.text if body.text else (body[0] if len(body) else None)
+    name = first.tag if _is_tag(first) else None
+    if name not in ('std', 'unknown'):
+        print(f"Unknown inner tag: {name}")
+        return
+    cld_tags = _children(tree.first(name))
+    if any([tag.tag == 'maketitle' or tag.tag == 'title' for tag in cld_tags]):
+        std = tree.first('std')
+        if std is None:
+            raise TypeError("'NoneType' object is not iterable")
+
+        def remove_before_title(tag):
+            if _is_tag(tag):
+                if tag.tag != 'maketitle' and tag.tag != 'title':
+                    tree.decompose(tag)
+                    return REMOVED
+                return STOP
+
+        _for_each_content(std, remove_before_title)
+
+
+def process_metadata(tree: XmlTree, grobid_client: GrobidClient, log_file: str) -> Tuple[str, List]:
+    """
+    Process metadata section, see xml_to_json.process_metadata
+    :param tree:
+    :param grobid_client:
+    :param log_file:
+    :return:
+    """
+    title = ""
+    authors = []
+
+    maketitle = tree.first('maketitle')
+    metadata = tree.first('metadata')
+    if maketitle is None and metadata is None:
+        title_el = tree.first('title')
+        if title_el is not None:
+            title = _text(title_el)
+        return title, authors
+    elif maketitle is not None:
+        try:
+            # process title
+            title_el = _find(maketitle, 'title')
+            if title_el is None:
+                raise AttributeError('title')
+            title = _text(title_el)
+            author = tree.first('author')
+            if author is None:
+                raise AttributeError('author')
+            for formula in _descendants(author, 'formula'):
+                tree.decompose(formula)
+            # process authors
+            author_parts = []
+            for tag in _contents(author):
+                if isinstance(tag, str):
+                    author_parts.append(tag.strip())
+                else:
+                    author_parts.append(_item_text(tag).strip())
+            author_parts = [re.sub(r'\s+', ' ', line) for line in author_parts]
+            author_parts = [re.sub(r'\s', ' ', line).strip() for line in author_parts]
+            author_parts = [part for part in author_parts if part.strip()]
+            author_string = ', '.join(author_parts)
+            authors = process_author(author_string, grobid_client, log_file)
+            tree.decompose(maketitle)
+        except AttributeError:
+            tree.decompose(maketitle)
+            return title, authors
+    else:
+        try:
+            # process title and authors from metadata
+            title_el = _find(metadata, 'title')
+            if title_el is None:
+                raise AttributeError('title')
+            title = _text(title_el)
+            authors_el = tree.first('authors')
+            if authors_el is None:
+                raise TypeError("'NoneType' object is not iterable")
+            # get authors
+            for author in _contents(authors_el):
+                if not _is_tag(author):
+                    # 字符串没有 decompose / text
+                    raise AttributeError('author')
+
+                def remove_subtag(subtag):
+                    if not _is_tag(subtag):
+                        raise AttributeError('subtag')
+                    tree.decompose(subtag)
+                    return REMOVED
+
+                _for_each_content(author, remove_subtag)
+                if _text(author).strip():
+                    author_parts = _text(author).strip().split()
+                    authors.append({
+                        "first": author_parts[0] if len(author_parts) > 1 else "",
+                        "last": author_parts[-1]
+                            if author_parts[-1].lower() not in {"jr", "jr.", "iii", "iv", "v"}
+                            else author_parts[-2] if len(author_parts) > 1 else author_parts[-1],
+                        "middle": author_parts[1:-1],
+                        "suffix": "",
+                        "affiliation": {},
+                        "email": ""
+                    })
+            tree.decompose(metadata)
+        except AttributeError:
+            tree.decompose(metadata)
+            return title, authors
+
+    return title, authors
+
+
+def _find_next(el, tag: str):
+    """
+    Tag.find_next(tag): first element with the tag after the start of el, its own descendants included
+    :param el:
+    :param tag:
+    :return:
+    """
+    found = _find(el, tag)
+    if found is not None:
+        return found
+    following = el.xpath(f'following::{tag}[1]')
+    return following[0] if following else None
+
+
+def process_bibliography(tree: XmlTree, client: GrobidClient, log_file: str) -> Dict:
+    """
+    Parse bibliography, see xml_to_json.process_bibliography_from_tex
+    :param tree:
+    :param client:
+    :param log_file:
+    :return:
+    """
+    bibkey_map = dict()
+    # (bib key, bib text, fields added to the processed entry) in document order
+    bib_items_to_process = []
+    bibliographies = tree.all('bibliography')
+    for bibliography in bibliographies:
+        bib_items = _descendants(bibliography, 'bibitem')
+        # map all bib entries
+        if bib_items:
+            for bi_num, bi in enumerate(bib_items):
+                try:
+                    if not bi.get('id'):
+                        continue
+                    # get bib entry text
+                    bib_par = next(bi.iterancestors('p'), None)
+                    if bib_par is None:
+                        raise AttributeError('p')
+                    if _text(bib_par):
+                        bib_text = _text(bib_par)
+                    else:
+                        next_tag = _find_next(bib_par, 'p')
+                        if next_tag is None:
+                            raise AttributeError('p')
+                        if _find(next_tag, 'bibitem') is None and _text(next_tag):
+                            bib_text = _text(next_tag)
+                        else:
+                            bib_text = None
+                    if not bib_text:
+                        continue
+                    # get URLs from bib entry
+                    urls = []
+                    for xref in _descendants(bib_par, 'xref'):
+                        urls.append(xref.get('url'))
+                    # map to ref id
+                    ref_id = normalize_latex_id(bi.get('id'))
+                    bib_items_to_process.append((ref_id, bib_text, {'urls': urls, 'ref_id': ref_id, 'num': bi_num}))
+                except AttributeError:
+                    print('Attribute error in bib item!', bi.get('id'))
+                    continue
+        else:
+            for bi_num, p in enumerate(_descendants(bibliographies[0], 'p')):
+                bib_key, bib_text = None, None
+                bib_text = _text(p)
+                bib_name = re.match(r'\[(.*?)\](.*)', bib_text)
+                if bib_name:
+                    bib_text = re.sub(r'\s', ' ', bib_text)
+                    bib_name = re.match(r'\[(.*?)\](.*)', bib_text)
+                    bib_text = None
+                    if bib_name:
+                        bib_key = bib_name.group(1)
+                        bib_text = bib_name.group(2)
+                else:
+                    bib_lines = bib_text.split('\n')
+                    bib_key = re.sub(r'\s', ' ', bib_lines[0])
+                    bib_text = re.sub(r'\s', ' ', ' '.join(bib_lines[1:]))
+                if bib_key and bib_text:
+                    # get URLs from bib entry
+                    urls = []
+                    for xref in _descendants(p, 'xref'):
+                        urls.append(xref.get('url'))
+                    # map to bib id
+                    bib_items_to_process.append((bib_key, bib_text, {'urls': urls, 'num': bi_num}))
+
+    # process all bib entries of the paper together
+    bib_entries = process_bibentries([bib_text for _, bib_text, _ in bib_items_to_process], client, log_file)
+    for (bib_key, _, fields), bib_entry in zip(bib_items_to_process, bib_entries):
+        # if processed successfully, add to map
+        if bib_entry:
+            bib_entry.update(fields)
+            bibkey_map[bib_key] = bib_entry
+
+    for bibliography in bibliographies:
+        tree.decompose(bibliography)
+    return bibkey_map
+
+
+def get_section_name(sec) -> str:
+    """
+    Get section name from div tag, see xml_to_json.get_section_name
+    :param sec:
+    :return:
+    """
+    head = _find(sec, 'head')
+    if head is not None:
+        return _text(head)
+    sec_str = []
+    for tag in _contents(sec):
+        if isinstance(tag, str):
+            if len(tag.strip()) < 50:
+                sec_str.append(tag.strip())
+            else:
+                break
+        elif not _is_tag(tag) or tag.tag != 'p':
+            if len(_item_text(tag).strip()) < 50:
+                sec_str.append(_item_text(tag).strip())
+            else:
+                break
+        else:
+            break
+    return ' '.join(sec_str).strip()
+
+
+def get_sections_from_div(el, parent: Optional[str], faux_max: int) -> Dict:
+    """
+    Process section headers for one div, see xml_to_json.get_sections_from_div
+    :param el:
+    :param parent:
+    :param faux_max:
+    :return:
+    """
+    sec_map_dict = dict()
+    el_ref_id = None
+
+    # process divs with ids
+    if el.get('id', None):
+        sec_num = el.get('id-text', None)
+        if 'cid' in el.get('id'):
+            el_ref_id = el.get('id').replace('cid', 'SECREF')
+        elif 'uid' in el.get('id'):
+            el_ref_id = el.get('id').replace('uid', 'SECREFU')
+        else:
+            print('Unknown ID type!', el.get('id'))
+            raise NotImplementedError
+        el.set('s2orc_id', el_ref_id)
+        sec_map_dict[el_ref_id] = {
+            "num": sec_num,
+            "text": get_section_name(el),
+            "ref_id": el_ref_id,
+            "parent": parent
+        }
+    # process divs without section numbers
+    elif el.get('rend') == "nonumber":
+        el_ref_id = f'SECREF{faux_max}'
+        el.set('s2orc_id', el_ref_id)
+        sec_map_dict[el_ref_id] = {
+            "num": None,
+            "text": get_section_name(el),
+            "ref_id": el_ref_id,
+            "parent": parent
+        }
+
+    # process sub elements
+    for sub_el in _children(el):
+        if sub_el.tag.startswith('div'):
+            # add any unspecified keys
+            sec_keys = [int(k.strip('SECREF')) for k in sec_map_dict.keys() if k and k.strip('SECREF').isdigit()]
+            faux_max = max(sec_keys + [faux_max]) + 1
+            sec_map_dict.update(
+                get_sections_from_div(sub_el, el_ref_id if el_ref_id else parent, faux_max)
+            )
+        elif sub_el.tag == 'p' or sub_el.tag == 'proof':
+            if sub_el.get('id', None):
+                hi = _find(sub_el, 'hi')
+                if hi is None:
+                    raise AttributeError("'NoneType' object has no attribute 'get'")
+                sec_num = sub_el.get('id-text', hi.get('id-text', None))
+                if 'cid' in sub_el.get('id'):
+                    sub_el_ref_id = sub_el.get('id').replace('cid', 'SECREF')
+                elif 'uid' in sub_el.get('id'):
+                    sub_el_ref_id = sub_el.get('id').replace('uid', 'SECREFU')
+                else:
+                    print('Unknown ID type!', sub_el.get('id'))
+                    raise NotImplementedError
+                sub_el.set('s2orc_id', sub_el_ref_id)
+                head = _find(sub_el, 'head')
+                sec_map_dict[el_ref_id] = {
+                    "num": sec_num,
+                    "text": _text(head) if head is not None else _text(hi),
+                    "ref_id": sub_el_ref_id,
+                    "parent": el_ref_id if el_ref_id else parent
+                }
+    return sec_map_dict
+
+
+def process_sections(tree: XmlTree) -> Dict:
+    """
+    Generate section dict, see xml_to_json.process_sections_from_text
+    :param tree:
+    :return:
+    """
+    section_map = dict()
+    max_above_1000 = 999
+
+    for div0 in tree.all('div0'):
+        section_map.update(get_sections_from_div(div0, None, max_above_1000 + 1))
+        # add any unspecified keys
+        sec_keys = [int(k.strip('SECREF')) for k in section_map.keys() if k and k.strip('SECREF').isdigit()]
+        max_above_1000 = max(sec_keys + [max_above_1000]) + 1
+
+    return section_map
+
+
+def process_equations(tree: XmlTree) -> Dict:
+    """
+    Generate equation dict and wrap display equations in <p>, see xml_to_json.process_equations_from_tex
+    :param tree:
+    :return:
+    """
+    equation_map = dict()
+    wrapped = set()
+
+    for eq in tree.all('formula'):
+        try:
+            if eq.get('type', None) == 'display':
+                texmath = _find(eq, 'texmath')
+                if eq.get('id', None):
+                    ref_id = eq.get('id').replace('uid', 'EQREF')
+                    try:
+                        mathml = latex_to_mathml(_text(texmath).strip())
+                    except Exception:
+                        mathml = ""
+                    math = _find(eq, 'math')
+                    if math is None or texmath is None:
+                        raise AttributeError('math')
+                    equation_map[ref_id] = {
+                        "num": eq.get('id-text', None),
+                        "text": _text(math).strip(),
+                        "mathml": mathml,
+                        "latex": _text(texmath).strip(),
+                        "ref_id": ref_id
+                    }
+                # BeautifulSoup 中嵌套的公式随外层公式被复制，原节点已不在树中
+                if any(ancestor in wrapped for ancestor in eq.iterancestors('formula')):
+                    continue
+                # replace with <p> containing equation as inline
+                parent = eq.getparent()
+                replace_item = etree.Element('p')
+                replace_item.tail = eq.tail
+                eq.tail = None
+                parent.replace(eq, replace_item)
+                replace_item.append(eq)
+                eq.set('type', 'inline')
+                wrapped.add(eq)
+        except AttributeError:
+            continue
+
+    return equation_map
+
+
+def process_footnotes(tree: XmlTree) -> Dict:
+    """
+    Process footnote marks, see xml_to_json.process_footnotes_from_text
+    :param tree:
+    :return:
+    """
+    footnote_map = dict()
+
+    for note in tree.all('note'):
+        if not tree.destroyed(note) and note.get('id'):
+            # normalize footnote id
+            ref_id = note.get('id').replace('uid', 'FOOTREF')
+            # remove equation tex
+            for eq in _descendants(note, 'texmath'):
+                tree.decompose(eq)
+            # replace all xrefs with link
+            for xref in _descendants(note, 'xref'):
+                _replace_with_string(xref, f" {xref.get('url')} ")
+            # clean footnote text
+            footnote_text = None
+            if _text(note):
+                footnote_text = _text(note).strip()
+                footnote_text = re.sub(r'\s+', ' ', footnote_text)
+                footnote_text = re.sub(r'\s', ' ', footnote_text)
+            # form footnote entry
+            footnote_map[ref_id] = {
+                "num": note.get('id-text', None),
+                "text": footnote_text,
+                "ref_id": ref_id
+            }
+            _replace_with_string(note, f" {ref_id} ")
+    return footnote_map
+
+
+def _figure_files(fig, latex_dir: str) -> List[str]:
+    fig_files = []
+    if fig.get('file') and fig.get('extension'):
+        fig_files.append(os.path.join(latex_dir, fig.get('file') + '.' + fig.get('extension')))
+    elif fig.get('file'):
+        fig_files.append(os.path.join(latex_dir, fig.get('file')))
+    else:
+        for subfig in _descendants(fig, 'subfigure'):
+            if subfig.get('file') and subfig.get('extension'):
+                fig_files.append(os.path.join(latex_dir, subfig.get('file') + '.' + subfig.get('extension')))
+            elif subfig.get('file'):
+                fig_files.append(os.path.join(latex_dir, subfig.get('file')))
+    return fig_files
+
+
+def get_figure_map(tree: XmlTree, latex_dir: str) -> Dict:
+    """
+    Generate figure dict only, see xml_to_json.get_figure_map_from_tex
+    :param tree:
+    :param latex_dir:
+    :return:
+    """
+    figure_map = dict()
+    # get floats first because they are around figures
+    for flt in tree.all('float'):
+        if flt.get('name') == 'figure':
+            fig_files = []
+            for fig in _descendants(flt, 'figure'):
+                fig_files += _figure_files(fig, latex_dir)
+            if flt.get('id'):
+                ref_id = flt.get('id').replace('uid', 'FIGREF')
+                figure_map[ref_id] = {
+                    "num": flt.get('id-text', None),
+                    "text": None,   # placeholder
+                    "uris": fig_files,
+                    "image_binary": [],
+                    "ref_id": ref_id
+                }
+
+    for fig in tree.all('figure'):
+        if fig.get('id'):
+            ref_id = fig.get('id').replace('uid', 'FIGREF')
+            figure_map[ref_id] = {
+                "num": fig.get('id-text', None),
+                "text": None,   # placeholder
+                "uris": _figure_files(fig, latex_dir),
+                "ref_id": ref_id
+            }
+
+    return figure_map
+
+
+def get_table_map(tree: XmlTree) -> Dict:
+    """
+    Generate table dict only, see xml_to_json.get_table_map_from_text
+    :param tree:
+    :return:
+    """
+    table_map = dict()
+
+    for flt in tree.all('float'):
+        if flt.get('name') == 'table' and flt.get('id'):
+            table_map[flt.get('id-text', None)] = flt.get('id').replace('uid', 'TABREF')
+
+    for tab in tree.all('table'):
+        # skip inline tables
+        if tab.get('rend') == 'inline':
+            continue
+        if tab.get('id'):
+            table_map[tab.get('id-text', None)] = tab.get('id').replace('uid', 'TABREF')
+
+    return table_map
+
+
+def replace_ref_tokens(el, ref_map: Dict):
+    """
+    Replace all references in element with special tokens, see xml_to_json.replace_ref_tokens
+    :param el:
+    :param ref_map:
+    :return:
+    """
+    # replace all citations with cite keyword
+    for cite in _descendants(el, 'cit'):
+        ref = _find(cite, 'ref')
+        if ref is None or ref.get('target') is None:
+            print('Attribute error: ', cite.tag)
+            continue
+        _replace_with_string(cite, f" {ref.get('target').replace('bid', 'BIBREF')} ")
+
+    # replace all non citation references
+    uid_index = get_uid_index(ref_map)
+    for rtag in _descendants(el, 'ref'):
+        target = rtag.get('target')
+        if target and not target.startswith('bid'):
+            _replace_with_string(rtag, f" {normalize_ref_target(target, uid_index)} ")
+    return el
+
+
+def process_figures(tree: XmlTree, ref_map: Dict) -> Dict:
+    """
+    Add figure captions to ref_map and decompose figures, see xml_to_json.process_figures_from_tex
+    :param tree:
+    :param ref_map:
+    :return:
+    """
+    # process floats first because they are on the outside
+    for flt in tree.all('float'):
+        # 外层 float 已删除
+        if tree.destroyed(flt):
+            continue
+        try:
+            if flt.get('name') == 'figure':
+                if flt.get('id'):
+                    ref_id = flt.get('id').replace('uid', 'FIGREF')
+                    # remove equation tex
+                    for eq in _descendants(flt, 'texmath'):
+                        tree.decompose(eq)
+                    # clean caption text
+                    caption_text = None
+                    if _find(flt, 'caption') is not None:
+                        replace_ref_tokens(flt, ref_map)
+                        # the caption may have been inside a replaced citation
+                        caption = _find(flt, 'caption')
+                        if caption is None:
+                            raise AttributeError('caption')
+                        caption_text = _text(caption).strip()
+                        caption_text = re.sub(r'\s+', ' ', caption_text)
+                        caption_text = re.sub(r'\s', ' ', caption_text)
+                    # form figmap entry
+                    ref_map[ref_id]['text'] = caption_text
+                tree.decompose(flt)
+        except AttributeError:
+            print('Attribute error with figure float: ', flt.tag)
+            continue
+
+    for fig in tree.all('figure'):
+        if tree.destroyed(fig):
+            continue
+        if fig.get('id'):
+            ref_id = fig.get('id').replace('uid', 'FIGREF')
+            # remove equation tex
+            for eq in _descendants(fig, 'texmath'):
+                tree.decompose(eq)
+            # clean caption text
+            caption_text = None
+            if _text(fig):
+                replace_ref_tokens(fig, ref_map)
+                caption_text = _text(fig).strip()
+                caption_text = re.sub(r'\s+', ' ', caption_text)
+                caption_text = re.sub(r'\s', ' ', caption_text)
+            ref_map[ref_id]["text"] = caption_text
+        tree.decompose(fig)
+    return ref_map
+
+
+def collapse_formatting_tags(tree: XmlTree):
+    """
+    Collapse formatting tags like <hi>, see xml_to_json.collapse_formatting_tags
+    :param tree:
+    :return:
+    """
+    for hi in tree.all('hi'):
+        _replace_with_string(hi, f' {_text(hi).strip()} ')
+
+
+def to_soup(tree: XmlTree) -> BeautifulSoup:
+    """
+    Build the BeautifulSoup tree of the lxml tree, through the same calls BeautifulSoup's lxml builder makes
+    :param tree:
+    :return:
+    """
+    soup = BeautifulSoup('', 'lxml')
+
+    def feed(el):
+        if el.tag is etree.Comment:
+            soup.endData()
+            soup.handle_data(el.text or '')
+            soup.endData(Comment)
+        elif el.tag == STRING_TAG:
+            soup.endData()
+            soup.object_was_parsed(NavigableString(el.text or ''))
+        elif el.tag == BOUNDARY_TAG:
+            soup.endData()
+        elif isinstance(el.tag, str):
+            soup.handle_starttag(el.tag, None, None, dict(el.attrib))
+            if el.text:
+                soup.handle_data(el.text)
+            for child in el:
+                feed(child)
+            soup.handle_endtag(el.tag)
+        if el.tail:
+            soup.handle_data(el.tail)
+
+    # the xml declaration is a comment before <html>
+    for el in reversed(list(tree.root.itersiblings(preceding=True))):
+        feed(el)
+    feed(tree.root)
+    soup.endData()
+    return soup
+
+
+def convert_xml_to_s2orc(
+        xml: str, html_sp: BeautifulSoup, file_id: str, year_str: str, log_file: str, temp_dir: str,
+        grobid_config: Optional[Dict]=None
+) -> Paper:
+    """
+    Convert tralics xml to gorc format, same output as xml_to_json.convert_xml_to_s2orc
+    :param xml: content of the tralics xml
+    :param html_sp:
+    :param file_id:
+    :param year_str:
+    :param log_file:
+    :param temp_dir:
+    :param grobid_config:
+    :return:
+    """
+    # create grobid client
+    client = GrobidClient(grobid_config)
+
+    tree = XmlTree(xml)
+
+    # the bs4 engine runs it twice, its loop skips the tag after each removed one
+    decompose_tags_before_title(tree)
+    decompose_tags_before_title(tree)
+
+    # process maketitle info
+    title, authors = process_metadata(tree, client, log_file)
+
+    # processing of bibliography entries
+    bibkey_map = process_bibliography(tree, client, log_file)
+
+    # no bibliography entries
+    if not bibkey_map:
+        with open(log_file, 'a+') as bib_f:
+            bib_f.write(f'{file_id},warn_no_bibs\n')
+
+    section_map = process_sections(tree)
+    equation_map = process_equations(tree)
+    footnote_map = process_footnotes(tree)
+
+    latex_dir = os.path.join(temp_dir, 'latex', file_id)
+    figure_map = get_figure_map(tree, latex_dir)
+
+    # get table_map
+    table_dict = get_table_map(tree)
+    table_map = get_table_map_from_html(html_sp, table_dict)
+    try:
+        # 补 latex代码，如果出错只保留markdown数据
+        table_map = get_table_list_from_tex(os.path.join(temp_dir, 'norm', file_id, file_id + '.tex'), table_map)
+    except Exception as e:
+        logger.info('err: [%s]' % e)
+
+    # combine references in one dict
+    refkey_map = combine_ref_maps(equation_map, figure_map, table_map, footnote_map, section_map)
+
+    # process and replace figures
+    refkey_map = process_figures(tree, refkey_map)
+
+    # collapse all hi tags
+    collapse_formatting_tags(tree)
+
+    # abstract and body text are walked on the BeautifulSoup tree
+    xml_sp = to_soup(tree)
+    abstract = process_abstract_from_tex(xml_sp, bibkey_map, refkey_map)
+    body_text = process_body_text_from_tex(xml_sp, bibkey_map, refkey_map)
+
+    # skip if no body text parsed
+    if not body_text:
+        with open(log_file, 'a+') as body_f:
+            body_f.write(f'{file_id},warn_no_body\n')
+
+    metadata = {
+        "title": title,
+        "authors": authors,
+        "year": year_str,
+        "venue": "",
+        "identifiers": {
+            "arxiv_id": file_id
+        }
+    }
+
+    return Paper(
+        paper_id=file_id,
+        pdf_hash="",
+        metadata=metadata,
+        abstract=abstract,
+        body_text=body_text,
+        back_matter=[],
+        bib_entries=bibkey_map,
+        ref_entries=refkey_map
+    )
@@ -0,0 +1,24 @@
+"""
+Persistent cache for GROBID results
+
+Parsed results are stored in a SQLite file keyed by the sha1 of the normalized
+input string, so the same reference ("Attention is all you need", "Adam", ...)
+is only sent to GROBID once for the whole corpus. See sqlite_cache for sharing
+the file between workers and LRU eviction.
+"""
+from doc2json.utils.sqlite_cache import SqliteLruCache, DEFAULT_MAX_ENTRIES, DEFAULT_TOUCH_AFTER
+
+# 每个进程打开缓存时检查一次大小，此后每写入多少条再检查一次
+EVICT_EVERY = 1000
+GROBID_TABLE = 'entries'
+
+
+class GrobidCache(SqliteLruCache):
+    """
+    SQLite backed LRU cache of GROBID results, safe to share across processes
+    """
+
+    def __init__(self, cache_path: str, max_entries: int = DEFAULT_MAX_ENTRIES, timeout: float = 30.0,
+                 evict_every: int = EVICT_EVERY, touch_after: float = DEFAULT_TOUCH_AFTER):
+        super().__init__(cache_path, max_entries=max_entries, evict_every=evict_every, table=GROBID_TABLE,
+                         timeout=timeout, normalize=True, touch_after=touch_after)
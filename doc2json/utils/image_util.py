@@ -0,0 +1,172 @@
+"""
+Helpers to turn figure files into the image bytes stored in parquet rows
+
+Vector figures (PDF/EPS) are rendered to PNG by FigureRasterizer: only the first
+page is rendered, PyMuPDF is used when available and rendered PNGs can be kept
+in an on-disk cache keyed by the content hash of the figure and the DPI.
+"""
+import io
+import os
+import hashlib
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Tuple
+
+from loguru import logger
+from PIL import Image as PILImage
+from pdf2image import convert_from_path
+
+try:
+    import pymupdf as fitz
+except ImportError:
+    try:
+        import fitz
+    except ImportError:
+        # 没有 PyMuPDF 时退回 pdf2image (poppler)
+        fitz = None
+
+# 这些格式直接保存原始字节，不做解码再编码
+PASSTHROUGH_FORMATS = {'PNG', 'JPEG', 'MPO', 'GIF', 'WEBP', 'BMP', 'TIFF'}
+# 需要栅格化为 PNG 的矢量图格式
+RASTERIZE_SUFFIXES = {'.pdf', '.eps', '.ps'}
+# 与 pdf2image 的默认值一致
+DEFAULT_DPI = 200
+# 进程内记住最近渲染结果的数量，同一图片被多处引用时不再重复渲染
+MEMO_SIZE = 64
+
+
+class FigureRasterizer:
+    """
+    Render the first page of PDF/EPS figures to PNG
+    """
+
+    def __init__(self, dpi: int = DEFAULT_DPI, cache_dir: Optional[str] = None, memo_size: int = MEMO_SIZE):
+        self.dpi = dpi
+        self.cache_dir = cache_dir
+        self.memo_size = memo_size
+        self._memo = OrderedDict()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_key(self, raw_bytes: bytes) -> str:
+        """
+        Content address of one rendered figure
+        :param raw_bytes: content of the figure file
+        :return:
+        """
+        return f'{hashlib.sha1(raw_bytes).hexdigest()}_{self.dpi}'
+
+    def rasterize(self, img_path: Path) -> Tuple[bytes, Tuple[int, int]]:
+        """
+        Return PNG bytes and size of the first page of a vector figure
+        :param img_path:
+        :return:
+        """
+        with open(img_path, 'rb') as file:
+            raw_bytes = file.read()
+        key = self.cache_key(raw_bytes)
+        if key in self._memo:
+            self._memo.move_to_end(key)
+            return self._memo[key]
+
+        result = self._read_cache(key)
+        if result is None:
+            result = self._render(img_path)
+            self._write_cache(key, result[0])
+
+        self._memo[key] = result
+        if len(self._memo) > self.memo_size:
+            self._memo.popitem(last=False)
+        return result
+
+    def _render(self, img_path: Path) -> Tuple[bytes, Tuple[int, int]]:
+        suffix = Path(img_path).suffix.lower()
+        if suffix == '.pdf':
+            if fitz is not None:
+                try:
+                    with fitz.open(img_path) as doc:
+                        pix = doc[0].get_pixmap(dpi=self.dpi)
+                        return pix.tobytes('png'), (pix.width, pix.height)
+                except Exception as e:
+                    logger.warning(f"PyMuPDF 渲染失败，改用 pdf2image: {e}")
+            image = convert_from_path(img_path, dpi=self.dpi, first_page=1, last_page=1)[0]
+        else:
+            # EPS/PS 由 PIL 调用 ghostscript 渲染，scale 以 72 dpi 为单位
+            image = PILImage.open(img_path)
+            image.load(scale=max(1, round(self.dpi / 72)))
+        return _encode_image(image, 'PNG'), image.size
+
+    def _cache_file(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f'{key}.png')
+
+    def _read_cache(self, key: str) -> Optional[Tuple[bytes, Tuple[int, int]]]:
+        if not self.cache_dir:
+            return None
+        cache_file = self._cache_file(key)
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            with open(cache_file, 'rb') as file:
+                png_bytes = file.read()
+            return png_bytes, PILImage.open(io.BytesIO(png_bytes)).size
+        except Exception:
+            # 损坏的缓存文件直接重新渲染
+            return None
+
+    def _write_cache(self, key: str, png_bytes: bytes):
+        if not self.cache_dir:
+            return
+        cache_file = self._cache_file(key)
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        # 先写临时文件再 rename，多个 worker 同时写同一图片时不会读到半个文件
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(png_bytes)
+        os.replace(tmp_file, cache_file)
+
+
+_default_rasterizer = None
+
+
+def get_default_rasterizer() -> FigureRasterizer:
+    global _default_rasterizer
+    if _default_rasterizer is None:
+        _default_rasterizer = FigureRasterizer()
+    return _default_rasterizer
+
+
+def read_image_bytes(img_path: Path,
+                     rasterizer: Optional[FigureRasterizer] = None) -> Tuple[Optional[bytes], Tuple[int, int]]:
+    """将图片文件转换为二进制格式
+
+    常见位图格式直接返回文件原始字节，尺寸只从文件头读取；
+    PDF/EPS 由 rasterizer 渲染第一页为 PNG；其余格式才解码并按原格式重新编码。
+
+    Args:
+        img_path: 图片文件路径
+        rasterizer: 矢量图渲染器，默认使用进程内共享的 DEFAULT_DPI 渲染器
+
+    Returns:
+        bytes: 图片文件的二进制数据
+        Tuple[int, int]: 图片的宽度和高度
+    """
+    try:
+        if Path(img_path).suffix.lower() in RASTERIZE_SUFFIXES:
+            return (rasterizer or get_default_rasterizer()).rasterize(img_path)
+        with open(img_path, 'rb') as file:
+            raw_bytes = file.read()
+        # PIL.Image.open 是惰性的，此处只解析文件头
+        image = PILImage.open(io.BytesIO(raw_bytes))
+        if image.format in PASSTHROUGH_FORMATS:
+            return raw_bytes, image.size
+        return _encode_image(image, image.format), image.size
+    except Exception as e:
+        logger.error(f"图片转换二进制失败: {e}")
+        return None, (0, 0)
+
+
+def _encode_image(image: PILImage.Image, image_format: Optional[str]) -> bytes:
+    img_byte_arr = io.BytesIO()
+    image.save(img_byte_arr, format=image_format)
+    return img_byte_arr.getvalue()
@@ -6,13 +6,17 @@ Modifications have been made to better identify the primary latex file and expan
 files into the main file. Latexpand and tralics options have also been changed.
 """
 import chardet
+from chardet.universaldetector import UniversalDetector
 import pylibmagic
 import magic
 import os
 import re
 import glob
-import subprocess
 import tempfile
+from functools import lru_cache
+from typing import Optional
+
+from doc2json.utils.tool_runner import run_tool, adaptive_timeout
 
 MAIN_TEX_PATT = re.compile(r'(\\begin\s*\{\s*document\s*\})', re.I)
 # ^ with capturing parentheses so that the pattern can be used for splitting
@@ -21,6 +25,31 @@ GZ_EXT_PATT = re.compile(r'^\.gz$', re.I)
 TEX_EXT_PATT = re.compile(r'^\.tex$', re.I)
 NON_TEXT_PATT = re.compile(r'^\.(pdf|eps|jpg|png|gif)$', re.I)
 BBL_SIGN = '\\bibitem'
+# encoding detection: bytes given to libmagic / chardet, fed to chardet in chunks
+ENCODING_SAMPLE_BYTES = 16 * 1024
+ENCODING_CHUNK_BYTES = 4096
+NON_ASCII_PATT = re.compile(rb'[\x80-\xff]')
+# libmagic reports these for any 8-bit text, chardet decides instead
+GENERIC_MAGIC_ENCODINGS = {'us-ascii', 'iso-8859-1', 'unknown-8bit', 'binary'}
+# expand \input / \include / the bbl file in process instead of running latexpand
+EXPAND_WITH_LATEXPAND = False
+MAX_INPUT_DEPTH = 32
+INPUT_PATT = re.compile(r'\\(input|include)(?![a-zA-Z@])\s*(?:\{([^{}]+)\}|([^\s{}\\%]+))')
+ENDINPUT_PATT = re.compile(r'\\endinput(?![a-zA-Z@])')
+BIBLIOGRAPHY_PATT = re.compile(r'\\bibliography\s*\{[^}]*\}')
+COMMENT_LINE_PATT = re.compile(r'^[ \t]*%.*\n?', re.M)
+COMMENT_PATT = re.compile(r'^((?:[^\\%\n]|\\.)*)%.*$', re.M)
+# conversions sent to a latexmls daemon that did not come back, reported to the parent by the worker
+latexml_timeouts = 0
+# 表格类环境（table, table*, tabular, tabularx, longtable, sidewaystable, wraptable, ...），
+# LaTeXML 的输出只用于表格
+TABLE_ENV_PATT = re.compile(r'\\begin\s*\{[^}]*tab', re.I)
+# main tex detection: only the first bytes of each candidate are scanned
+MAIN_TEX_SCAN_BYTES = 64 * 1024
+DOCUMENTCLASS_PATT = re.compile(r'\\documentclass', re.I)
+BEGIN_DOCUMENT_PATT = re.compile(r'\\begin\s*\{\s*document\s*\}', re.I)
+MAIN_NAME_PATT = re.compile(r'^(main|ms|paper|article|manuscript)$', re.I)
+AUX_NAME_PATT = re.compile(r'(appendix|supp|response|rebuttal|reply|cover|letter)', re.I)
 # natbib fix
 PRE_FIX_NATBIB = True
 NATBIB_PATT = re.compile((r'\\cite(t|p|alt|alp|author|year|yearpar)\s*?\*?\s*?'
@@ -47,28 +76,210 @@ FILTER_PATTS.append(re.compile(r'\\\(.+?\\\)', re.S))
 FILTER_PATTS.append(re.compile(r'\\\[.+?\\\]', re.S))
 
 
-def read_file(path):
+@lru_cache(maxsize=None)
+def is_permissive_encoding(encoding: str) -> bool:
+    """
+    Whether an encoding decodes almost every byte, a successful decode then says nothing about the content
+    :param encoding:
+    :return:
+    """
+    decoded = 0
+    for b in range(0x80, 0x100):
+        try:
+            bytes([b]).decode(encoding)
+            decoded += 1
+        except (UnicodeDecodeError, LookupError):
+            continue
+    # cp1252 只有 5 个未定义字节
+    return decoded >= 0x60
+
+
+class EncodingDetector:
+    """
+    Detect the encoding of files that are not UTF-8
+
+    Only a bounded sample starting at the first non-ASCII byte is given to libmagic and chardet,
+    the libmagic handle is shared by the process and the encoding found for one file of an archive
+    is tried first for its other files, unless it decodes about any bytes (latin-1, cp1252, koi8-r, ...)
+    and so cannot tell that a file uses another encoding
+    """
+    _magic = None
+    _magic_pid = None
+
+    def __init__(self, sample_bytes=ENCODING_SAMPLE_BYTES):
+        self.sample_bytes = sample_bytes
+        # 同一压缩包内的文件通常使用同一编码
+        self.encoding = None
+
+    @classmethod
+    def magic_handle(cls):
+        # libmagic handles must not cross a fork
+        if cls._magic is None or cls._magic_pid != os.getpid():
+            cls._magic = magic.Magic(mime_encoding=True)
+            cls._magic_pid = os.getpid()
+        return cls._magic
+
+    def sample(self, blob):
+        m = NON_ASCII_PATT.search(blob)
+        start = max(0, m.start() - 1024) if m else 0
+        return blob[start:start + self.sample_bytes]
+
+    def detect_chardet(self, sample):
+        detector = UniversalDetector()
+        for i in range(0, len(sample), ENCODING_CHUNK_BYTES):
+            detector.feed(sample[i:i + ENCODING_CHUNK_BYTES])
+            if detector.done:
+                break
+        detector.close()
+        return detector.result['encoding']
+
+    def decode(self, blob):
+        """
+        Decode a blob that is not valid UTF-8
+        :param blob:
+        :return: decoded content, '' if no encoding was found
+        """
+        try:
+            return blob.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+        if self.encoding and not is_permissive_encoding(self.encoding):
+            try:
+                return blob.decode(self.encoding)
+            except (UnicodeDecodeError, LookupError):
+                pass
+        sample = self.sample(blob)
+        magic_encoding = self.magic_handle().from_buffer(sample)
+        encodings = [(magic_encoding, 'strict')]
+        if magic_encoding in GENERIC_MAGIC_ENCODINGS:
+            encodings.insert(0, (self.detect_chardet(sample), 'replace'))
+        else:
+            encodings.append((self.detect_chardet(sample), 'replace'))
+        for encoding, errors in encodings:
+            if not encoding:
+                continue
+            try:
+                cntnt = blob.decode(encoding, errors=errors)
+                self.encoding = encoding
+                return cntnt
+            except (UnicodeDecodeError, LookupError):
+                continue
+        return ''
+
+
+def read_file(path, detector=None):
+    """
+    Read a text file of unknown encoding
+    :param path:
+    :param detector: EncodingDetector shared by the files of one archive
+    :return:
+    """
     try:
         with open(path) as f:
             cntnt = f.read()
     except UnicodeDecodeError:
-        blob = open(path, 'rb').read()
-        m = magic.Magic(mime_encoding=True)
-        encoding = m.from_buffer(blob)
-        try:
-            cntnt = blob.decode(encoding)
-        except (UnicodeDecodeError, LookupError) as e:
-            encoding = chardet.detect(blob)['encoding']
-            if encoding:
-                try:
-                    cntnt = blob.decode(encoding, errors='replace')
-                except:
-                    return ''
-            else:
-                return ''
+        with open(path, 'rb') as f:
+            blob = f.read()
+        cntnt = (detector or EncodingDetector()).decode(blob)
     return cntnt
 
 
+def _read_head(path, size):
+    # the patterns are ASCII, decoding errors do not matter here
+    with open(path, 'rb') as f:
+        return f.read(size).decode('utf-8', errors='replace')
+
+
+def _has_uncommented(patt, cntnt):
+    for m in patt.finditer(cntnt):
+        line_start = cntnt.rfind('\n', 0, m.start()) + 1
+        if '%' not in cntnt[line_start:m.start()]:
+            return True
+    return False
+
+
+def score_main_tex(fn, head):
+    """
+    Score a main tex candidate from the beginning of its content and its name
+    :param fn: file name
+    :param head: first bytes of the file
+    :return: 0 if the file does not look like a main tex file
+    """
+    score = 0
+    if _has_uncommented(BEGIN_DOCUMENT_PATT, head):
+        score += 4
+    if _has_uncommented(DOCUMENTCLASS_PATT, head):
+        score += 2
+    if score == 0:
+        return 0
+    stem = os.path.splitext(fn)[0]
+    if MAIN_NAME_PATT.match(stem):
+        score += 1
+    if AUX_NAME_PATT.search(stem):
+        score -= 1
+    return score
+
+
+def _find_main_tex(path, file_names, scan_bytes, detector):
+    tex_names = [fn for fn in file_names if TEX_EXT_PATT.match(os.path.splitext(fn)[1])]
+
+    # score .tex files by their first bytes, the best one that has \begin{document} wins
+    candidates = []
+    for tfn in tex_names:
+        try:
+            head = _read_head(os.path.join(path, tfn), scan_bytes)
+        except OSError:
+            continue
+        score = score_main_tex(tfn, head)
+        if score > 0:
+            candidates.append((score, os.path.getsize(os.path.join(path, tfn)), tfn, head))
+    for _, _, tfn, head in sorted(candidates, reverse=True):
+        # \begin{document} after a long preamble
+        if _has_uncommented(BEGIN_DOCUMENT_PATT, head):
+            return tfn
+        try:
+            if re.search(MAIN_TEX_PATT, read_file(os.path.join(path, tfn), detector)) is not None:
+                return tfn
+        except:
+            continue
+
+    # fall back to full scans, .tex files first, then other files
+    main_tex_path = None
+    for tfn in tex_names:
+        try:
+            cntnt = read_file(os.path.join(path, tfn), detector)
+        except:
+            continue
+        if re.search(MAIN_TEX_PATT, cntnt) is not None:
+            main_tex_path = tfn
+    if main_tex_path is not None:
+        return main_tex_path
+
+    for tfn in file_names:
+        if tfn in tex_names or NON_TEXT_PATT.match(os.path.splitext(tfn)[1]):
+            continue
+        try:
+            cntnt = read_file(os.path.join(path, tfn), detector)
+            if re.search(MAIN_TEX_PATT, cntnt) is not None:
+                main_tex_path = tfn
+        except:
+            continue
+    return main_tex_path
+
+
+def find_main_tex(path, scan_bytes=MAIN_TEX_SCAN_BYTES, detector=None) -> Optional[str]:
+    """
+    Identify the primary tex file of an extracted archive
+    Only the first scan_bytes of each .tex file are read unless that is inconclusive
+    :param path: directory of the extracted archive
+    :param scan_bytes:
+    :param detector: EncodingDetector of the archive, used for full reads
+    :return: file name relative to path, None if not found
+    """
+    file_names = sorted(entry.name for entry in os.scandir(path) if entry.is_file())
+    return _find_main_tex(path, file_names, scan_bytes, detector)
+
+
 def remove_math(latex_str):
     parts = re.split(MAIN_TEX_PATT, latex_str, maxsplit=1)
     for patt in FILTER_PATTS:
@@ -94,36 +305,11 @@ def normalize(path, out_dir, write_logs=True):
     # break path
     _, fn = os.path.split(path.strip('/'))
 
-    # identify main tex file
-    main_tex_path = None
-    ignored_names = []
-
-    # check .tex files first
-    for tfn in os.listdir(path):
+    # one encoding detector per archive
+    detector = EncodingDetector()
 
-        if not TEX_EXT_PATT.match(os.path.splitext(tfn)[1]):
-            ignored_names.append(tfn)
-            continue
-
-        try:
-            cntnt = read_file(os.path.join(path, tfn))
-        except:
-            continue
-
-        if re.search(MAIN_TEX_PATT, cntnt) is not None:
-            main_tex_path = tfn
-
-    # try other files
-    if main_tex_path is None:
-        for tfn in ignored_names:
-            if NON_TEXT_PATT.match(os.path.splitext(tfn)[1]):
-                continue
-            try:
-                cntnt = read_file(os.path.join(path, tfn))
-                if re.search(MAIN_TEX_PATT, cntnt) is not None:
-                    main_tex_path = tfn
-            except:
-                continue
+    # identify main tex file
+    main_tex_path = find_main_tex(path, detector=detector)
 
     # give up
     if main_tex_path is None:
@@ -131,18 +317,65 @@ def normalize(path, out_dir, write_logs=True):
              '').format(fn))
         return None
 
+    # find bbl file
+    main_tex_fn = os.path.join(path, main_tex_path)
+    bbl_files = glob.glob(os.path.join(path, '*.bbl'))
+    bbl_path = os.path.split(bbl_files[0])[1] if bbl_files else None
+
     # flatten to single tex file and save
+    if EXPAND_WITH_LATEXPAND:
+        cntnt = run_latexpand(path, main_tex_path, bbl_path, out_dir, detector)
+    else:
+        try:
+            cntnt = expand_latex(path, main_tex_path, bbl_path, detector)
+        except Exception as e:
+            # 展开失败则回退到直接读取主 tex，而不中断整个流程
+            log(f'expand_latex failed for {main_tex_path}: {e}')
+            cntnt = read_file(main_tex_fn, detector)
+
+    new_tex_fn = os.path.join(out_dir, f'{fn}.tex')
+    if PRE_FIX_NATBIB:
+        cntnt = NATBIB_PATT.sub(r'\\cite{\3}', cntnt)
+    if PRE_FIX_BIBOPT:
+        cntnt = BIBOPT_PATT.sub(r'\\bibitem', cntnt)
+    if PRE_FILTER_MATH:
+        cntnt = remove_math(cntnt)
+    with open(new_tex_fn, mode='w', encoding='utf-8') as f:
+        f.write(cntnt)
+    return main_tex_fn
+
+
+def has_table_environment(tex_file: str) -> bool:
+    """
+    Whether a normalized tex file begins any table-like environment, True when it cannot be read
+    :param tex_file:
+    :return:
+    """
+    try:
+        with open(tex_file, 'r', encoding='utf-8', errors='ignore') as f:
+            return TABLE_ENV_PATT.search(f.read()) is not None
+    except OSError:
+        return True
+
+
+def run_latexpand(path, main_tex_path, bbl_path, out_dir, detector=None):
+    """
+    Expand the main tex file with the latexpand perl script
+    :param path: directory of the extracted archive
+    :param main_tex_path: main tex file relative to path
+    :param bbl_path: bbl file relative to path or None
+    :param out_dir: directory of the latexpand log
+    :param detector: EncodingDetector of the archive
+    :return: expanded content
+    """
+    _, fn = os.path.split(path.strip('/'))
     with tempfile.TemporaryDirectory() as tmp_dir_path:
         temp_tex_fn = os.path.join(tmp_dir_path, f'{fn}.tex')
 
-        # find bbl file
-        main_tex_fn = os.path.join(path, main_tex_path)
-        bbl_files = glob.glob(os.path.join(path, '*.bbl'))
-
-        if bbl_files:
+        if bbl_path:
             latexpand_args = ['latexpand',
                               '--expand-bbl',
-                              os.path.split(bbl_files[0])[1],
+                              bbl_path,
                               main_tex_path,
                               '--output',
                               temp_tex_fn]
@@ -155,28 +388,82 @@ def normalize(path, out_dir, write_logs=True):
         # run latexpand
         latexpand_ok = True
         with open(os.path.join(out_dir, 'log_latexpand.txt'), 'a+') as err:
-            try:
-                subprocess.run(latexpand_args, stderr=err, cwd=path, timeout=120)
-            except subprocess.TimeoutExpired:
+            if run_tool(latexpand_args, input_path=main_tex_path, stdout=None, stderr=err, cwd=path).timed_out:
                 # 超时则回退到直接读取主 tex，而不中断整个流程
                 latexpand_ok = False
                 err.write(f'latexpand timeout for {main_tex_path}\n')
 
         # re-read and write to ensure utf-8 b/c latexpand doesn't behave
-        new_tex_fn = os.path.join(out_dir, f'{fn}.tex')
         if latexpand_ok and os.path.exists(temp_tex_fn):
-            cntnt = read_file(temp_tex_fn)
-        else:
-            cntnt = read_file(main_tex_fn)
-        if PRE_FIX_NATBIB:
-            cntnt = NATBIB_PATT.sub(r'\\cite{\3}', cntnt)
-        if PRE_FIX_BIBOPT:
-            cntnt = BIBOPT_PATT.sub(r'\\bibitem', cntnt)
-        if PRE_FILTER_MATH:
-            cntnt = remove_math(cntnt)
-        with open(new_tex_fn, mode='w', encoding='utf-8') as f:
-            f.write(cntnt)
-    return main_tex_fn
+            return read_file(temp_tex_fn, detector)
+        return read_file(os.path.join(path, main_tex_path), detector)
+
+
+def strip_comments(cntnt):
+    """
+    Remove comments like latexpand: comment-only lines are dropped, other comments are cut after the `%`
+    :param cntnt:
+    :return:
+    """
+    cntnt = COMMENT_LINE_PATT.sub('', cntnt)
+    return COMMENT_PATT.sub(r'\1%', cntnt)
+
+
+def expand_latex(path, main_tex_path, bbl_path=None, detector=None):
+    """
+    Inline \\input / \\include files (and the bbl file) into the main tex file, in process
+    Replacement for latexpand: comments are stripped, \\endinput is honored, files are resolved
+    relative to the archive directory like LaTeX does, and cyclic or too deep inputs are left as is
+    :param path: directory of the extracted archive
+    :param main_tex_path: main tex file relative to path
+    :param bbl_path: bbl file relative to path, replaces \\bibliography{...} like latexpand --expand-bbl
+    :param detector: EncodingDetector of the archive
+    :return: expanded content
+    """
+    root = os.path.abspath(path)
+
+    def resolve(name):
+        name = name.strip().strip('"')
+        candidates = [name + '.tex', name] if not name.lower().endswith('.tex') else [name]
+        for candidate in candidates:
+            fpath = os.path.abspath(os.path.join(root, candidate))
+            if os.path.commonpath([root, fpath]) == root and os.path.isfile(fpath):
+                return fpath
+        return None
+
+    def load(fpath):
+        cntnt = strip_comments(read_file(fpath, detector))
+        # \endinput: the rest of the line is kept, the rest of the file is not
+        m = ENDINPUT_PATT.search(cntnt)
+        if m:
+            line_end = cntnt.find('\n', m.end())
+            rest_of_line = cntnt[m.end():] if line_end < 0 else cntnt[m.end():line_end + 1]
+            cntnt = cntnt[:m.start()] + rest_of_line
+        return cntnt
+
+    def expand(fpath, stack):
+        def replace_input(m):
+            fname = m.group(2) if m.group(2) is not None else m.group(3)
+            child = resolve(fname)
+            if child is None or child in stack or len(stack) >= MAX_INPUT_DEPTH:
+                return m.group(0)
+            child_cntnt = expand(child, stack | {child})
+            if not child_cntnt.endswith('\n'):
+                child_cntnt += '\n'
+            if m.group(1) == 'include':
+                return '\\clearpage{}' + child_cntnt + '\\clearpage{}'
+            return child_cntnt
+        return INPUT_PATT.sub(replace_input, load(fpath))
+
+    main_fpath = os.path.abspath(os.path.join(root, main_tex_path))
+    cntnt = expand(main_fpath, {main_fpath})
+
+    if bbl_path:
+        bbl_fpath = os.path.join(root, bbl_path)
+        if os.path.isfile(bbl_fpath):
+            bbl_cntnt = strip_comments(read_file(bbl_fpath, detector))
+            cntnt = BIBLIOGRAPHY_PATT.sub(lambda m: bbl_cntnt, cntnt)
+    return cntnt
 
 
 def latex_to_xml(tex_file: str, out_dir: str, out_file: str, err_file: str, log_file: str):
@@ -202,9 +489,7 @@ def latex_to_xml(tex_file: str, out_dir: str, out_file: str, err_file: str, log_
                         '-nomathml',
                         f'-output_dir={out_dir}',
                         tex_file]
-        try:
-            subprocess.run(tralics_args, stdout=devnull, stderr=err_f, timeout=5)
-        except subprocess.TimeoutExpired:
+        if run_tool(tralics_args, input_path=tex_file, stdout=devnull, stderr=err_f).timed_out:
             skip_f.write(f'{tex_file}\n')
 
         # if no output, skip
@@ -215,41 +500,55 @@ def latex_to_xml(tex_file: str, out_dir: str, out_file: str, err_file: str, log_
         return out_file
 
 
-def latex_to_html(tex_file: str, out_file: str, err_file: str, log_file: str):
+def latex_to_html(tex_file: str, out_file: str, err_file: str, log_file: str, latexml_port: Optional[int] = None):
     """
-    Convert expanded latex file to XML using tralics
+    Convert latex file to HTML using latexml and latexmlpost
     :param tex_file:
-    :param out_dir:
     :param out_file:
     :param err_file:
     :param log_file:
+    :param latexml_port: port of a warm latexmls daemon, None runs latexml and latexmlpost per paper
     :return:
     """
+    global latexml_timeouts
     with open(os.devnull, 'w') as devnull, \
             open(err_file, 'a+') as err_f, \
             open(log_file, 'a+') as skip_f:
-        # run tralics
-        xml_file = out_file.replace('.html', '.xml')
-        latexml_args = ['latexml',
-                        tex_file,
-                        f'--dest={xml_file}'
-                        ]
-        try:
-            subprocess.run(latexml_args, stdout=devnull, stderr=err_f, timeout=120)
-        except subprocess.TimeoutExpired:
-            skip_f.write(f'{tex_file}\n')
-
-        # 仅当生成了 xml 再进行 post 处理
-        if os.path.exists(xml_file):
-            latexmlpost_args = ['latexmlpost',
-                            xml_file,
-                            f'--dest={out_file}'
+        if latexml_port is not None:
+            # 转换与 post 处理都在常驻的 latexmls 中完成
+            tex_file = os.path.abspath(tex_file)
+            timeout = adaptive_timeout('latexml', os.path.getsize(tex_file))
+            latexmlc_args = ['latexmlc',
+                             f'--port={latexml_port}',
+                             f'--timeout={int(timeout)}',
+                             '--format=html5',
+                             f'--path={os.path.dirname(tex_file)}',
+                             f'--dest={os.path.abspath(out_file)}',
+                             tex_file
+                             ]
+            if run_tool(latexmlc_args, input_path=tex_file, timeout=2 * timeout, stdout=devnull, stderr=err_f).timed_out:
+                # 守护进程没有按 --timeout 放弃该任务，视为卡死，由父进程重启
+                latexml_timeouts += 1
+                skip_f.write(f'{tex_file}\n')
+        else:
+            # run latexml
+            xml_file = out_file.replace('.html', '.xml')
+            latexml_args = ['latexml',
+                            tex_file,
+                            f'--dest={xml_file}'
                             ]
-            try:
-                subprocess.run(latexmlpost_args, stdout=devnull, stderr=err_f, timeout=120)
-            except subprocess.TimeoutExpired:
+            if run_tool(latexml_args, input_path=tex_file, stdout=devnull, stderr=err_f).timed_out:
                 skip_f.write(f'{tex_file}\n')
 
+            # 仅当生成了 xml 再进行 post 处理
+            if os.path.exists(xml_file):
+                latexmlpost_args = ['latexmlpost',
+                                xml_file,
+                                f'--dest={out_file}'
+                                ]
+                if run_tool(latexmlpost_args, input_path=xml_file, stdout=devnull, stderr=err_f).timed_out:
+                    skip_f.write(f'{tex_file}\n')
+
         # if no output, skip
         if not os.path.exists(out_file):
             skip_f.write(f'{tex_file}\n')
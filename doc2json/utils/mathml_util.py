@@ -0,0 +1,105 @@
+"""
+Cached LaTeX to MathML conversion
+
+The same formulas ($x$, $\\theta$, $n$, ...) come back thousands of times within a
+paper and across the corpus. Converted snippets are kept in a bounded in-process
+LRU keyed by the TeX source and, optionally, in a SQLite file shared by all
+workers (a SqliteLruCache like the GROBID cache, with its own table and
+eviction trigger). MathML can also be turned off entirely: the parquet rows
+only use the TeX source of formulas.
+"""
+from collections import OrderedDict
+from typing import Optional
+
+import latex2mathml.converter
+
+from doc2json.utils.sqlite_cache import SqliteLruCache, DEFAULT_MAX_ENTRIES
+
+# 进程内缓存的公式数量
+MEMO_SIZE = 4096
+CACHE_KIND = 'mathml'
+CACHE_TABLE = 'mathml'
+# 每篇论文写入的公式远多于参考文献，写入更多条后才检查一次大小
+EVICT_EVERY = 10000
+
+
+class MathmlConverter:
+    """
+    latex2mathml with an in-process LRU and an optional persistent tier
+    """
+
+    def __init__(self, memo_size: int = MEMO_SIZE, cache_path: Optional[str] = None, enabled: bool = True,
+                 max_entries: int = DEFAULT_MAX_ENTRIES, evict_every: int = EVICT_EVERY):
+        """
+        :param memo_size: snippets kept in memory
+        :param cache_path: SQLite file shared by the workers, None keeps the cache in memory only
+        :param enabled: False skips MathML and returns "" for every formula
+        :param max_entries: entries kept in the SQLite file
+        :param evict_every: writes of one worker between two size checks of the SQLite file
+        """
+        self.memo_size = memo_size
+        self.enabled = enabled
+        # TeX 中空白可能有意义（如 \text{}），按原文精确匹配
+        self.cache = None
+        if cache_path:
+            self.cache = SqliteLruCache(cache_path, max_entries=max_entries, evict_every=evict_every,
+                                        table=CACHE_TABLE, normalize=False)
+        self.hits = 0
+        self.misses = 0
+        self._memo = OrderedDict()
+
+    def convert(self, latex: str) -> str:
+        """
+        MathML of a TeX snippet, "" when latex2mathml cannot convert it or MathML is disabled
+        :param latex:
+        :return:
+        """
+        if not self.enabled:
+            return ""
+        if latex in self._memo:
+            self._memo.move_to_end(latex)
+            self.hits += 1
+            return self._memo[latex]
+
+        mathml = self.cache.get(CACHE_KIND, latex) if self.cache is not None else None
+        if mathml is None:
+            self.misses += 1
+            try:
+                mathml = latex2mathml.converter.convert(latex)
+            except Exception:
+                mathml = ""
+            if self.cache is not None:
+                self.cache.put(CACHE_KIND, latex, mathml)
+        else:
+            self.hits += 1
+
+        self._memo[latex] = mathml
+        if len(self._memo) > self.memo_size:
+            self._memo.popitem(last=False)
+        return mathml
+
+
+_converter = MathmlConverter()
+
+
+def set_converter(converter: MathmlConverter):
+    """
+    Use converter for the following conversions, workers forked afterwards inherit it
+    :param converter:
+    :return:
+    """
+    global _converter
+    _converter = converter
+
+
+def get_converter() -> MathmlConverter:
+    return _converter
+
+
+def latex_to_mathml(latex: str) -> str:
+    """
+    MathML of a TeX snippet through the current converter
+    :param latex:
+    :return:
+    """
+    return _converter.convert(latex)
@@ -0,0 +1,172 @@
+"""
+Persistent LRU cache in a SQLite file
+
+Values are stored as JSON keyed by the sha1 of the (optionally normalized) input
+string. The file can be shared by several worker processes; entries that were
+not read for the longest time are evicted when a table grows past max_entries.
+Workers are short-lived (one paper each), so the size is checked whenever a
+process opens the file, and then every evict_every writes of a long-running
+process. Each cache keeps its entries in its own table, so caches sharing a
+file never evict each other's entries. A hit only refreshes the access time of
+an entry that was not touched for touch_after seconds, so that reads of hot
+entries do not take the write lock of the shared file.
+"""
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+from typing import Any, Optional
+
+DEFAULT_MAX_ENTRIES = 1000000
+# 每个进程打开缓存时检查一次大小，此后每写入多少条再检查一次
+DEFAULT_EVICT_EVERY = 1000
+DEFAULT_TABLE = 'entries'
+# 命中时仅当访问时间早于该秒数才写回，LRU 的精度随之变为该粒度
+DEFAULT_TOUCH_AFTER = 3600.0
+
+
+def normalize_cache_text(text: str) -> str:
+    """
+    Collapse whitespace so trivially different strings share a cache entry
+    :param text:
+    :return:
+    """
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def cache_key(kind: str, text: str, normalize: bool = True) -> str:
+    """
+    Content address of one cached entry
+    :param kind: type of cached call, e.g. citation or mathml
+    :param text:
+    :param normalize: collapse whitespace before hashing
+    :return:
+    """
+    if normalize:
+        text = normalize_cache_text(text)
+    return hashlib.sha1(f'{kind}\x00{text}'.encode('utf-8')).hexdigest()
+
+
+class SqliteLruCache:
+    """
+    SQLite backed LRU cache of JSON values, safe to share across processes
+    """
+
+    def __init__(self, cache_path: str, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 evict_every: int = DEFAULT_EVICT_EVERY, table: str = DEFAULT_TABLE, timeout: float = 30.0,
+                 normalize: bool = True, touch_after: float = DEFAULT_TOUCH_AFTER):
+        """
+        :param cache_path: SQLite file, created if missing
+        :param max_entries: entries kept in the table
+        :param evict_every: writes of one process between two size checks
+        :param table: table holding the entries of this cache
+        :param timeout: seconds to wait for a lock held by another process
+        :param normalize: collapse whitespace of the inputs before hashing
+        :param touch_after: seconds after which a hit refreshes the access time of an entry
+        """
+        if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', table):
+            raise ValueError(f"invalid cache table name: {table}")
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.table = table
+        self.timeout = timeout
+        # 关闭时按原文精确匹配，用于空白可能影响结果的输入（如 TeX）
+        self.normalize = normalize
+        self.touch_after = touch_after
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._pid = None
+        self._puts = 0
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite connections must not cross a fork, reconnect in every new process
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.cache_path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                'key TEXT PRIMARY KEY, kind TEXT NOT NULL, value TEXT NOT NULL, accessed REAL NOT NULL)'
+            )
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table} (accessed)')
+            self._conn = conn
+            self._pid = os.getpid()
+            self._puts = 0
+            # 计数只在本进程内有效，新进程先按文件中的实际条数淘汰
+            self.evict()
+        return self._conn
+
+    def get(self, kind: str, text: str) -> Optional[Any]:
+        """
+        Return the cached value or None on a miss
+        :param kind:
+        :param text:
+        :return:
+        """
+        key = cache_key(kind, text, self.normalize)
+        try:
+            conn = self._connect()
+            row = conn.execute(f'SELECT value, accessed FROM {self.table} WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            now = time.time()
+            if now - row[1] >= self.touch_after:
+                conn.execute(f'UPDATE {self.table} SET accessed = ? WHERE key = ?', (now, key))
+        except sqlite3.Error:
+            # 缓存不可用时退化为直接计算
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, kind: str, text: str, value: Any):
+        """
+        Store a JSON serializable value
+        :param kind:
+        :param text:
+        :param value:
+        :return:
+        """
+        if value is None:
+            return
+        try:
+            conn = self._connect()
+            conn.execute(
+                f'INSERT OR REPLACE INTO {self.table} (key, kind, value, accessed) VALUES (?, ?, ?, ?)',
+                (cache_key(kind, text, self.normalize), kind, json.dumps(value, ensure_ascii=False), time.time())
+            )
+            self._puts += 1
+            if self._puts % self.evict_every == 0:
+                self.evict()
+        except sqlite3.Error:
+            return
+
+    def evict(self):
+        """
+        Drop the least recently used entries above max_entries
+        :return:
+        """
+        conn = self._connect()
+        count = conn.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+        if count > self.max_entries:
+            conn.execute(
+                f'DELETE FROM {self.table} WHERE key IN '
+                f'(SELECT key FROM {self.table} ORDER BY accessed ASC LIMIT ?)',
+                (count - self.max_entries,)
+            )
+
+    def __len__(self):
+        return self._connect().execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
@@ -0,0 +1,197 @@
+"""
+Run the external LaTeX tools (tralics, latexml, latexpand, pdflatex, ...)
+
+Every tool runs in its own process group, so a timeout kills the tool together
+with the children it forked. The timeout grows with the size of the input and
+with the durations seen for the tool so far, and every run is written as one
+JSON line (tool, input size, timeout, duration, exit reason) to the tool log.
+"""
+import os
+import json
+import time
+import signal
+import threading
+import subprocess
+from collections import defaultdict, deque
+from typing import List, NamedTuple, Optional
+
+TOOL_LOG_NAME = 'tool_runs.jsonl'
+# 超时至少为该工具近期运行时长 p95 的倍数
+HISTORY_FACTOR = 3
+HISTORY_SIZE = 200
+# 有足够的历史记录后才按历史调整超时
+HISTORY_MIN_RUNS = 10
+REASON_OK = 'ok'
+REASON_ERROR = 'error'
+REASON_TIMEOUT = 'timeout'
+
+
+class ToolPolicy(NamedTuple):
+    min_timeout: float  # seconds, also the timeout of small inputs
+    per_mb: float       # extra seconds per MB of input
+    max_timeout: float  # seconds, upper bound whatever the size and history
+
+
+TOOL_POLICIES = {
+    'tralics': ToolPolicy(5, 20, 60),
+    'latexml': ToolPolicy(120, 120, 600),
+    'latexmlpost': ToolPolicy(120, 120, 600),
+    'latexmlc': ToolPolicy(240, 240, 1200),
+    'latexpand': ToolPolicy(120, 0, 300),
+    'pdflatex': ToolPolicy(180, 120, 600),
+}
+DEFAULT_POLICY = ToolPolicy(60, 60, 600)
+
+
+class ToolResult(NamedTuple):
+    returncode: Optional[int]
+    reason: str
+    duration: float
+    timeout: float
+
+    @property
+    def timed_out(self) -> bool:
+        return self.reason == REASON_TIMEOUT
+
+
+# tool -> durations of recent runs that did not time out
+_history = defaultdict(lambda: deque(maxlen=HISTORY_SIZE))
+# process groups of the tools currently running in this process
+_active_groups = set()
+# tralics 与 latexml 在两个线程中同时运行，_history、_active_groups 与日志文件都在锁内访问
+_lock = threading.Lock()
+_log_file = None
+
+
+def set_log_dir(log_dir: Optional[str]):
+    """
+    Write the structured log of the following runs to log_dir/TOOL_LOG_NAME, None disables it
+    :param log_dir:
+    :return:
+    """
+    global _log_file
+    _log_file = os.path.join(log_dir, TOOL_LOG_NAME) if log_dir else None
+
+
+def _add_duration(tool: str, duration: float):
+    with _lock:
+        _history[tool].append(duration)
+
+
+def load_history(log_file: str):
+    """
+    Add the durations of a tool log to the history, e.g. a paper's log before the parent merges it
+    Workers are forked from the parent, so they start with the history of every paper finished so far
+    :param log_file:
+    :return:
+    """
+    if not os.path.exists(log_file):
+        return
+    with open(log_file, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('reason') != REASON_TIMEOUT:
+                _add_duration(entry['tool'], entry['duration'])
+
+
+def adaptive_timeout(tool: str, input_size: int = 0) -> float:
+    """
+    Timeout of one run from the input size and the durations seen so far
+    :param tool:
+    :param input_size: bytes
+    :return: seconds
+    """
+    policy = TOOL_POLICIES.get(tool, DEFAULT_POLICY)
+    timeout = policy.min_timeout + policy.per_mb * input_size / (1024 * 1024)
+    with _lock:
+        durations = sorted(_history[tool])
+    if len(durations) >= HISTORY_MIN_RUNS:
+        p95 = durations[int(0.95 * (len(durations) - 1))]
+        timeout = max(timeout, HISTORY_FACTOR * p95)
+    return min(timeout, policy.max_timeout)
+
+
+def _kill_group(pgid: int, sig: int):
+    try:
+        os.killpg(pgid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def kill_active_tools():
+    """
+    Kill every tool still running in this process, called before the worker exits
+    :return:
+    """
+    with _lock:
+        groups = list(_active_groups)
+    for pgid in groups:
+        _kill_group(pgid, signal.SIGKILL)
+
+
+def _write_log(entry: dict):
+    if _log_file is None:
+        return
+    line = json.dumps(entry, ensure_ascii=False) + '\n'
+    with _lock:
+        os.makedirs(os.path.dirname(_log_file), exist_ok=True)
+        with open(_log_file, 'a') as f:
+            f.write(line)
+
+
+def run_tool(args: List[str], input_path: Optional[str] = None, timeout: Optional[float] = None,
+             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd: Optional[str] = None) -> ToolResult:
+    """
+    Run an external tool in its own process group and kill the whole group on timeout
+    :param args: command line, args[0] names the tool
+    :param input_path: input file, its size sets the timeout
+    :param timeout: seconds, default is adaptive_timeout
+    :param stdout:
+    :param stderr:
+    :param cwd:
+    :return:
+    """
+    tool = os.path.basename(args[0])
+    input_size = 0
+    if input_path is not None:
+        try:
+            input_size = os.path.getsize(os.path.join(cwd or '', input_path))
+        except OSError:
+            pass
+    if timeout is None:
+        timeout = adaptive_timeout(tool, input_size)
+
+    start_time = time.time()
+    # 新的会话即新的进程组，超时时连同 latexml 等 fork 出的子进程一起结束
+    p = subprocess.Popen(args, stdout=stdout, stderr=stderr, cwd=cwd, start_new_session=True)
+    with _lock:
+        _active_groups.add(p.pid)
+    try:
+        returncode = p.wait(timeout=timeout)
+        reason = REASON_OK if returncode == 0 else REASON_ERROR
+    except subprocess.TimeoutExpired:
+        _kill_group(p.pid, signal.SIGTERM)
+        try:
+            p.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            _kill_group(p.pid, signal.SIGKILL)
+            p.wait()
+        returncode = None
+        reason = REASON_TIMEOUT
+    finally:
+        # 工具自身退出后，残留的子进程也一并结束
+        _kill_group(p.pid, signal.SIGKILL)
+        with _lock:
+            _active_groups.discard(p.pid)
+    duration = round(time.time() - start_time, 3)
+
+    if reason != REASON_TIMEOUT:
+        _add_duration(tool, duration)
+    _write_log({
+        'tool': tool, 'input': input_path, 'input_size': input_size, 'timeout': round(timeout, 3),
+        'duration': duration, 'returncode': returncode, 'reason': reason, 'time': round(start_time, 3)
+    })
+    return ToolResult(returncode, reason, duration, timeout)
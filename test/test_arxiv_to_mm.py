@@ -0,0 +1,152 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import Future
+from pathlib import Path
+from unittest import mock
+
+import pyarrow.parquet as parquet
+from PIL import Image
+
+from doc2json.tex2json import arxiv_to_mm
+from doc2json.tex2json.arxiv_to_mm import ArxivBlock, batch_to_parquet, ARXIV_BLOCK_SCHEMA, ROW_GROUP_SIZE, \
+    FIGURE_PREFETCH, convert_to_rows, prefetch_images, read_image, figure_executor
+from doc2json.utils.image_util import FigureRasterizer
+
+
+def _blocks(count, fail_at=None):
+    for i in range(count):
+        if i == fail_at:
+            raise RuntimeError("figure could not be read")
+        yield ArxivBlock(file_md5='md5', file_id='2101.00001', block_id=i, text=f'text {i}',
+                         image_data=b'png' if i % 2 else None, category='text', timestamp='20260101',
+                         meta_data='{}')
+
+
+class TestBatchToParquet(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.output_file = Path(self.temp_dir) / '2101.00001.parquet'
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_split_and_row_groups(self):
+        files = batch_to_parquet(self.output_file, 3, _blocks(7), row_group_size=2)
+        assert [f.name for f in files] == ['2101.00001_0.parquet', '2101.00001_1.parquet', '2101.00001_2.parquet']
+        block_ids = []
+        for f in files:
+            parquet_file = parquet.ParquetFile(f)
+            assert parquet_file.schema_arrow.equals(ARXIV_BLOCK_SCHEMA)
+            block_ids.append(parquet_file.read().column('块ID').to_pylist())
+        assert block_ids == [[0, 1, 2], [3, 4, 5], [6]]
+        metadata = parquet.ParquetFile(files[0]).metadata
+        assert [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)] == [2, 1]
+        table = parquet.read_table(files[1])
+        assert table.column('图片').to_pylist() == [b'png', None, b'png']
+
+    def test_default_row_group_size(self):
+        files = batch_to_parquet(self.output_file, 1000, _blocks(ROW_GROUP_SIZE * 2 + 1))
+        metadata = parquet.ParquetFile(files[0]).metadata
+        assert [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)] == [
+            ROW_GROUP_SIZE, ROW_GROUP_SIZE, 1
+        ]
+
+    def test_no_rows(self):
+        assert batch_to_parquet(self.output_file, 3, _blocks(0)) == []
+
+    def test_partial_files_removed_on_error(self):
+        with self.assertRaises(RuntimeError):
+            batch_to_parquet(self.output_file, 3, _blocks(7, fail_at=4), row_group_size=2)
+        assert os.listdir(self.temp_dir) == []
+
+
+def _worker_memo_size():
+    return len(arxiv_to_mm._worker_rasterizer._memo)
+
+
+class RecordingExecutor:
+    """
+    Runs submitted calls inline and records how many were submitted
+    """
+
+    def __init__(self):
+        self.submitted = 0
+
+    def submit(self, fn, *args):
+        self.submitted += 1
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+class TestFigurePrefetch(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.uris = []
+        for i in range(5):
+            fpath = os.path.join(self.temp_dir, f'fig{i}.png')
+            Image.new('RGB', (10 + i, 10), (i, 0, 0)).save(fpath)
+            self.uris.append(fpath)
+        broken = os.path.join(self.temp_dir, 'broken.png')
+        with open(broken, 'wb') as f:
+            f.write(b'not a png')
+        self.uris.insert(2, broken)
+        self.uris.insert(4, os.path.join(self.temp_dir, 'missing.pdf'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_same_images_as_serial(self):
+        serial = [read_image(uri) for uri in self.uris]
+        # unreadable figures give the same empty result
+        assert serial[2] == serial[4] == (None, (0, 0))
+        with figure_executor(2) as executor:
+            assert list(prefetch_images(self.uris, executor, prefetch=3)) == serial
+
+    def test_worker_rasterizer(self):
+        pdf = os.path.join(self.temp_dir, 'vector.pdf')
+        Image.new('RGB', (20, 10), (0, 0, 255)).save(pdf)
+        rasterizer = FigureRasterizer(dpi=72)
+        serial = read_image(pdf, rasterizer)
+        assert serial[0] is not None
+        with figure_executor(1, FigureRasterizer(dpi=72)) as executor:
+            assert list(prefetch_images([pdf] * 3, executor)) == [serial] * 3
+            # the worker kept its rasterizer and its memo across tasks
+            assert executor.submit(_worker_memo_size).result() == 1
+
+    def test_window(self):
+        executor = RecordingExecutor()
+        images = prefetch_images(self.uris * 10, executor)
+        next(images)
+        assert executor.submitted == FIGURE_PREFETCH
+        for consumed in range(2, 20):
+            next(images)
+            assert executor.submitted == FIGURE_PREFETCH + consumed - 1
+        assert len(list(images)) == len(self.uris) * 10 - 19
+
+    def test_rows(self):
+        figures = [
+            {'uris': self.uris[:3], 'num': 1, 'text': 'three panels'},
+            {'uris': self.uris[3:4], 'num': 2, 'text': 'missing'},
+            {'uris': self.uris[4:], 'num': 3, 'text': 'three more'},
+        ]
+        md = '\n\n'.join(['Intro'] + [
+            f'[BEGIN_FIGURE_PLACEHOLDER]{json.dumps(figure)}[END_FIGURE_PLACEHOLDER]' for figure in figures
+        ] + ['Outro'])
+        input_file = Path(self.temp_dir) / '2101.00001.json'
+        input_file.write_text('{}')
+
+        def rows(executor=None):
+            return [(row.block_id, row.text, row.image_data, row.category, row.meta_data)
+                    for row in convert_to_rows(input_file, executor=executor)]
+
+        with mock.patch.object(arxiv_to_mm, 'convert_json_to_markdown', lambda data: md):
+            serial = rows()
+            with figure_executor(2) as executor:
+                assert rows(executor) == serial
+        assert [row[3] for row in serial].count('figure') == len(self.uris)
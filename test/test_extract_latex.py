@@ -0,0 +1,273 @@
+import io
+import os
+import gzip
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+from doc2json.tex2json import tex_to_xml
+from doc2json.tex2json.extract_policy import ExtractionPolicy
+from doc2json.tex2json.tex_to_xml import extract_latex, convert_latex_to_s2orc_json, EMPTY_HTML
+
+# stands in for tralics, latexml and latexmlpost: copies its input to the output after FAKE_TOOL_DELAY_<tool>
+# seconds, records when it ran in FAKE_TOOL_EVENTS and fails without output when named by FAKE_TOOL_FAIL
+FAKE_TOOL = f"""#!{sys.executable}
+import os, sys, time
+tool = os.path.basename(sys.argv[0])
+with open(os.environ['FAKE_TOOL_EVENTS'], 'a') as f:
+    f.write(f'{{tool}} start {{time.time()}}\\n')
+time.sleep(float(os.environ.get('FAKE_TOOL_DELAY_' + tool, 0)))
+if tool == 'tralics':
+    in_file = sys.argv[-1]
+    out_dir = [a for a in sys.argv if a.startswith('-output_dir=')][0].split('=', 1)[1]
+    out_file = os.path.join(out_dir, os.path.splitext(os.path.basename(in_file))[0] + '.xml')
+else:
+    in_file = sys.argv[1]
+    out_file = [a for a in sys.argv if a.startswith('--dest=')][0].split('=', 1)[1]
+if os.environ.get('FAKE_TOOL_FAIL') == tool:
+    sys.exit(1)
+with open(in_file) as f_in, open(out_file, 'w') as f_out:
+    f_out.write(f'<{{tool}}>' + f_in.read() + f'</{{tool}}>')
+with open(os.environ['FAKE_TOOL_EVENTS'], 'a') as f:
+    f.write(f'{{tool}} end {{time.time()}}\\n')
+"""
+
+
+class TestExtractLatex(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.latex_dir = os.path.join(self.temp_dir, 'latex')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _make_tar(self, fname, members):
+        fpath = os.path.join(self.temp_dir, fname)
+        with tarfile.open(fpath, 'w:gz') as tar:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        return fpath
+
+    def test_gzip_tar(self):
+        fpath = self._make_tar('1234.5678.gz', [('main.tex', b'\\documentclass{article}'), ('figs/a.png', b'png')])
+        out_dir = extract_latex(fpath, self.latex_dir, policy=ExtractionPolicy(selective=False))
+        assert out_dir == os.path.join(self.latex_dir, '1234.5678')
+        with open(os.path.join(out_dir, 'figs', 'a.png'), 'rb') as f:
+            assert f.read() == b'png'
+        assert not os.path.exists(fpath)
+
+    def test_selective(self):
+        """
+        Unreferenced images and members above the size cap are not extracted
+        :return:
+        """
+        main_tex = b'\\includegraphics[width=3cm]{figs/a}\n\\input{fig.pdf_tex}'
+        fpath = self._make_tar('1234.5678.gz', [
+            ('figs/a.png', b'png'), ('figs/b.pdf', b'pdf'), ('supplement.pdf', b'pdf'), ('c.eps', b'eps'),
+            ('data.csv', b'x' * 100), ('dump.txt', b'x' * 100), ('notes.dat', b'x'), ('readme.txt', b'x'),
+            ('main.tex', main_tex),
+            ('fig.pdf_tex', b'\\put(0,0){\\includegraphics{c.eps}}'),
+        ])
+        out_dir = extract_latex(fpath, self.latex_dir, policy=ExtractionPolicy(max_member_size=50))
+        extracted = sorted(os.path.relpath(os.path.join(root, f), out_dir)
+                           for root, _, files in os.walk(out_dir) for f in files)
+        assert extracted == ['c.eps', 'fig.pdf_tex', 'figs/a.png', 'main.tex', 'notes.dat', 'readme.txt']
+
+    def test_single_pass(self):
+        """
+        Referenced images are kept from the same pass as the sources, the archive is decompressed once
+        :return:
+        """
+        fpath = self._make_tar('1234.5678.gz', [
+            ('figs/a.png', b'png'), ('figs/b.png', b'png'), ('data.csv', b'x' * 100),
+            ('main.tex', b'\\includegraphics{figs/a}'),
+        ])
+        with mock.patch.object(tex_to_xml.gzip, 'open', wraps=gzip.open) as gzip_open:
+            out_dir = extract_latex(fpath, self.latex_dir, policy=ExtractionPolicy(max_member_size=50))
+        # one read of the tar header, one extraction pass
+        assert gzip_open.call_count == 2
+        extracted = sorted(os.path.relpath(os.path.join(root, f), out_dir)
+                           for root, _, files in os.walk(out_dir) for f in files)
+        assert extracted == ['figs/a.png', 'main.tex']
+        # no staged image is left behind
+        assert os.listdir(self.latex_dir) == ['1234.5678']
+
+    def test_selective_macro_reference(self):
+        main_tex = b'\\newcommand{\\fig}[1]{\\includegraphics{#1}}\\fig{a}'
+        fpath = self._make_tar('1234.5678.gz', [('main.tex', main_tex), ('a.png', b'png'), ('b.png', b'png')])
+        out_dir = extract_latex(fpath, self.latex_dir)
+        assert sorted(os.listdir(out_dir)) == ['a.png', 'b.png', 'main.tex']
+
+    def test_gzip_single_tex(self):
+        fpath = os.path.join(self.temp_dir, '1234.5678.gz')
+        with gzip.open(fpath, 'wb') as f:
+            f.write(b'\\documentclass{article}')
+        out_dir = extract_latex(fpath, self.latex_dir)
+        with open(os.path.join(out_dir, '1234.5678.tex'), 'rb') as f:
+            assert f.read() == b'\\documentclass{article}'
+
+    def test_path_traversal(self):
+        fpath = self._make_tar('1234.5678.gz', [('../evil.tex', b'x')])
+        with self.assertRaises(Exception):
+            extract_latex(fpath, self.latex_dir)
+        assert not os.path.exists(os.path.join(self.latex_dir, 'evil.tex'))
+
+
+class TestLazyLatexml(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.latexml_runs = []
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _latex_to_xml(self, tex_file, out_dir, out_file, err_file, log_file):
+        with open(out_file, 'w') as f:
+            f.write('<std/>')
+
+    def _latex_to_html(self, tex_file, out_file, err_file, log_file, latexml_port=None):
+        self.latexml_runs.append(tex_file)
+        with open(out_file, 'w') as f:
+            f.write('<html><body><figure class="ltx_table"></figure></body></html>')
+
+    def _convert(self, main_tex, **kwargs):
+        fpath = os.path.join(self.temp_dir, '1234.5678.gz')
+        with tarfile.open(fpath, 'w:gz') as tar:
+            info = tarfile.TarInfo('main.tex')
+            info.size = len(main_tex)
+            tar.addfile(info, io.BytesIO(main_tex))
+        # tralics and latexml are not run here
+        with mock.patch.object(tex_to_xml, 'latex_to_xml', self._latex_to_xml), \
+                mock.patch.object(tex_to_xml, 'latex_to_html', self._latex_to_html):
+            xml_file, html_file, _ = convert_latex_to_s2orc_json(fpath, os.path.join(self.temp_dir, 'tmp'), **kwargs)
+        assert os.path.exists(xml_file)
+        with open(html_file) as f:
+            return f.read()
+
+    def test_no_tables(self):
+        main_tex = b'\\documentclass{article}\n\\begin{document}\n% \\begin{table}\nText\n\\end{document}\n'
+        assert self._convert(main_tex) == EMPTY_HTML
+        assert not self.latexml_runs
+        assert 'ltx_table' in self._convert(main_tex, lazy_latexml=False)
+        assert len(self.latexml_runs) == 1
+
+    def test_tables(self):
+        for env in ('table*', 'tabular', 'longtable', 'sidewaystable'):
+            main_tex = f'\\documentclass{{article}}\n\\begin{{document}}\n\\begin{{{env}}}\\end{{{env}}}\n\\end{{document}}\n'
+            assert 'ltx_table' in self._convert(main_tex.encode())
+        assert len(self.latexml_runs) == 4
+
+
+class SerialExecutor:
+    """
+    Runs submitted calls inline, in submission order
+    """
+
+    def __init__(self, max_workers=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+class TestConcurrentTools(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.bin_dir = os.path.join(self.temp_dir, 'bin')
+        os.makedirs(self.bin_dir)
+        for tool in ('tralics', 'latexml', 'latexmlpost'):
+            fpath = os.path.join(self.bin_dir, tool)
+            with open(fpath, 'w') as f:
+                f.write(FAKE_TOOL)
+            os.chmod(fpath, 0o755)
+        self.events_file = os.path.join(self.temp_dir, 'events.log')
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = self.bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_TOOL_EVENTS'] = self.events_file
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.temp_dir)
+
+    def _convert(self, run_id):
+        """
+        Convert a paper with a table, so that both tralics and latexml run
+        :param run_id: name of the temp directory of this run
+        :return: contents of the xml and html files, None for a missing one
+        """
+        main_tex = b'\\documentclass{article}\n\\begin{document}\n\\begin{tabular}{c}x\\end{tabular}\n\\end{document}\n'
+        fpath = os.path.join(self.temp_dir, '1234.5678.gz')
+        with tarfile.open(fpath, 'w:gz') as tar:
+            info = tarfile.TarInfo('main.tex')
+            info.size = len(main_tex)
+            tar.addfile(info, io.BytesIO(main_tex))
+        temp_dir = os.path.join(self.temp_dir, run_id)
+        xml_file, html_file, main_tex_fn = convert_latex_to_s2orc_json(fpath, temp_dir)
+        # the extracted sources are removed once both tools are done
+        assert not os.listdir(os.path.join(temp_dir, 'latex'))
+        contents = []
+        for fpath in (xml_file, html_file):
+            if fpath is None:
+                contents.append(None)
+                continue
+            with open(fpath) as f:
+                contents.append(f.read())
+        return contents
+
+    def _events(self):
+        events = dict()
+        with open(self.events_file) as f:
+            for line in f:
+                tool, event, t = line.split()
+                events.setdefault(tool, dict())[event] = float(t)
+        os.remove(self.events_file)
+        return events
+
+    def test_same_as_serial(self):
+        os.environ['FAKE_TOOL_DELAY_tralics'] = '0.5'
+        os.environ['FAKE_TOOL_DELAY_latexml'] = '0.5'
+        concurrent = self._convert('concurrent')
+        events = self._events()
+        # latexml starts while tralics is still running
+        assert events['latexml']['start'] < events['tralics']['end']
+        with mock.patch.object(tex_to_xml, 'ThreadPoolExecutor', SerialExecutor):
+            serial = self._convert('serial')
+        events = self._events()
+        assert events['tralics']['end'] < events['latexml']['start']
+        assert concurrent == serial
+        assert concurrent[0].startswith('<tralics>') and concurrent[1].startswith('<latexmlpost><latexml>')
+
+    def test_latex_dir_kept_until_latexml_ends(self):
+        # latexml reads the main tex from the latex directory long after tralics is done
+        os.environ['FAKE_TOOL_DELAY_latexml'] = '1'
+        xml, html = self._convert('tmp')
+        assert '\\begin{tabular}' in html
+
+    def test_tool_failure_fails_paper(self):
+        for tool in ('tralics', 'latexml', 'latexmlpost'):
+            os.environ['FAKE_TOOL_FAIL'] = tool
+            xml, html = self._convert(tool)
+            # process_tex skips papers without xml or html
+            assert xml is None or html is None
+            if tool == 'tralics':
+                assert xml is None and html is None
+            else:
+                assert xml is not None and html is None
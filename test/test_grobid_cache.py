@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+import sqlite3
+import multiprocessing as mp
+from unittest import mock
+
+from doc2json.grobid2json.grobid.grobid_client import GrobidClient, DEFAULT_GROBID_CONFIG
+from doc2json.tex2json.xml_to_json import process_author
+from doc2json.utils.grobid_cache import GrobidCache
+
+BIB_STRING = 'A. Vaswani et al.  Attention is all you need. NIPS 2017.'
+
+
+def _put_from_child(cache_path):
+    GrobidCache(cache_path).put('citation', 'child entry', {'title': 'child'})
+
+
+def _put_many_from_child(cache_path, max_entries, prefix, count):
+    cache = GrobidCache(cache_path, max_entries=max_entries)
+    for i in range(count):
+        cache.put('citation', f'{prefix} {i}', i)
+
+
+class TestGrobidCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.temp_dir, 'grobid_cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_hit_and_miss(self):
+        cache = GrobidCache(self.cache_path)
+        assert cache.get('citation', BIB_STRING) is None
+        cache.put('citation', BIB_STRING, {'title': 'Attention is all you need', 'year': 2017})
+        # whitespace differences share the same entry, kinds do not
+        assert cache.get('citation', ' ' + BIB_STRING.replace(' ', '\n')) == {
+            'title': 'Attention is all you need', 'year': 2017
+        }
+        assert cache.get('header_names', BIB_STRING) is None
+        assert cache.hits == 1
+        assert cache.misses == 2
+
+    def test_lru_eviction(self):
+        # every hit refreshes the access time
+        cache = GrobidCache(self.cache_path, max_entries=2, touch_after=0)
+        cache.put('citation', 'a', 1)
+        cache.put('citation', 'b', 2)
+        cache.put('citation', 'c', 3)
+        cache.get('citation', 'a')
+        cache.evict()
+        assert len(cache) == 2
+        assert cache.get('citation', 'a') == 1
+        assert cache.get('citation', 'b') is None
+
+    def test_shared_across_processes(self):
+        cache = GrobidCache(self.cache_path)
+        cache.put('citation', 'parent entry', {'title': 'parent'})
+        p = mp.Process(target=_put_from_child, args=(self.cache_path,))
+        p.start()
+        p.join()
+        assert cache.get('citation', 'child entry') == {'title': 'child'}
+
+    def test_eviction_across_processes(self):
+        # one short-lived worker per paper, none of them reaches EVICT_EVERY writes
+        for job in range(6):
+            p = mp.Process(target=_put_many_from_child, args=(self.cache_path, 10, f'paper {job}', 5))
+            p.start()
+            p.join()
+            assert p.exitcode == 0
+            # entries of the previous papers were evicted when the worker opened the cache
+            with sqlite3.connect(self.cache_path) as conn:
+                assert conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0] == min(5 * (job + 1), 15)
+        cache = GrobidCache(self.cache_path, max_entries=10)
+        cache.get('citation', 'paper 5 0')
+        assert len(cache) == 10
+        assert cache.get('citation', 'paper 5 4') == 4
+        assert cache.get('citation', 'paper 0 0') is None
+
+    def test_empty_cache_is_used(self):
+        client = GrobidClient(dict(DEFAULT_GROBID_CONFIG, cache_path=self.cache_path))
+        author_xml = '<author><persname><forename type="first">Ada</forename><surname>Lovelace</surname></persname></author>'
+        log_file = os.path.join(self.temp_dir, 'failed.log')
+        with mock.patch.object(GrobidClient, 'process_header_names', return_value=author_xml) as process_header_names:
+            # an empty cache must still be read and written
+            assert process_author('Ada Lovelace', client, log_file)[0]['last'] == 'Lovelace'
+            assert process_author('Ada Lovelace', client, log_file)[0]['last'] == 'Lovelace'
+        assert process_header_names.call_count == 1
@@ -0,0 +1,202 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+from doc2json.grobid2json.grobid import grobid_client
+from doc2json.grobid2json.grobid.grobid_client import GrobidClient, DEFAULT_GROBID_CONFIG
+from doc2json.tex2json.xml_to_json import process_bibentries
+
+
+def _bib_xml(bib_string):
+    return f'<biblStruct><analytic><title level="a" type="main">{bib_string}</title></analytic></biblStruct>'
+
+
+class FakeResponse:
+
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGrobid:
+    """
+    Answers processCitation and processCitationList with the input string as title
+    """
+
+    def __init__(self, list_status=200, drop=(), empty=()):
+        """
+        :param list_status: status of processCitationList, 404 for servers without it
+        :param drop: citations missing from the processCitationList answer
+        :param empty: citations answered with an empty biblStruct by processCitationList
+        """
+        self.list_status = list_status
+        self.drop = drop
+        self.empty = empty
+        self.calls = []
+
+    def post(self, url, data=None, files=None, headers=None, timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls.append((endpoint, data['citations']))
+        if endpoint == 'processCitation':
+            return FakeResponse(_bib_xml(data['citations'])), 200
+        if self.list_status != 200:
+            return FakeResponse(''), self.list_status
+        bib_structs = [
+            '<biblStruct/>' if bib_string in self.empty else _bib_xml(bib_string)
+            for bib_string in data['citations'] if bib_string not in self.drop
+        ]
+        return FakeResponse('<TEI><listBibl>' + ''.join(bib_structs) + '</listBibl></TEI>'), 200
+
+
+class TestCitationBatches(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.temp_dir, 'failed.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _client(self, fake, **config):
+        client = GrobidClient(dict(DEFAULT_GROBID_CONFIG, max_retries=0, citation_concurrency=1, **config))
+        client.post = fake.post
+        return client
+
+    def _titles(self, xml_strs):
+        return [xml_str.split('type="main">')[1].split('<')[0] if xml_str else None for xml_str in xml_strs]
+
+    def test_batch_results_by_position(self):
+        fake = FakeGrobid()
+        client = self._client(fake, citation_batch_size=2)
+        bib_strings = ['a', 'b', 'c', 'd', 'e']
+        assert self._titles(client.process_citation_list(bib_strings, self.log_file)) == bib_strings
+        # the single citation of the last batch is not worth a list call
+        assert fake.calls == [('processCitationList', ['a', 'b']), ('processCitationList', ['c', 'd']),
+                              ('processCitation', 'e')]
+
+    def test_length_mismatch_falls_back(self):
+        fake = FakeGrobid(drop=('b',))
+        client = self._client(fake)
+        assert self._titles(client.process_citation_list(['a', 'b', 'c'], self.log_file)) == ['a', 'b', 'c']
+        # positions cannot be trusted, every citation of the batch is sent again on its own
+        assert fake.calls[1:] == [('processCitation', 'a'), ('processCitation', 'b'), ('processCitation', 'c')]
+
+    def test_empty_bibl_struct_falls_back(self):
+        fake = FakeGrobid(empty=('b',))
+        client = self._client(fake)
+        assert self._titles(client.process_citation_list(['a', 'b', 'c'], self.log_file)) == ['a', 'b', 'c']
+        assert fake.calls[1:] == [('processCitation', 'b')]
+
+    def test_no_list_endpoint(self):
+        fake = FakeGrobid(list_status=404)
+        client = self._client(fake)
+        assert self._titles(client.process_citation_list(['a', 'b'], self.log_file)) == ['a', 'b']
+        assert not client.batch_citations
+        fake.calls = []
+        client.process_citation_list(['c', 'd'], self.log_file)
+        assert fake.calls == [('processCitation', 'c'), ('processCitation', 'd')]
+
+    def test_process_bibentries(self):
+        fake = FakeGrobid()
+        client = self._client(fake, cache_path=os.path.join(self.temp_dir, 'cache.sqlite'))
+        bib_texts = ['A. Author.\n  First   paper.', None, 'B. Author. Second paper.', 'A. Author. First paper.']
+        entries = process_bibentries(bib_texts, client, self.log_file)
+        # duplicates are requested once
+        assert fake.calls == [('processCitationList', ['A. Author. First paper.', 'B. Author. Second paper.'])]
+        assert [entry['title'] if entry else None for entry in entries] == [
+            'A. Author. First paper.', None, 'B. Author. Second paper.', 'A. Author. First paper.'
+        ]
+        # every position gets its own copy
+        entries[0]['ref_id'] = 'BIBREF0'
+        assert entries[3]['ref_id'] is None
+        fake.calls = []
+        assert process_bibentries(bib_texts, client, self.log_file)[3]['ref_id'] is None
+        assert not fake.calls
+
+
+class SlowGrobid(FakeGrobid):
+    """
+    Requests sent first are answered last
+    """
+
+    def __init__(self, delays, **kwargs):
+        super().__init__(**kwargs)
+        self.delays = delays
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def post(self, url, data=None, files=None, headers=None, timeout=None):
+        citations = data['citations']
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delays[citations if isinstance(citations, str) else citations[0]])
+        with self._lock:
+            self.in_flight -= 1
+        return super().post(url, data=data, files=files, headers=headers, timeout=timeout)
+
+
+class TestCitationConcurrency(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.temp_dir, 'failed.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _citation_list(self, concurrency, bib_strings):
+        delays = {bib_string: 0.02 * (len(bib_strings) - i) for i, bib_string in enumerate(bib_strings)}
+        # c comes back empty and e is missing from its batch, c, e and f go through processCitation
+        fake = SlowGrobid(delays, empty=('c',), drop=('e',))
+        client = GrobidClient(dict(DEFAULT_GROBID_CONFIG, max_retries=0, citation_batch_size=2,
+                                   citation_concurrency=concurrency))
+        client.post = fake.post
+        return client.process_citation_list(bib_strings, self.log_file), fake
+
+    def test_input_order(self):
+        bib_strings = ['a', 'b', 'c', 'd', 'e', 'f', 'g']
+        serial, serial_fake = self._citation_list(1, bib_strings)
+        concurrent, concurrent_fake = self._citation_list(3, bib_strings)
+        assert concurrent == serial
+        assert [xml_str.split('type="main">')[1].split('<')[0] for xml_str in concurrent] == bib_strings
+        assert serial_fake.max_in_flight == 1
+        assert concurrent_fake.max_in_flight == 3
+        assert sorted(map(str, concurrent_fake.calls)) == sorted(map(str, serial_fake.calls))
+
+
+class TestRetry(unittest.TestCase):
+
+    def _post_with_retry(self, answers):
+        """
+        :param answers: status codes or exceptions returned by the successive posts
+        :return: result of _post_with_retry and the sleeps in between
+        """
+        client = GrobidClient(dict(DEFAULT_GROBID_CONFIG, sleep_time=5, max_sleep_time=60, max_retries=5))
+        answers = iter(answers)
+
+        def post(**kwargs):
+            answer = next(answers)
+            if isinstance(answer, Exception):
+                raise answer
+            return FakeResponse(str(answer)), answer
+
+        client.post = post
+        with mock.patch.object(grobid_client.time, 'sleep') as sleep:
+            res, status = client._post_with_retry('http://localhost:8070/api/processCitation', {}, {})
+        return status, [call.args[0] for call in sleep.call_args_list]
+
+    def test_busy_backoff(self):
+        assert self._post_with_retry([503] * 6) == (503, [5, 10, 20, 40, 60])
+        assert self._post_with_retry([503, 503, 200]) == (200, [5, 10])
+
+    def test_connection_errors_backoff(self):
+        errors = [requests.exceptions.ConnectionError()] * 6
+        assert self._post_with_retry(errors) == (None, [5, 10, 20, 40, 60])
+        assert self._post_with_retry([requests.exceptions.ReadTimeout(), 503, 500]) == (500, [5, 10])
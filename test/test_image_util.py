@@ -0,0 +1,85 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from doc2json.utils.image_util import FigureRasterizer, fitz, read_image_bytes
+
+
+class TestReadImageBytes(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, fname, fmt):
+        fpath = os.path.join(self.temp_dir, fname)
+        Image.new('RGB', (40, 30), (255, 0, 0)).save(fpath, format=fmt)
+        return fpath
+
+    def test_passthrough(self):
+        """
+        PNG and JPEG files are stored as is, without a decode/re-encode round trip
+        :return:
+        """
+        for fname, fmt in [('a.png', 'PNG'), ('b.jpg', 'JPEG')]:
+            fpath = self._write(fname, fmt)
+            img_bytes, size = read_image_bytes(fpath)
+            with open(fpath, 'rb') as f:
+                assert img_bytes == f.read()
+            assert size == (40, 30)
+
+    def test_reencode(self):
+        fpath = self._write('c.ppm', 'PPM')
+        img_bytes, size = read_image_bytes(fpath)
+        assert size == (40, 30)
+        assert Image.open(io.BytesIO(img_bytes)).format == 'PPM'
+
+    def test_invalid(self):
+        fpath = os.path.join(self.temp_dir, 'd.png')
+        with open(fpath, 'wb') as f:
+            f.write(b'not an image')
+        assert read_image_bytes(fpath) == (None, (0, 0))
+
+
+@unittest.skipIf(fitz is None, "PyMuPDF is not installed")
+class TestFigureRasterizer(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.temp_dir, 'cache')
+        self.pdf_path = os.path.join(self.temp_dir, 'figure.pdf')
+        doc = fitz.open()
+        for _ in range(3):
+            doc.new_page(width=144, height=72)
+        doc.save(self.pdf_path)
+        doc.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_dpi(self):
+        """
+        Only the first page is rendered, to PNG, at the configured DPI
+        :return:
+        """
+        img_bytes, size = FigureRasterizer(dpi=144).rasterize(self.pdf_path)
+        assert size == (288, 144)
+        assert Image.open(io.BytesIO(img_bytes)).format == 'PNG'
+        assert read_image_bytes(self.pdf_path, FigureRasterizer(dpi=72))[1] == (144, 72)
+
+    def test_disk_cache(self):
+        rendered = FigureRasterizer(dpi=72, cache_dir=self.cache_dir).rasterize(self.pdf_path)
+        # a second process reads the PNG from disk, even if the source is renamed
+        renamed = os.path.join(self.temp_dir, 'copy.pdf')
+        os.rename(self.pdf_path, renamed)
+        rasterizer = FigureRasterizer(dpi=72, cache_dir=self.cache_dir)
+        rasterizer._render = None
+        assert rasterizer.rasterize(renamed) == rendered
+        # the DPI is part of the key
+        assert FigureRasterizer(dpi=144, cache_dir=self.cache_dir).rasterize(renamed)[1] == (288, 144)
@@ -0,0 +1,143 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from doc2json.utils.latex_util import EncodingDetector, expand_latex, find_main_tex, read_file, has_table_environment
+
+
+class TestFindMainTex(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, fname, content):
+        with open(os.path.join(self.temp_dir, fname), 'w') as f:
+            f.write(content)
+
+    def test_scores(self):
+        """
+        Commented out preambles and supplementary documents lose against the real main file
+        :return:
+        """
+        self._write('intro.tex', '% \\begin{document}\n\\section{Introduction}\n')
+        self._write('supplement.tex', '\\documentclass{article}\n\\begin{document}\nsupp\n\\end{document}\n')
+        self._write('ms.tex', '\\documentclass{article}\n\\begin{document}\n\\input{intro}\n\\end{document}\n')
+        self._write('figure.png', 'not a tex file')
+        assert find_main_tex(self.temp_dir) == 'ms.tex'
+
+    def test_long_preamble(self):
+        preamble = '\\newcommand{\\foo}{bar}\n' * 100
+        self._write('a.tex', '\\documentclass{article}\n' + preamble + '\\begin{document}\nx\n\\end{document}\n')
+        self._write('b.tex', '\\section{B}\n')
+        assert find_main_tex(self.temp_dir, scan_bytes=256) == 'a.tex'
+
+    def test_no_main(self):
+        self._write('a.tex', '\\section{A}\n')
+        assert find_main_tex(self.temp_dir) is None
+        # other text files are tried last
+        self._write('main.txt', '\\begin{document}\n\\end{document}\n')
+        assert find_main_tex(self.temp_dir) == 'main.txt'
+
+
+class TestReadFile(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, fname, content, encoding):
+        fpath = os.path.join(self.temp_dir, fname)
+        with open(fpath, 'wb') as f:
+            f.write(content.encode(encoding))
+        return fpath
+
+    def test_legacy_encoding(self):
+        text = '\\documentclass{article}\n' + '\u041f\u0440\u0438\u0432\u0435\u0442 \u043c\u0438\u0440, \u044d\u0442\u043e \u0442\u0435\u043a\u0441\u0442. ' * 200
+        fpath = self._write('a.tex', text, 'koi8-r')
+        assert read_file(fpath) == text
+
+    def test_archive_encoding_reused(self):
+        """
+        The encoding found for one file of an archive is tried first for the next ones
+        :return:
+        """
+        detector = EncodingDetector()
+        text = '\u65e5\u672c\u8a9e\u306e\u6587\u7ae0\u3067\u3059\u3002' * 200
+        read_file(self._write('a.tex', text, 'shift_jis'), detector)
+        encoding = detector.encoding
+        assert encoding is not None
+        detector.detect_chardet = None
+        assert read_file(self._write('b.tex', '\u65e5\u672c', 'shift_jis'), detector) == '\u65e5\u672c'
+        assert detector.encoding == encoding
+        # UTF-8 files never go through the detector
+        assert read_file(self._write('c.tex', '\u00fcber', 'utf-8'), detector) == '\u00fcber'
+
+    def test_permissive_encoding_not_reused(self):
+        """
+        latin-1 decodes any bytes, the next files of the archive are detected again
+        :return:
+        """
+        detector = EncodingDetector()
+        latin_text = 'Caf\u00e9 na\u00efve r\u00e9sum\u00e9 \u00fcber Stra\u00dfe. ' * 200
+        assert read_file(self._write('a.tex', latin_text, 'latin-1'), detector) == latin_text
+        assert detector.encoding is not None
+        utf8_text = 'd\u00e9j\u00e0 vu \u2014 \u03b1\u03b2\u03b3'
+        assert detector.decode(utf8_text.encode('utf-8')) == utf8_text
+        russian_text = '\u041f\u0440\u0438\u0432\u0435\u0442 \u043c\u0438\u0440, \u044d\u0442\u043e \u0442\u0435\u043a\u0441\u0442. ' * 200
+        assert read_file(self._write('b.tex', russian_text, 'koi8-r'), detector) == russian_text
+
+
+class TestExpandLatex(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, fname, content):
+        fpath = os.path.join(self.temp_dir, fname)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath, 'w') as f:
+            f.write(content)
+
+    def test_input_and_include(self):
+        self._write('main.tex', '\\begin{document}\n\\input{sec/intro}\n\\include{b}\n\\input c\n\\input{missing}\n')
+        self._write('sec/intro.tex', 'Intro\n')
+        self._write('b.tex', 'B\n')
+        self._write('c.tex', 'C\n')
+        cntnt = expand_latex(self.temp_dir, 'main.tex')
+        assert 'Intro\n' in cntnt
+        assert '\\clearpage{}B\n\\clearpage{}' in cntnt
+        assert 'C\n' in cntnt
+        assert '\\input{missing}' in cntnt
+
+    def test_comments_and_endinput(self):
+        self._write('main.tex', '% header\nA 50\\% done % note\n\\input{b}\n')
+        self._write('b.tex', 'B \\endinput rest\nnot expanded\n')
+        cntnt = expand_latex(self.temp_dir, 'main.tex')
+        assert cntnt == 'A 50\\% done %\nB  rest\n\n'
+
+    def test_cycle_and_bbl(self):
+        self._write('main.tex', '\\input{a}\n\\bibliography{refs}\n')
+        self._write('a.tex', 'A\n\\input{main}\n')
+        self._write('main.bbl', '\\begin{thebibliography}{1}\\end{thebibliography}\n')
+        cntnt = expand_latex(self.temp_dir, 'main.tex', 'main.bbl')
+        assert cntnt.count('A\n') == 1
+        assert '\\input{main}' in cntnt
+        assert '\\begin{thebibliography}' in cntnt
+        assert '\\bibliography{' not in cntnt
+
+    def test_table_environment(self):
+        self._write('a.tex', 'Text\n\\begin {Table}[h]\n')
+        self._write('b.tex', 'Text with a \\tabularnewline and \\begin{figure}\n')
+        assert has_table_environment(os.path.join(self.temp_dir, 'a.tex'))
+        assert not has_table_environment(os.path.join(self.temp_dir, 'b.tex'))
+        # unreadable input keeps latexml
+        assert has_table_environment(os.path.join(self.temp_dir, 'missing.tex'))
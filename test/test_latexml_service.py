@@ -0,0 +1,122 @@
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from doc2json.tex2json import latexml_service
+from doc2json.tex2json.latexml_service import LatexmlService, port_is_open
+
+# stands in for latexmls: listens on --port until terminated
+FAKE_LATEXMLS = f"""#!{sys.executable}
+import socket, sys
+port = int([a for a in sys.argv if a.startswith('--port=')][0].split('=')[1])
+server = socket.socket()
+server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+server.bind(('127.0.0.1', port))
+server.listen()
+while True:
+    server.accept()[0].close()
+"""
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class TestLatexmlService(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.temp_dir + os.pathsep + self.path
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.temp_dir)
+
+    def _install_fake(self, script=FAKE_LATEXMLS):
+        fpath = os.path.join(self.temp_dir, 'latexmls')
+        with open(fpath, 'w') as f:
+            f.write(script)
+        os.chmod(fpath, 0o755)
+
+    def _acquire(self, service, slot):
+        # papers run latexml on their own until the daemon listens
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            port = service.acquire(slot)
+            if port is not None:
+                return port
+            time.sleep(0.05)
+        raise AssertionError(f"latexmls of slot {slot} did not start")
+
+    def test_restart_after_max_jobs(self):
+        self._install_fake()
+        service = LatexmlService(base_port=_free_port(), max_jobs=2)
+        try:
+            port = self._acquire(service, 0)
+            daemon = service._daemons[0]
+            assert port == service.base_port and port_is_open(port)
+            assert service.acquire(0) == port
+            assert service._daemons[0] is daemon
+            # the third paper goes to a fresh daemon
+            assert self._acquire(service, 0) == port
+            assert service._daemons[0] is not daemon
+            assert daemon.poll() is not None
+        finally:
+            service.close()
+        assert not service._daemons
+
+    def test_stop_on_hang(self):
+        self._install_fake()
+        service = LatexmlService(base_port=_free_port())
+        try:
+            self._acquire(service, 0)
+            daemon = service._daemons[0]
+            service.stop(0)
+            assert daemon.poll() is not None
+            assert self._acquire(service, 0) is not None
+            assert service._daemons[0] is not daemon
+        finally:
+            service.close()
+
+    def test_missing_binary(self):
+        os.environ['PATH'] = self.temp_dir
+        service = LatexmlService(base_port=_free_port())
+        assert service.acquire(0) is None
+        assert not service.available
+
+    def test_startup_does_not_block(self):
+        # a daemon that takes a while before listening
+        self._install_fake(FAKE_LATEXMLS.replace('import socket, sys\n', 'import socket, sys, time\ntime.sleep(1)\n'))
+        service = LatexmlService(base_port=_free_port())
+        try:
+            start = time.time()
+            service.start_all(2)
+            assert service.acquire(0) is None and service.acquire(1) is None
+            assert time.time() - start < 0.5
+            assert sorted(service._daemons) == [0, 1]
+            assert self._acquire(service, 1) == service.port(1)
+        finally:
+            service.close()
+
+    def test_startup_timeout(self):
+        self._install_fake(f"#!{sys.executable}\nimport time\ntime.sleep(30)\n")
+        service = LatexmlService(base_port=_free_port())
+        try:
+            assert service.acquire(0) is None
+            daemon = service._daemons[0]
+            with mock.patch.object(latexml_service, 'STARTUP_TIMEOUT', 0):
+                assert service.acquire(0) is None
+            # the slot gives up on its daemon and runs latexml per paper
+            assert daemon.poll() is not None
+            assert 0 in service._disabled and not service._daemons
+            assert service.acquire(0) is None
+        finally:
+            service.close()
@@ -0,0 +1,63 @@
+import os
+import hashlib
+import shutil
+import tempfile
+import unittest
+
+from doc2json.tex2json.manifest import CompletionManifest, file_md5
+
+
+class TestCompletionManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.manifest_file = os.path.join(self.temp_dir, 'manifest.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_resume(self):
+        """
+        Only sources whose last record is ok are skipped after a restart
+        :return:
+        """
+        manifest = CompletionManifest(self.manifest_file)
+        manifest.record('a.tar.gz', 'ok', outputs=['a.json'], md5='1', runtime=1.0)
+        manifest.record('b.tar.gz', 'timeout', error='timeout after 600s')
+        manifest.record('c.tar.gz', 'failed')
+        manifest.record('c.tar.gz', 'ok')
+
+        resumed = CompletionManifest(self.manifest_file)
+        assert len(resumed) == 3
+        assert resumed.is_completed('a.tar.gz')
+        assert not resumed.is_completed('b.tar.gz')
+        assert resumed.is_completed('c.tar.gz')
+        assert not resumed.is_completed('d.tar.gz')
+        assert resumed.get('a.tar.gz')['outputs'] == ['a.json']
+
+    def test_truncated_line(self):
+        """
+        A half written last line from a crash is ignored
+        :return:
+        """
+        manifest = CompletionManifest(self.manifest_file)
+        manifest.record('a.tar.gz', 'ok')
+        with open(self.manifest_file, 'a') as f:
+            f.write('{"source": "b.tar.gz", "sta')
+
+        resumed = CompletionManifest(self.manifest_file)
+        assert resumed.is_completed('a.tar.gz')
+        assert not resumed.is_completed('b.tar.gz')
+
+        # the next record starts on a line of its own
+        resumed.record('c.tar.gz', 'ok')
+        resumed = CompletionManifest(self.manifest_file)
+        assert resumed.is_completed('a.tar.gz')
+        assert resumed.is_completed('c.tar.gz')
+        assert len(resumed) == 2
+
+    def test_file_md5(self):
+        fpath = os.path.join(self.temp_dir, 'x.txt')
+        with open(fpath, 'wb') as f:
+            f.write(b'hello')
+        assert file_md5(fpath, chunk_size=2) == hashlib.md5(b'hello').hexdigest()
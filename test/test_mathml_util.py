@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import latex2mathml.converter
+
+from doc2json.utils.mathml_util import MathmlConverter
+
+
+class TestMathmlConverter(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.temp_dir, 'mathml_cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_memo(self):
+        converter = MathmlConverter(memo_size=2)
+        assert converter.convert('x') == latex2mathml.converter.convert('x')
+        converter.convert('x')
+        converter.convert('y')
+        converter.convert('z')
+        # x was evicted by z
+        converter.convert('x')
+        assert (converter.hits, converter.misses) == (1, 4)
+
+    def test_persistent_tier(self):
+        MathmlConverter(cache_path=self.cache_path).convert('\\theta + n')
+        # a converter in another worker starts with an empty memo
+        converter = MathmlConverter(cache_path=self.cache_path)
+        assert converter.convert('\\theta + n') == latex2mathml.converter.convert('\\theta + n')
+        assert (converter.hits, converter.misses) == (1, 0)
+        # whitespace is not normalized for TeX
+        converter.convert('\\theta  + n')
+        assert converter.misses == 1
+
+    def test_disabled(self):
+        converter = MathmlConverter(enabled=False)
+        assert converter.convert('x') == ""
+        assert (converter.hits, converter.misses) == (0, 0)
@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from doc2json.tex2json import process_source
+from doc2json.tex2json.manifest import CompletionManifest, STATUS_OK, STATUS_FAILED, STATUS_TIMEOUT
+from doc2json.tex2json.workdir import WorkdirPool
+
+
+def _fake_process_one(source_path, temp_path, output_path, split_size, log_path, *args):
+    """
+    Stand-in for the tex pipeline, the archive name says what happens to the paper
+    """
+    name = os.path.basename(source_path)
+    events_dir = os.path.join(os.path.dirname(source_path), 'events')
+    with open(os.path.join(events_dir, f'{name}.start'), 'w') as f:
+        f.write(str(time.time()))
+    os.makedirs(log_path, exist_ok=True)
+    with open(os.path.join(log_path, 'xml_error.log'), 'a') as f:
+        f.write(f'{name}\n')
+    if name.startswith('fail'):
+        raise RuntimeError(f"{source_path} is not a valid tex file")
+    if name.startswith('crash'):
+        os._exit(3)
+    if name.startswith('nospace') and not os.path.exists(os.path.join(events_dir, f'{name}.nospace')):
+        # a tool filled tmpfs, the paper only fails for lack of output
+        open(os.path.join(events_dir, f'{name}.nospace'), 'w').close()
+        with open(os.path.join(log_path, 'html_error.log'), 'a') as f:
+            f.write('Fatal:I/O:write: No space left on device\n')
+        raise RuntimeError(f"{source_path} is not a valid tex file")
+    time.sleep({'hang': 30, 'slow': 2}.get(name[:4], 0.2))
+    with open(os.path.join(events_dir, f'{name}.end'), 'w') as f:
+        f.write(str(time.time()))
+    return [os.path.join(output_path, name + '.parquet')]
+
+
+class TestProcessSourceList(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.temp_dir, 'sources')
+        self.log_path = os.path.join(self.temp_dir, 'log')
+        os.makedirs(os.path.join(self.source_dir, 'events'))
+        os.makedirs(self.log_path)
+        # logs of the whole run must survive the cleanup of every paper
+        with open(os.path.join(self.log_path, 'run.log'), 'w') as f:
+            f.write('run\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _sources(self, *names):
+        paths = []
+        for name in names:
+            path = os.path.join(self.source_dir, name)
+            with open(path, 'wb') as f:
+                f.write(name.encode())
+            paths.append(path)
+        return paths
+
+    def _run(self, sources, **kwargs):
+        with mock.patch.object(process_source, '_process_one', _fake_process_one):
+            return process_source.process_source_list(
+                sources, os.path.join(self.temp_dir, 'temp'), os.path.join(self.temp_dir, 'output'),
+                log_path=self.log_path, keep_temp=False, **kwargs
+            )
+
+    def _times(self, suffix):
+        events_dir = os.path.join(self.source_dir, 'events')
+        times = dict()
+        for fname in os.listdir(events_dir):
+            if fname.endswith(suffix):
+                with open(os.path.join(events_dir, fname)) as f:
+                    times[fname[:-len(suffix)]] = float(f.read())
+        return times
+
+    def test_results_and_failures(self):
+        sources = self._sources('ok1', 'fail1', 'crash1', 'hang1', 'ok2')
+        manifest = CompletionManifest(os.path.join(self.temp_dir, 'manifest.jsonl'))
+        summary = self._run(sources, workers=2, timeout=3, manifest=manifest)
+        assert (summary['processed'], summary['failed'], summary['skipped']) == (2, 3, 0)
+        statuses = {os.path.basename(source): manifest.get(source)['status'] for source in sources}
+        assert statuses == {'ok1': STATUS_OK, 'ok2': STATUS_OK, 'fail1': STATUS_FAILED,
+                            'crash1': STATUS_FAILED, 'hang1': STATUS_TIMEOUT}
+        assert 'exited with code 3' in manifest.get(sources[2])['error']
+        assert manifest.get(sources[0])['outputs'][0].endswith('ok1.parquet')
+        # every paper's log is merged once, the shared logs are kept
+        with open(os.path.join(self.log_path, 'xml_error.log')) as f:
+            assert sorted(f.read().split()) == ['crash1', 'fail1', 'hang1', 'ok1', 'ok2']
+        assert os.path.exists(os.path.join(self.log_path, 'run.log'))
+        assert not os.listdir(os.path.join(self.temp_dir, 'temp', 'worker_0'))
+
+        assert self._run(sources, workers=2, timeout=3, manifest=manifest)['skipped'] == 2
+
+    def test_pool_is_refilled(self):
+        names = ['slow0'] + [f'ok{i}' for i in range(5)]
+        summary = self._run(self._sources(*names), workers=2, timeout=10)
+        assert summary['processed'] == 6
+        starts, ends = self._times('.start'), self._times('.end')
+        assert sorted(starts) == sorted(names)
+        # never more than two papers in flight
+        for name, start in starts.items():
+            in_flight = [other for other in names if starts[other] <= start < ends[other]]
+            assert len(in_flight) <= 2
+        # the free slot is refilled while the slow paper is still running
+        assert all(ends[name] < ends['slow0'] for name in names[1:])
+
+    def test_tool_out_of_space_retried_on_disk(self):
+        pool = WorkdirPool(os.path.join(self.temp_dir, 'temp'), tmpfs_root=self.temp_dir)
+        try:
+            manifest = CompletionManifest(os.path.join(self.temp_dir, 'manifest.jsonl'))
+            sources = self._sources('nospace1', 'fail1')
+            summary = self._run(sources, workers=2, timeout=10, manifest=manifest, workdir_pool=pool)
+        finally:
+            pool.close()
+        assert (summary['processed'], summary['failed']) == (1, 1)
+        assert manifest.get(sources[0])['status'] == STATUS_OK
+        assert manifest.get(sources[1])['status'] == STATUS_FAILED
@@ -0,0 +1,67 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from doc2json.utils.grobid_cache import GrobidCache
+from doc2json.utils import sqlite_cache
+from doc2json.utils.sqlite_cache import SqliteLruCache
+
+
+class TestSqliteLruCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.temp_dir, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_evict_every(self):
+        cache = SqliteLruCache(self.cache_path, max_entries=3, evict_every=4)
+        for i in range(7):
+            cache.put('x', str(i), i)
+        # size checked at the 4th write only
+        assert len(cache) == 6
+        cache.put('x', '7', 7)
+        assert len(cache) == 3
+        assert [cache.get('x', str(i)) for i in range(8)] == [None] * 5 + [5, 6, 7]
+
+    def test_tables_evicted_separately(self):
+        grobid_cache = GrobidCache(self.cache_path, max_entries=2, evict_every=1)
+        formula_cache = SqliteLruCache(self.cache_path, max_entries=5, evict_every=1, table='mathml', normalize=False,
+                                       touch_after=0)
+        for i in range(5):
+            formula_cache.put('mathml', f'x_{i}', f'<math>{i}</math>')
+        for i in range(3):
+            grobid_cache.put('citation', f'paper {i}', i)
+        # citations only evict citations, the formulas kept their own bound
+        assert (len(grobid_cache), len(formula_cache)) == (2, 5)
+        assert grobid_cache.get('citation', 'paper 0') is None
+        assert formula_cache.get('mathml', 'x_0') == '<math>0</math>'
+        formula_cache.put('mathml', 'x_5', '<math>5</math>')
+        assert (len(grobid_cache), len(formula_cache)) == (2, 5)
+        assert formula_cache.get('mathml', 'x_1') is None
+
+    def test_touch_after(self):
+        cache = SqliteLruCache(self.cache_path, touch_after=60)
+        with mock.patch.object(sqlite_cache.time, 'time', return_value=1000.0):
+            cache.put('x', 'a', 1)
+        # hits of a recently used entry are plain reads
+        for now in (1000.0, 1059.0):
+            with mock.patch.object(sqlite_cache.time, 'time', return_value=now):
+                assert cache.get('x', 'a') == 1
+            assert self._accessed() == [1000.0]
+        with mock.patch.object(sqlite_cache.time, 'time', return_value=1060.0):
+            assert cache.get('x', 'a') == 1
+        assert self._accessed() == [1060.0]
+
+    def _accessed(self):
+        with sqlite3.connect(self.cache_path) as conn:
+            return [row[0] for row in conn.execute('SELECT accessed FROM entries')]
+
+    def test_invalid_table(self):
+        with self.assertRaises(ValueError):
+            SqliteLruCache(self.cache_path, table='entries; DROP TABLE entries')
@@ -0,0 +1,63 @@
+import os
+import json
+import shutil
+import tempfile
+import time
+import unittest
+
+from doc2json.utils import tool_runner
+from doc2json.utils.tool_runner import run_tool, adaptive_timeout, TOOL_POLICIES
+
+
+class TestToolRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        tool_runner.set_log_dir(self.temp_dir)
+        tool_runner._history.clear()
+
+    def tearDown(self):
+        tool_runner.set_log_dir(None)
+        tool_runner._history.clear()
+        shutil.rmtree(self.temp_dir)
+
+    def _log_entries(self):
+        with open(os.path.join(self.temp_dir, tool_runner.TOOL_LOG_NAME)) as f:
+            return [json.loads(line) for line in f]
+
+    def test_timeout_kills_process_group(self):
+        pid_file = os.path.join(self.temp_dir, 'child.pid')
+        # the shell forks a child that would outlive a plain terminate
+        result = run_tool(['sh', '-c', f'sleep 30 & echo $! > {pid_file}; wait'], timeout=1)
+        assert result.timed_out
+        with open(pid_file) as f:
+            child_pid = int(f.read())
+        time.sleep(0.2)
+        # gone, or a zombie waiting for init to reap it
+        stat_file = f'/proc/{child_pid}/stat'
+        if os.path.exists(stat_file):
+            with open(stat_file) as f:
+                assert f.read().split(')')[-1].split()[0] == 'Z'
+        entry = self._log_entries()[-1]
+        assert entry['tool'] == 'sh' and entry['reason'] == 'timeout' and entry['returncode'] is None
+
+    def test_exit_reasons_logged(self):
+        assert run_tool(['true']).reason == 'ok'
+        assert run_tool(['false']).reason == 'error'
+        assert [(e['tool'], e['reason'], e['returncode']) for e in self._log_entries()] == [
+            ('true', 'ok', 0), ('false', 'error', 1)
+        ]
+
+    def test_adaptive_timeout(self):
+        policy = TOOL_POLICIES['tralics']
+        assert adaptive_timeout('tralics') == policy.min_timeout
+        assert adaptive_timeout('tralics', 1024 * 1024) == policy.min_timeout + policy.per_mb
+        assert adaptive_timeout('tralics', 1024 ** 3) == policy.max_timeout
+        # slow runs seen so far raise the timeout of small inputs
+        log_file = os.path.join(self.temp_dir, 'history.jsonl')
+        with open(log_file, 'w') as f:
+            for _ in range(tool_runner.HISTORY_MIN_RUNS):
+                f.write(json.dumps({'tool': 'tralics', 'duration': 4.0, 'reason': 'ok'}) + '\n')
+            f.write(json.dumps({'tool': 'tralics', 'duration': 500.0, 'reason': 'timeout'}) + '\n')
+        tool_runner.load_history(log_file)
+        assert adaptive_timeout('tralics') == tool_runner.HISTORY_FACTOR * 4.0
@@ -0,0 +1,90 @@
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from doc2json.tex2json import workdir as workdir_module
+from doc2json.tex2json.workdir import WorkdirPool, uncompressed_size, merge_logs, paper_log_dir, ran_out_of_space, \
+    EXPANSION_FACTOR
+
+
+class TestWorkdirPool(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.tmpfs_root = os.path.join(self.temp_dir, 'shm')
+        os.makedirs(self.tmpfs_root)
+        self.source_path = os.path.join(self.temp_dir, '1234.5678.gz')
+        with gzip.open(self.source_path, 'wb') as f:
+            f.write(b'\0' * 100000)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_uncompressed_size(self):
+        assert uncompressed_size(self.source_path) == 100000
+        plain_path = os.path.join(self.temp_dir, 'a.tar')
+        with open(plain_path, 'wb') as f:
+            f.write(b'\0' * 10)
+        assert uncompressed_size(plain_path) == 10
+
+    def test_allocate_and_release(self):
+        pool = WorkdirPool(self.temp_dir, self.tmpfs_root, tmpfs_budget=100000 * EXPANSION_FACTOR)
+        workdir, on_tmpfs = pool.allocate(self.source_path, slot=1)
+        assert on_tmpfs
+        assert workdir == os.path.join(pool.tmpfs_dir, 'worker_1', '1234.5678')
+        assert os.path.isdir(workdir)
+        assert pool.allocate(self.source_path, slot=2, on_disk=True) == (
+            os.path.join(self.temp_dir, 'worker_2', '1234.5678'), False
+        )
+        pool.release(workdir, on_tmpfs, keep=True)
+        assert not os.path.exists(workdir)
+        pool.close()
+        assert os.listdir(self.tmpfs_root) == []
+
+    def test_over_budget(self):
+        pool = WorkdirPool(self.temp_dir, self.tmpfs_root, tmpfs_budget=100000)
+        workdir, on_tmpfs = pool.allocate(self.source_path, slot=0)
+        assert not on_tmpfs
+        assert workdir == os.path.join(self.temp_dir, 'worker_0', '1234.5678')
+        pool.close()
+
+    def test_release_merges_logs(self):
+        """
+        Per-paper logs are appended to the shared log dir, the tree on disk is kept only if asked
+        :return:
+        """
+        log_path = os.path.join(self.temp_dir, 'log')
+        pool = WorkdirPool(self.temp_dir)
+        for slot, keep in [(0, True), (1, False)]:
+            workdir, on_tmpfs = pool.allocate(self.source_path, slot=slot)
+            os.makedirs(paper_log_dir(workdir))
+            with open(os.path.join(paper_log_dir(workdir), 'failed.log'), 'w') as f:
+                f.write(f'worker {slot}\n')
+            pool.release(workdir, on_tmpfs, log_path=log_path, keep=keep)
+            assert os.path.exists(workdir) == keep
+            assert not os.path.exists(os.path.join(paper_log_dir(workdir), 'failed.log'))
+        with open(os.path.join(log_path, 'failed.log')) as f:
+            assert f.read() == 'worker 0\nworker 1\n'
+
+    def test_merge_missing_dir(self):
+        merge_logs(os.path.join(self.temp_dir, 'missing'), os.path.join(self.temp_dir, 'log'))
+        assert not os.path.exists(os.path.join(self.temp_dir, 'log'))
+
+    def test_ran_out_of_space(self):
+        workdir = os.path.join(self.temp_dir, 'worker_0', '1234.5678')
+        os.makedirs(paper_log_dir(workdir))
+        with open(os.path.join(paper_log_dir(workdir), 'xml_error.log'), 'w') as f:
+            f.write('Error: file is not valid LaTeX\n')
+        assert not ran_out_of_space(workdir, min_free=0)
+        # a tool that hit the limit only leaves its error message
+        with open(os.path.join(paper_log_dir(workdir), 'html_error.log'), 'w') as f:
+            f.write('Fatal:I/O:write: No space left on device\n')
+        assert ran_out_of_space(workdir, min_free=0)
+        os.remove(os.path.join(paper_log_dir(workdir), 'html_error.log'))
+        # a full file system after the failure
+        usage = shutil.disk_usage(self.temp_dir)
+        with mock.patch.object(workdir_module.shutil, 'disk_usage', return_value=usage._replace(free=1024)):
+            assert ran_out_of_space(workdir)
@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import htmlmin
+from bs4 import BeautifulSoup
+
+from doc2json.tex2json import xml_to_json
+from doc2json.tex2json.xml_to_json import combine_ref_maps, replace_ref_tokens, build_uid_index, \
+    extract_latexml_tables, get_table_map_from_html
+
+# LaTeXML html with text around the tables, a figure, a nested table and non-ASCII content
+LATEXML_HTML = """<!DOCTYPE html><html lang="en">
+<head><meta charset="UTF-8"><title>A Test Paper</title></head>
+<body><div class="ltx_page_main"><article class="ltx_document">
+<h1 class="ltx_title">A Test Paper</h1>
+<p class="ltx_p">Some text\u00a0with a non\u2011breaking space &amp; an entity.</p>
+<figure class="ltx_figure" id="S1.F1"><img src="x.png"/><figcaption>Figure 1: Not a table</figcaption></figure>
+<figure class="ltx_table" id="S1.T1">
+<table class="ltx_tabular">
+<thead><tr><th class="ltx_td" colspan="2">Model&nbsp;A</th></tr></thead>
+<tbody><tr><td class="ltx_td" rowspan="1">\u03b1\u00a0= 1</td><td>caf\u00e9 &lt;b&gt;</td></tr></tbody>
+</table>
+<figcaption class="ltx_caption"><span class="ltx_tag">Table 1: </span>Results with
+<math alttext="x^{2}" display="inline"><semantics><msup><mi>x</mi><mn>2</mn></msup></semantics></math> errors</figcaption>
+</figure>
+<figure class="ltx_table" id="S1.T2"><figure class="ltx_table ltx_subfigure" id="S1.T2.1">
+<table><tr><td>inner</td></tr></table><figcaption>(a) Inner</figcaption></figure>
+<figcaption>Table 2: Outer</figcaption></figure>
+<p class="ltx_p">Trailing text.</p>
+</article></div></body></html>
+"""
+
+
+class TestRefTargets(unittest.TestCase):
+
+    def test_uid_index(self):
+        ref_map = combine_ref_maps(
+            {'EQREF3': {}}, {'FIGREF1': {}, 'FIGREF3': {}}, {'TABREF2': {}}, {'FOOTREF4': {}},
+            {'SECREF1': {}, 'SECREFU5': {}}
+        )
+        # figures win over equations, like the order the prefixes used to be tried in
+        assert ref_map.uid_index == {
+            'uid1': 'FIGREF1', 'uid2': 'TABREF2', 'uid3': 'FIGREF3', 'uid4': 'FOOTREF4', 'uid5': 'SECREFU5'
+        }
+        assert build_uid_index(dict(ref_map)) == ref_map.uid_index
+
+    def test_replace_ref_tokens(self):
+        ref_map = combine_ref_maps({'EQREF2': {}}, {'FIGREF1': {}}, {}, {}, {'SECREF1': {}})
+        sp = BeautifulSoup(
+            "<p>See <ref target='uid1'/>, <ref target='uid2'/>, <ref target='cid1'/>, <ref target='uid9'/>"
+            " and <cit><ref target='bid0'/></cit>.</p>", "lxml"
+        )
+        for ref_map in (ref_map, dict(ref_map)):
+            p = replace_ref_tokens(sp, BeautifulSoup(str(sp.p), "lxml").p, ref_map)
+            assert p.text == "See  FIGREF1 ,  EQREF2 ,  SECREF1 ,  UID9  and  BIBREF0 ."
+
+    def test_plain_dict_indexed_once(self):
+        ref_map = dict(combine_ref_maps({'EQREF2': {}}, {'FIGREF1': {}}, {}, {}, {}))
+        sp = BeautifulSoup("<p><ref target='uid1'/></p><p><ref target='uid2'/></p>", "lxml")
+        with mock.patch.object(xml_to_json, 'build_uid_index', wraps=build_uid_index) as build:
+            assert [replace_ref_tokens(sp, p, ref_map).text for p in sp.find_all('p')] == [' FIGREF1 ', ' EQREF2 ']
+            replace_ref_tokens(sp, sp.p, dict(ref_map))
+        # once per ref map, not once per element
+        assert build.call_count == 2
+
+
+class TestLatexmlTables(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.html_file = os.path.join(self.temp_dir, 'paper.html')
+        with open(self.html_file, 'w', encoding='utf-8') as f:
+            f.write(LATEXML_HTML)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _table_map(self, html_str):
+        sp = BeautifulSoup(htmlmin.minify(html_str, remove_all_empty_space=1), features="html.parser")
+        return get_table_map_from_html(sp, {'1': 'TABREF0', '2': 'TABREF1', '3': 'TABREF2'})
+
+    def test_same_tables_as_whole_page(self):
+        expected = self._table_map(LATEXML_HTML.replace("\xa0", " "))
+        assert len(expected) == 3 and 'Model' in expected['TABREF0']['html']
+        assert self._table_map(extract_latexml_tables(self.html_file)) == expected
+        # U+00A0 split across reads
+        for read_size in (1, 7, 64):
+            with mock.patch.object(xml_to_json, 'HTML_READ_SIZE', read_size):
+                assert self._table_map(extract_latexml_tables(self.html_file)) == expected
+
+    def test_only_tables(self):
+        sp = BeautifulSoup(extract_latexml_tables(self.html_file), features="html.parser")
+        assert [fig['id'] for fig in sp.find_all('figure')] == ['S1.T1', 'S1.T2', 'S1.T2.1']
+        assert 'Trailing' not in sp.text and 'Not a table' not in sp.text
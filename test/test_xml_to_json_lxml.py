@@ -0,0 +1,122 @@
+import contextlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import htmlmin
+from bs4 import BeautifulSoup
+
+from doc2json.grobid2json.grobid.grobid_client import GrobidClient, DEFAULT_GROBID_CONFIG
+from doc2json.tex2json import xml_to_json, xml_to_json_lxml
+
+FILE_ID = '2101.00001'
+
+# tralics output with the constructs each step of the conversion handles
+TRALICS_XML = """<?xml version='1.0' encoding='iso-8859-1'?>
+<!DOCTYPE std SYSTEM 'classes.dtd'>
+<std><p>junk before the title</p> <hi rend='it'>more junk</hi>
+<maketitle><title>A Test <hi rend='bold'>Paper</hi></title></maketitle>
+<author>Ada Lovelace <formula type='inline'><math><mi>a</mi></math></formula> <hi rend='it'>and</hi> Charles Babbage</author>
+<abstract><p>We study <hi rend='it'>things</hi> as in <cit><ref target='bid0'/></cit>.</p></abstract>
+<div0 id-text='1' id='cid1'><head>Introduction</head>
+<p>Text with a footnote<note id-text='1' id='uid1' place='foot'>See <xref url='http://example.org'>here</xref> and <formula type='inline'><math><mi>x</mi></math><texmath>x</texmath></formula>.</note> and
+an equation <formula id-text='1' id='uid2' type='display'><math><mi>y</mi><mo>=</mo><mi>x</mi></math><texmath>y=x</texmath></formula>
+referenced as <ref target='uid2'/>, figure <ref target='uid3'/> and table <ref target='uid5'/>.</p>
+<float name='figure' id-text='1' id='uid3'><figure file='fig1' extension='png'/><caption>A figure, see <ref target='cid2'/> and <cit><ref target='bid1'/></cit>.</caption></float>
+<figure file='fig2' id-text='2' id='uid4'>Bare figure <ref target='uid3'/></figure>
+<float name='table' id-text='1' id='uid5'><table rend='display'><row><cell>a</cell></row></table><caption>A table</caption></float>
+<div1 id-text='1.1' id='cid2'><head>Details <hi rend='it'>here</hi></head>
+<p>More <hi rend='bold'>bold</hi> text <cit><ref target='bid1'/></cit>.</p>
+<p>A list <list type='simple'><item id-text='1' id='uid6'><p noindent='true'>first item</p></item></list></p>
+</div1></div0>
+<div0 rend='nonumber'><head>Acknowledgements</head><p>Thanks <!-- comment --> to all.</p></div0>
+<Bibliography><p><bibitem id='bid0'/>A. Author. A first paper. 2020.</p>
+<p><bibitem id='bid1'/>B. Author. A second paper. <xref url='http://example.org/2'>link</xref> 2021.</p></Bibliography>
+</std>
+"""
+
+LATEXML_HTML = """<html><body><figure class="ltx_table" id="S1.T1"><table><tr><td>a</td></tr></table>
+<figcaption>Table 1: A table</figcaption></figure></body></html>"""
+
+
+def _bib_xml(bib_string):
+    return f'<biblStruct><analytic><title level="a" type="main">{bib_string}</title></analytic></biblStruct>'
+
+
+class TestXmlToJsonLxml(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.temp_dir, 'failed.log')
+        norm_dir = os.path.join(self.temp_dir, 'norm', FILE_ID)
+        os.makedirs(norm_dir)
+        with open(os.path.join(norm_dir, FILE_ID + '.tex'), 'w') as f:
+            f.write('\\begin{tabular}{c}a\\end{tabular}\n')
+        self.grobid_config = dict(DEFAULT_GROBID_CONFIG)
+        self.grobid_config['max_retries'] = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _html_sp(self):
+        return BeautifulSoup(htmlmin.minify(LATEXML_HTML, remove_all_empty_space=1), features="html.parser")
+
+    def _release_json(self, paper):
+        release = paper.release_json()
+        # generation time
+        del release['header']
+        return release
+
+    @contextlib.contextmanager
+    def _grobid(self):
+        # GROBID answers every citation with its own text and is down for author names
+        with mock.patch.object(GrobidClient, 'process_citation_list',
+                               lambda self, bib_strings, log_file: [_bib_xml(s) for s in bib_strings]), \
+                mock.patch.object(GrobidClient, 'process_header_names', lambda self, header, log_file: None):
+            yield
+
+    def _convert(self, engine):
+        with self._grobid():
+            if engine == 'bs4':
+                return xml_to_json.convert_xml_to_s2orc(
+                    BeautifulSoup(TRALICS_XML, "lxml"), self._html_sp(), FILE_ID, '2021', self.log_file,
+                    self.temp_dir, grobid_config=self.grobid_config
+                )
+            return xml_to_json_lxml.convert_xml_to_s2orc(
+                TRALICS_XML, self._html_sp(), FILE_ID, '2021', self.log_file, self.temp_dir,
+                grobid_config=self.grobid_config
+            )
+
+    def test_same_paper_as_bs4(self):
+        expected = self._convert('bs4')
+        assert self._release_json(self._convert('lxml')) == self._release_json(expected)
+        # the fixture reaches every map
+        assert {ref.type_str for ref in expected.ref_entries} == {'equation', 'figure', 'table', 'footnote', 'section'}
+        assert len(expected.bib_entries) == 2 and expected.metadata.authors
+        assert expected.abstract and expected.body_text
+
+    def test_same_body_with_comments_and_whitespace(self):
+        xml = TRALICS_XML.replace("to all.</p>", "to all.</p><!-- c --> \t <p> </p>")
+        # a comment in the author list makes both engines give up on the authors
+        xml = xml.replace("<hi rend='it'>and</hi>", "<!-- affiliation -->")
+        with mock.patch(__name__ + '.TRALICS_XML', xml):
+            assert self._release_json(self._convert('lxml')) == self._release_json(self._convert('bs4'))
+
+    def test_engine_option(self):
+        xml_file = os.path.join(self.temp_dir, FILE_ID + '.xml')
+        html_file = os.path.join(self.temp_dir, FILE_ID + '.html')
+        with open(xml_file, 'w') as f:
+            f.write(TRALICS_XML)
+        with open(html_file, 'w') as f:
+            f.write(LATEXML_HTML)
+        papers = []
+        for engine in xml_to_json.XML_ENGINES:
+            with self._grobid():
+                papers.append(self._release_json(xml_to_json.convert_latex_xml_to_s2orc_json(
+                    xml_file, html_file, self.temp_dir, self.temp_dir, grobid_config=self.grobid_config, engine=engine
+                )))
+        assert papers[0] == papers[1]
+        with self.assertRaises(ValueError):
+            xml_to_json.convert_latex_xml_to_s2orc_json(xml_file, html_file, self.temp_dir, self.temp_dir, engine='sax')